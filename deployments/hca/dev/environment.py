@@ -24,4 +24,6 @@ def env() -> Mapping[str, Optional[str]]:
         'AWS_DEFAULT_REGION': 'us-east-1',
         'AZUL_VERSIONED_BUCKET': 'org-humancellatlas-azul-dev-config',
         'CELLXGENE_ZONE_NAME': 'dev.explore.data.humancellatlas.org',
+        'CELLXGENE_OPTIMIZED_BUCKET': 'org-humancellatlas-cellxgene-optimized-dev',
+        'CELLXGENE_SCHEDULES': '{project_root}/deployments/hca/dev/schedules.json',
     }
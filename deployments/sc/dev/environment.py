@@ -24,4 +24,6 @@ def env() -> Mapping[str, Optional[str]]:
         'AWS_DEFAULT_REGION': 'us-east-1',
         'AZUL_VERSIONED_BUCKET': 'edu-ucsc-gi-singlecell-azul-config-dev.{AWS_DEFAULT_REGION}',
         'CELLXGENE_ZONE_NAME': 'singlecell.gi.ucsc.edu',
+        'CELLXGENE_OPTIMIZED_BUCKET': 'edu-ucsc-gi-singlecell-cellxgene-optimized-dev',
+        'CELLXGENE_SCHEDULES': '{project_root}/deployments/sc/dev/schedules.json',
     }
@@ -36,6 +36,20 @@ def env() -> Mapping[str, Optional[str]]:
         #
         'CELLXGENE_DOMAIN_NAME': 'cellxgene.{CELLXGENE_ZONE_NAME}',
 
+        # The name of the S3 bucket to hold the copies of the matrix files
+        # that `make optimize` rewrites for fast, low-memory serving. The bucket
+        # is created by `make terraform`. Containers serve the optimized copy of
+        # a matrix file if one exists. Leave empty to always serve the original
+        # matrix files.
+        #
+        'CELLXGENE_OPTIMIZED_BUCKET': '',
+
+        # The name of the S3 bucket for the access logs of the load balancer,
+        # created by `make terraform`. Leave empty to disable access logging.
+        # See `cellxgene_fargate.access_logs` for summarizing the logs.
+        #
+        'CELLXGENE_ACCESS_LOG_BUCKET': '',
+
         # The name of the Docker image repository to which the cellxgene Docker
         # image will be pushed.
         #
@@ -45,6 +59,138 @@ def env() -> Mapping[str, Optional[str]]:
         #
         'CELLXGENE_VERSION': '0.15.0',
 
+        # The path to the manifest of matrix files in the release bucket. The
+        # Terraform templates read the manifest instead of listing the bucket.
+        # Run `make manifest` to create or refresh it.
+        #
+        'CELLXGENE_MANIFEST': '{project_root}/manifests/2020-mar.json',
+
+        # A CSV file with the peak memory usage and startup CPU time measured
+        # for a range of matrices, as written by `cellxgene_fargate.benchmark`.
+        # Once it has enough rows, the containers are sized with a model fitted
+        # to these measurements instead of with an estimate based on the size of
+        # the matrix file alone.
+        #
+        'CELLXGENE_PROFILES': '{project_root}/sizing/profiles.csv',
+
+        # A JSON file with the vCPUs and memory of the tasks of individual
+        # studies, as recommended by `cellxgene_fargate.rightsizing` from the
+        # usage observed in production. These take precedence over the sizing
+        # model and the estimate based on file size.
+        #
+        'CELLXGENE_SIZING_OVERRIDES': '{project_root}/sizing/overrides.json',
+
+        # A file with the results of load tests against a single replica of
+        # various sizes, as written by `cellxgene_fargate.loadtest`. Studies
+        # with a concurrency target in their scaling policy are sized with
+        # these, see `cellxgene_fargate.planning`.
+        #
+        'CELLXGENE_CURVES': '{project_root}/sizing/curves.jsonl',
+
+        # A JSON file with the minimum and maximum number of replicas of each
+        # study and the targets for scaling between them. See
+        # `cellxgene_fargate.scaling` for the format.
+        #
+        'CELLXGENE_SCALING': '{project_root}/scaling/studies.json',
+
+        # A JSON file with the number of replicas each study is predicted to
+        # need in every hour of the week, as written by
+        # `cellxgene_fargate.forecast`. Each study's minimum capacity is raised
+        # accordingly, ahead of time. The forecast is made from the traffic of
+        # one deployment, so every deployment has a file of its own.
+        #
+        'CELLXGENE_SCHEDULES': None,
+
+        # Set to 1 to route the requests to the studies through a proxy that
+        # discovers their tasks in Cloud Map, instead of through a listener
+        # rule and target group per study. See `cellxgene_fargate.router`.
+        #
+        'CELLXGENE_ROUTER': '0',
+
+        # Set to 1 to put the resources of each study into a Terraform component
+        # with a state of its own, below `terraform/studies`, and deploy only
+        # the studies that changed with `make deploy`. Switching an existing
+        # deployment requires moving the resources of the studies between
+        # states with `terraform state mv`.
+        #
+        'CELLXGENE_STUDY_COMPONENTS': '0',
+
+        # Set to 1 to have Terraform register new revisions of the task
+        # definitions without updating the services that run them. The services
+        # are then rolled forward in batches with `make rollout`, see
+        # `cellxgene_fargate.rollout`.
+        #
+        'CELLXGENE_ROLLOUT': '0',
+
+        # Set to 1 to extract the latency, status and size of every response
+        # from the access logs of the containers into CloudWatch metrics per
+        # study and endpoint, with a Lambda function subscribed to their log
+        # group. See `cellxgene_fargate.request_metrics`.
+        #
+        'CELLXGENE_REQUEST_METRICS': '0',
+
+        # Set to 1 to enable Container Insights on the cluster, which records
+        # the memory and CPU used by the tasks of every service. `make
+        # rightsize` needs these metrics.
+        #
+        'CELLXGENE_CONTAINER_INSIGHTS': '0',
+
+        # The number of idle, pre-started cellxgene containers to keep ready for
+        # studies that are waking up or scaling out, see
+        # `cellxgene_fargate.pool`. Zero disables the warm pool.
+        #
+        'CELLXGENE_WARM_POOL_SIZE': '0',
+
+        # The memory of each container in the warm pool, in MiB. Only studies
+        # that fit can borrow a container from the pool.
+        #
+        'CELLXGENE_WARM_POOL_MEMORY': '8192',
+
+        # The maximum memory of a Fargate task shared by several small studies,
+        # in MiB. Zero runs every study in a task of its own. See
+        # `cellxgene_fargate.packing`.
+        #
+        'CELLXGENE_PACKING_MEMORY': '0',
+
+        # The fraction by which to increase the memory and CPU predicted by the
+        # sizing model
+        #
+        'CELLXGENE_SIZING_MARGIN': '0.2',
+
+        # The number of seconds in which a container should load its matrix.
+        # The sizing model allocates as many vCPUs as needed to achieve this.
+        #
+        'CELLXGENE_STARTUP_SECONDS_TARGET': '120',
+
+        # Set to 1 to keep a copy of every matrix file on a shared EFS file
+        # system that the containers mount read-only, instead of having every
+        # container download its matrix file whenever it starts. The file system
+        # needs to be populated with `make populate` after it is created and
+        # whenever the set of matrix files changes. Containers fall back to
+        # downloading the matrix file if it is missing from the file system.
+        #
+        'CELLXGENE_EFS_CACHE': '0',
+
+        # Set to 1 to serve each matrix file with several gunicorn worker
+        # processes, as many as the vCPUs allocated to the container allow,
+        # instead of with the single-process server of `cellxgene launch`.
+        #
+        'CELLXGENE_WSGI': '0',
+
+        # Set to 1 to run a caching reverse proxy in front of cellxgene in every
+        # container. The proxy caches the responses to GET requests in memory
+        # and on the task's ephemeral storage and coalesces concurrent identical
+        # requests.
+        #
+        'CELLXGENE_CACHE_PROXY': '0',
+
+        # Set to 1 to serve the studies through a CloudFront distribution that
+        # caches and compresses the responses of the containers at the edge and
+        # speaks HTTP/2 and HTTPS to browsers. The distribution is invalidated
+        # whenever a matrix file or the image changes.
+        #
+        'CELLXGENE_CLOUDFRONT': '0',
+
         # The variables below this point aren't meant to be customized. Things
         # may break if they are changed.
 
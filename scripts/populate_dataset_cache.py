@@ -0,0 +1,43 @@
+"""
+Run the one-shot Fargate task that copies every matrix file to the shared EFS
+file system and wait for it to finish. Requires CELLXGENE_EFS_CACHE=1 and a
+prior `make terraform`.
+"""
+import json
+import os
+from subprocess import check_output
+import sys
+
+import boto3
+
+outputs = json.loads(check_output(['terraform', 'output', '-json'],
+                                  cwd=os.path.join(os.environ['project_root'], 'terraform')))
+try:
+    populate = outputs['populate']['value']
+except KeyError:
+    sys.exit('Terraform output `populate` is missing. Is CELLXGENE_EFS_CACHE set to 1?')
+
+ecs = boto3.client('ecs')
+response = ecs.run_task(cluster=populate['cluster'],
+                        taskDefinition=populate['task_definition'],
+                        launchType='FARGATE',
+                        platformVersion='1.4.0',
+                        networkConfiguration={
+                            'awsvpcConfiguration': {
+                                'subnets': populate['subnets'],
+                                'securityGroups': populate['security_groups'],
+                                'assignPublicIp': 'DISABLED'
+                            }
+                        })
+if response['failures']:
+    sys.exit(f"Failed to start task: {response['failures']}")
+task_arn = response['tasks'][0]['taskArn']
+print('Started', task_arn)
+waiter = ecs.get_waiter('tasks_stopped')
+waiter.wait(cluster=populate['cluster'],
+            tasks=[task_arn],
+            WaiterConfig=dict(Delay=30, MaxAttempts=240))
+task = ecs.describe_tasks(cluster=populate['cluster'], tasks=[task_arn])['tasks'][0]
+exit_code = task['containers'][0].get('exitCode')
+print('Task stopped:', task.get('stoppedReason'), 'Exit code:', exit_code)
+sys.exit(0 if exit_code == 0 else 1)
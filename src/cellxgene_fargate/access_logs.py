@@ -0,0 +1,435 @@
+"""
+Summarize the access logs of the load balancer per study and endpoint.
+
+With CELLXGENE_ACCESS_LOG_BUCKET set, the load balancer writes its access logs
+as gzipped objects to that bucket, every five minutes. This module reads the
+log objects below a prefix of the bucket, or log files downloaded from it,
+several of them at a time, each in a process of its own and as a stream. It
+aggregates the requests per study, taken from the first label of the host,
+and per endpoint, as defined by `cellxgene_fargate.request_metrics`.
+
+For each study and endpoint, the report has the number of requests and the
+average number of requests per second over the period covered by the logs,
+the bytes received and sent, the number of responses with a 5xx status from
+the target and from the load balancer itself, and the 50th, 95th and 99th
+percentile of the target processing time. It also lists the endpoints that
+received the most requests and those that kept the targets busiest.
+
+The percentiles are estimated with a sketch that needs little memory,
+however many requests there are, and whose estimates are within one percent
+of the true value. The sketches of different log files are merged, so the
+result doesn't depend on how the files are spread over the processes. The
+report is written as JSON with one property per line, so that the reports of
+two releases can be compared with `diff` or `--compare`.
+
+Usage:
+
+    python -m cellxgene_fargate.access_logs --output=REPORT \
+        [--domain=DOMAIN] [--jobs=N] (s3://BUCKET/PREFIX | FILE | DIR)...
+    python -m cellxgene_fargate.access_logs --compare OLD NEW
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import gzip
+import io
+import json
+import logging
+import math
+import os
+import re
+import sys
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from dataclasses import (
+    dataclass,
+    field,
+)
+
+from cellxgene_fargate.request_metrics import (
+    endpoint,
+)
+
+log = logging.getLogger(__name__)
+
+JSON = Dict[str, Any]
+
+# https://docs.aws.amazon.com/elasticloadbalancing/latest/application/load-balancer-access-logs.html#access-log-entry-syntax
+field_re = re.compile(r'"(?:[^"\\]|\\.)*"|\S+')
+
+# The indices of the fields used of every log entry
+time_field = 1
+target_processing_time_field = 6
+elb_status_code_field = 8
+target_status_code_field = 9
+received_bytes_field = 10
+sent_bytes_field = 11
+request_field = 12
+
+request_re = re.compile(r'^"\S+ [a-z]+://(?P<host>[^/:]+)(?::\d+)?(?P<target>/\S*)? ')
+
+percentiles = (50, 95, 99)
+
+
+class Sketch:
+    """
+    Estimates quantiles of positive values within a given relative error, in
+    memory bounded by the given number of buckets. Each bucket counts the
+    values between two consecutive powers of gamma. Two sketches with the same
+    accuracy can be merged. If there are more buckets than allowed, the lowest
+    ones are collapsed, sacrificing the accuracy of the lowest quantiles.
+
+    This is the DDSketch, see https://arxiv.org/abs/1908.10693
+
+    >>> s = Sketch()
+    >>> for v in range(1, 1001):
+    ...     s.add(v)
+    >>> [round(s.quantile(q / 100)) for q in (1, 50, 99)]
+    [10, 498, 983]
+    >>> t = Sketch()
+    >>> for v in range(1001, 2001):
+    ...     t.add(v)
+    >>> s.merge(t)
+    >>> s.count, round(s.quantile(0.5))
+    (2000, 1002)
+    """
+
+    # Values below this count as zero
+    min_value = 1e-6
+
+    def __init__(self, relative_accuracy: float = 0.01, max_buckets: int = 2048):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.buckets: Dict[int, int] = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value: float, count: int = 1):
+        if value < self.min_value:
+            self.zeros += count
+        else:
+            i = math.ceil(math.log(value) / self.log_gamma)
+            self.buckets[i] = self.buckets.get(i, 0) + count
+            if len(self.buckets) > self.max_buckets:
+                self._collapse()
+        self.count += count
+
+    def merge(self, other: 'Sketch'):
+        assert self.gamma == other.gamma, (self.gamma, other.gamma)
+        for i, count in other.buckets.items():
+            self.buckets[i] = self.buckets.get(i, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def _collapse(self):
+        indices = sorted(self.buckets)
+        excess = indices[:len(indices) - self.max_buckets + 1]
+        lowest = indices[len(excess)]
+        self.buckets[lowest] += sum(self.buckets.pop(i) for i in excess)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if seen > rank:
+            return 0.0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen > rank:
+                # The middle of the bucket, in terms of relative error
+                return 2 * self.gamma ** i / (self.gamma + 1)
+        assert False
+
+
+@dataclass
+class Stats:
+    requests: int = 0
+    received_bytes: int = 0
+    sent_bytes: int = 0
+    # Responses with a 5xx status from the target
+    target_errors: int = 0
+    # Responses with a 5xx status from the load balancer, for example because
+    # no target was healthy or the target didn't respond
+    elb_errors: int = 0
+    # The total time the targets spent processing the requests, in seconds
+    target_seconds: float = 0.0
+    latency: Sketch = field(default_factory=Sketch)
+
+    def merge(self, other: 'Stats'):
+        self.requests += other.requests
+        self.received_bytes += other.received_bytes
+        self.sent_bytes += other.sent_bytes
+        self.target_errors += other.target_errors
+        self.elb_errors += other.elb_errors
+        self.target_seconds += other.target_seconds
+        self.latency.merge(other.latency)
+
+    def to_json(self, seconds: float) -> JSON:
+        return {
+            'requests': self.requests,
+            'requests_per_second': round(self.requests / seconds, 3) if seconds else None,
+            'received_bytes': self.received_bytes,
+            'sent_bytes': self.sent_bytes,
+            'target_errors': self.target_errors,
+            'elb_errors': self.elb_errors,
+            'target_seconds': round(self.target_seconds, 3),
+            **{
+                f'p{p}_ms': None if q is None else round(q * 1000, 1)
+                for p, q in ((p, self.latency.quantile(p / 100)) for p in percentiles)
+            }
+        }
+
+
+@dataclass
+class Summary:
+    # The stats per study and endpoint
+    stats: Dict[Tuple[str, str], Stats] = field(default_factory=dict)
+    # The time of the first and last request, as ISO 8601 strings
+    first: Optional[str] = None
+    last: Optional[str] = None
+    # Lines that couldn't be parsed
+    malformed: int = 0
+
+    def add(self, study: str, endpoint_: str, time: str, entry: Sequence[str]):
+        key = study, endpoint_
+        try:
+            s = self.stats[key]
+        except KeyError:
+            s = self.stats[key] = Stats()
+        s.requests += 1
+        s.received_bytes += int(entry[received_bytes_field])
+        s.sent_bytes += int(entry[sent_bytes_field])
+        if entry[elb_status_code_field].startswith('5'):
+            if entry[target_status_code_field].startswith('5'):
+                s.target_errors += 1
+            else:
+                s.elb_errors += 1
+        target_processing_time = float(entry[target_processing_time_field])
+        # -1 if the request didn't reach a target or the target didn't respond
+        if target_processing_time >= 0:
+            s.target_seconds += target_processing_time
+            s.latency.add(target_processing_time)
+        # ISO 8601 timestamps in the same time zone compare lexicographically
+        if self.first is None or time < self.first:
+            self.first = time
+        if self.last is None or time > self.last:
+            self.last = time
+
+    def merge(self, other: 'Summary'):
+        for key, s in other.stats.items():
+            try:
+                self.stats[key].merge(s)
+            except KeyError:
+                self.stats[key] = s
+        self.first = min(filter(None, (self.first, other.first)), default=None)
+        self.last = max(filter(None, (self.last, other.last)), default=None)
+        self.malformed += other.malformed
+
+    @property
+    def seconds(self) -> float:
+        if self.first is None:
+            return 0.0
+        else:
+            return (parse_time(self.last) - parse_time(self.first)).total_seconds()
+
+
+def parse_time(s: str) -> datetime:
+    """
+    >>> parse_time('2026-10-18T09:00:00.123456Z')
+    datetime.datetime(2026, 10, 18, 9, 0, 0, 123456)
+    """
+    return datetime.strptime(s, '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def study(host: str, domain: Optional[str]) -> str:
+    """
+    The study the given host belongs to, or `other` for requests that don't
+    name a study, like those of scanners using the address of the load
+    balancer
+
+    >>> study('2020-mar-foo.cellxgene.example.org', 'cellxgene.example.org')
+    '2020-mar-foo'
+    >>> study('cellxgene-123.us-east-1.elb.amazonaws.com', 'cellxgene.example.org')
+    'other'
+    >>> study('2020-mar-foo.cellxgene.example.org', None)
+    '2020-mar-foo'
+    """
+    label, _, parent = host.lower().partition('.')
+    if domain is None or parent == domain.lower():
+        return label
+    else:
+        return 'other'
+
+
+def summarize(lines: Iterable[str], domain: Optional[str]) -> Summary:
+    """
+    >>> line = ('http 2026-10-18T09:00:00.123456Z app/cellxgene/0123 10.0.0.1:4242 10.0.1.5:5005 0.000 0.250 0.000 '
+    ...         '200 200 512 2048 "GET http://2020-mar-foo.cellxgene.example.org:80/api/v0.2/schema HTTP/1.1" '
+    ...         '"Mozilla/5.0" - - arn:aws:elasticloadbalancing:... "Root=1-0123" "-" "-" 1 '
+    ...         '2026-10-18T09:00:00.100000Z "forward" "-" "-" "10.0.1.5:5005" "200" "-" "-"')
+    >>> s = summarize([line, 'garbage'], 'cellxgene.example.org')
+    >>> s.stats[('2020-mar-foo', '/api/v0.2/schema')].to_json(0)['p50_ms'], s.malformed
+    (249.1, 1)
+    """
+    summary = Summary()
+    for line in lines:
+        entry = field_re.findall(line)
+        try:
+            match = request_re.match(entry[request_field])
+            if match is None:
+                raise ValueError(entry[request_field])
+            endpoint_ = endpoint(match.group('target') or '/')
+            if endpoint_ is not None:
+                summary.add(study(match.group('host'), domain), endpoint_, entry[time_field], entry)
+        except (IndexError, ValueError):
+            summary.malformed += 1
+    return summary
+
+
+def open_log(location: str) -> io.TextIOBase:
+    if location.startswith('s3://'):
+        import boto3
+        bucket, _, key = location[len('s3://'):].partition('/')
+        body = boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body']
+        f = gzip.GzipFile(fileobj=body)
+    elif location.endswith('.gz'):
+        f = gzip.open(location)
+    else:
+        f = open(location, 'rb')
+    return io.TextIOWrapper(f, encoding='utf-8', errors='replace')
+
+
+def summarize_log(location: str, domain: Optional[str]) -> Summary:
+    with open_log(location) as f:
+        return summarize(f, domain)
+
+
+def list_logs(locations: Sequence[str]) -> List[str]:
+    """
+    The log objects below the given S3 prefixes and the log files in the given
+    directories, and the given files
+    """
+    logs = []
+    for location in locations:
+        if location.startswith('s3://'):
+            import boto3
+            bucket, _, prefix = location[len('s3://'):].partition('/')
+            paginator = boto3.client('s3').get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                logs.extend(f"s3://{bucket}/{o['Key']}" for o in page.get('Contents', []) if o['Key'].endswith('.log.gz'))
+        elif os.path.isdir(location):
+            for root, _, names in os.walk(location):
+                logs.extend(os.path.join(root, name) for name in names if name.endswith(('.log', '.log.gz')))
+        else:
+            logs.append(location)
+    return sorted(logs)
+
+
+def report(summary: Summary, top: int) -> JSON:
+    seconds = summary.seconds
+    studies = {}
+    for (study_, endpoint_), s in summary.stats.items():
+        studies.setdefault(study_, {})[endpoint_] = s
+    totals = {}
+    for study_, endpoints in studies.items():
+        total = Stats()
+        for s in endpoints.values():
+            total.merge(s)
+        totals[study_] = total
+
+    def hot(key) -> List[str]:
+        ranked = sorted(summary.stats.items(), key=lambda item: (-key(item[1]), item[0]))
+        return [f'{study_} {endpoint_}' for (study_, endpoint_), _ in ranked[:top]]
+
+    return {
+        'first': summary.first,
+        'last': summary.last,
+        'seconds': round(seconds),
+        'malformed': summary.malformed,
+        'studies': {
+            study_: {
+                **totals[study_].to_json(seconds),
+                'endpoints': {
+                    endpoint_: s.to_json(seconds) for endpoint_, s in endpoints.items()
+                }
+            } for study_, endpoints in studies.items()
+        },
+        'most_requested': hot(lambda s: s.requests),
+        'busiest': hot(lambda s: s.target_seconds)
+    }
+
+
+def compare(old_path: str, new_path: str):
+    """
+    Print the per-study metrics that changed between two reports
+    """
+    with open(old_path) as f:
+        old = json.load(f)['studies']
+    with open(new_path) as f:
+        new = json.load(f)['studies']
+    metrics = ('requests_per_second', 'target_errors', 'elb_errors', *(f'p{p}_ms' for p in percentiles))
+    row_format = '{:<32} ' + '| {:<22}' * len(metrics)
+    print(row_format.format('study', *metrics))
+    for study_ in sorted(old.keys() | new.keys()):
+        if study_ not in old or study_ not in new:
+            print(f"{study_:<32} {'added' if study_ in new else 'removed'}")
+            continue
+
+        def change(m: str) -> str:
+            a, b = old[study_][m], new[study_][m]
+            if not a or b is None:
+                return f'{a} -> {b}'
+            else:
+                return f'{a} -> {b} ({(b / a - 1) * 100:+.0f}%)'
+
+        print(row_format.format(study_, *map(change, metrics)))
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--output', help='The file to write the report to')
+    parser.add_argument('--domain', default=os.environ.get('CELLXGENE_DOMAIN_NAME'),
+                        help='The parent domain of the studies. Requests for other hosts are counted as `other`.')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='The number of log files to read concurrently')
+    parser.add_argument('--top', type=int, default=20,
+                        help='The number of endpoints to list as the most requested and busiest')
+    parser.add_argument('locations', nargs='*', metavar='LOCATION')
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.output is None or not args.locations:
+        parser.error('--output and at least one location are required unless --compare is given')
+    logs = list_logs(args.locations)
+    log.info('Reading %i log files', len(logs))
+    summary = Summary()
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for partial in executor.map(summarize_log, logs, [args.domain] * len(logs)):
+            summary.merge(partial)
+    if summary.malformed:
+        log.warning('Skipped %i malformed lines', summary.malformed)
+    with open(args.output, 'w') as f:
+        json.dump(report(summary, args.top), f, indent=1, sort_keys=True)
+        f.write('\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,330 @@
+"""
+Measure the cold start of cellxgene on synthetic matrices of increasing size.
+
+For every combination of the given numbers of cells and genes, densities and
+dtypes, a synthetic `.h5ad` file is generated, unless it already exists in the
+work directory. Then cellxgene is launched on it with the same arguments the
+task definitions use. The time until `/` first responds with 200 OK, the peak
+RSS and the CPU time of the cellxgene process are recorded as one JSON object
+per line in the output file. Each record includes the cellxgene version, so
+the output files of two versions can be compared with `--compare`.
+
+The default grid fits on a laptop. With `--large`, it extends to matrices the
+size of the largest studies, which need tens of GiB of memory and disk.
+
+Usage:
+
+    python -m cellxgene_fargate.benchmark --output results.jsonl [--large]
+    python -m cellxgene_fargate.benchmark --output results.jsonl \
+        --cells 10000,100000 --genes 20000 --density 0.05 --dtype float32
+    python -m cellxgene_fargate.benchmark --compare old.jsonl new.jsonl
+"""
+import argparse
+from contextlib import closing
+import itertools
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import (
+    Any,
+    List,
+    Mapping,
+    Sequence,
+)
+import urllib.error
+import urllib.request
+
+import anndata
+from dataclasses import (
+    asdict,
+    dataclass,
+)
+import h5py
+import numpy
+import pandas
+import scipy.sparse
+
+from cellxgene_fargate.launch import (
+    launch_args,
+)
+from cellxgene_fargate.sizing import (
+    Profile,
+    append_profiles,
+)
+
+log = logging.getLogger(__name__)
+
+# The numbers of cells and genes and the densities measured by default, and
+# with `--large`. The largest matrix of the former has 15 million non-zero
+# values, that of the latter 600 million.
+default_grid = dict(cells=[10_000, 30_000], genes=[2_000, 10_000], density=[0.01, 0.05])
+large_grid = dict(cells=[10_000, 100_000, 300_000], genes=[2_000, 20_000], density=[0.01, 0.1])
+
+# The number of seconds cellxgene is given to exit after being asked to, before
+# it is killed
+stop_timeout = 30
+
+
+@dataclass(frozen=True)
+class Synthetic:
+    n_obs: int
+    n_vars: int
+    density: float
+    x_dtype: str
+    n_embeddings: int
+
+    @property
+    def name(self) -> str:
+        return (f'synthetic_{self.n_obs}x{self.n_vars}_{self.density}'
+                f'_{self.x_dtype}_{self.n_embeddings}.h5ad')
+
+    def generate(self, path: str):
+        """
+        Write an AnnData file with a sparse X of the given shape and density,
+        a few categorical cell annotations and the given number of 2D
+        embeddings.
+        """
+        random = numpy.random.RandomState(42)
+        x = scipy.sparse.random(self.n_obs, self.n_vars,
+                                density=self.density,
+                                format='csr',
+                                dtype=self.x_dtype,
+                                random_state=random)
+        obs = pandas.DataFrame(index=[f'cell_{i}' for i in range(self.n_obs)])
+        for i, cardinality in enumerate((4, 32, 256)):
+            categories = [f'category_{j}' for j in range(cardinality)]
+            obs[f'annotation_{i}'] = pandas.Categorical(random.choice(categories, self.n_obs))
+        var = pandas.DataFrame(index=[f'gene_{i}' for i in range(self.n_vars)])
+        obsm = {
+            f'X_embedding_{i}': random.rand(self.n_obs, 2).astype('float32')
+            for i in range(self.n_embeddings)
+        }
+        adata = anndata.AnnData(X=x, obs=obs, var=var, obsm=obsm)
+        tmp_path = path + '.tmp'
+        adata.write(tmp_path)
+        os.rename(tmp_path, path)
+
+
+@dataclass(frozen=True)
+class Measurement:
+    cellxgene_version: str
+    n_obs: int
+    n_vars: int
+    density: float
+    x_dtype: str
+    n_embeddings: int
+    nnz: int
+    size: int
+    # The number of seconds from spawning the process to the first 200 OK on `/`
+    startup_seconds: float
+    # Peak resident set size of the process, sampled when it is terminated
+    # right after the first 200 OK
+    peak_rss_MiB: float
+    # User and system CPU time of the process
+    cpu_seconds: float
+
+    def as_profile(self) -> Profile:
+        return Profile(label=f'synthetic_{self.n_obs}x{self.n_vars}_{self.density}_{self.x_dtype}',
+                       cellxgene_version=self.cellxgene_version,
+                       n_obs=self.n_obs,
+                       n_vars=self.n_vars,
+                       nnz=self.nnz,
+                       x_dtype=self.x_dtype,
+                       n_embeddings=self.n_embeddings,
+                       size=self.size,
+                       peak_rss_MiB=self.peak_rss_MiB,
+                       startup_cpu_seconds=self.cpu_seconds,
+                       startup_seconds=self.startup_seconds)
+
+
+def cellxgene_version() -> str:
+    output = subprocess.run(['cellxgene', '--version'],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            check=True).stdout
+    return output.decode().split()[-1]
+
+
+def free_port() -> int:
+    with closing(socket.socket()) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_200(url: str, process: subprocess.Popen, timeout: float) -> float:
+    start = time.monotonic()
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError('cellxgene exited prematurely', process.returncode)
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                if response.status == 200:
+                    return time.monotonic()
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            pass
+        if time.monotonic() - start > timeout:
+            raise RuntimeError('Timed out waiting for cellxgene', url)
+        time.sleep(0.1)
+
+
+def terminate(process: subprocess.Popen, timeout: float):
+    """
+    Stop the given process, killing it if it doesn't exit within the given
+    number of seconds, and return its resource usage
+    """
+    process.send_signal(signal.SIGTERM)
+    deadline = time.monotonic() + timeout
+    while True:
+        # Reap the process ourselves to get at its resource usage
+        pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        elif time.monotonic() > deadline:
+            log.warning('cellxgene did not exit within %s seconds, killing it', timeout)
+            process.kill()
+            _, status, rusage = os.wait4(process.pid, 0)
+            break
+        time.sleep(0.1)
+    # Like Popen.wait() would have
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return rusage
+
+
+def measure(synthetic: Synthetic, path: str, version: str, timeout: float) -> Measurement:
+    port = free_port()
+    start = time.monotonic()
+    process = subprocess.Popen(['cellxgene', *launch_args('benchmark', path, port)],
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    try:
+        ready = wait_for_200(f'http://127.0.0.1:{port}/', process, timeout)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            process.wait()
+        raise
+    rusage = terminate(process, stop_timeout)
+    with h5py.File(path, 'r') as f:
+        nnz = f['X']['data'].shape[0]
+    return Measurement(cellxgene_version=version,
+                       n_obs=synthetic.n_obs,
+                       n_vars=synthetic.n_vars,
+                       density=synthetic.density,
+                       x_dtype=synthetic.x_dtype,
+                       n_embeddings=synthetic.n_embeddings,
+                       nnz=nnz,
+                       size=os.path.getsize(path),
+                       startup_seconds=ready - start,
+                       # On Linux, ru_maxrss is in KiB
+                       peak_rss_MiB=rusage.ru_maxrss / 1024,
+                       cpu_seconds=rusage.ru_utime + rusage.ru_stime)
+
+
+def grid(args: argparse.Namespace) -> List[Synthetic]:
+    return [
+        Synthetic(n_obs=n_obs,
+                  n_vars=n_vars,
+                  density=density,
+                  x_dtype=x_dtype,
+                  n_embeddings=args.embeddings)
+        for n_obs, n_vars, density, x_dtype in itertools.product(args.cells,
+                                                                 args.genes,
+                                                                 args.density,
+                                                                 args.dtype)
+    ]
+
+
+def load_measurements(path: str) -> List[Mapping[str, Any]]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(old_path: str, new_path: str):
+    """
+    Print the relative change of each metric between two result files, for
+    each grid point present in both.
+    """
+    metrics = ('startup_seconds', 'peak_rss_MiB', 'cpu_seconds')
+
+    def by_grid_point(path):
+        return {
+            (m['n_obs'], m['n_vars'], m['density'], m['x_dtype'], m['n_embeddings']): m
+            for m in load_measurements(path)
+        }
+
+    old, new = by_grid_point(old_path), by_grid_point(new_path)
+    row_fmt = '{:<45} ' + '| {:<24}' * len(metrics)
+    print(row_fmt.format('cells x genes, density, dtype, embeddings', *metrics))
+    for grid_point in sorted(old.keys() & new.keys()):
+        changes = [
+            f'{old[grid_point][m]:.1f} -> {new[grid_point][m]:.1f} '
+            f'({(new[grid_point][m] / old[grid_point][m] - 1) * 100:+.0f}%)'
+            for m in metrics
+        ]
+        n_obs, n_vars, density, x_dtype, n_embeddings = grid_point
+        print(row_fmt.format(f'{n_obs} x {n_vars}, {density}, {x_dtype}, {n_embeddings}', *changes))
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+
+    def int_list(s):
+        return list(map(int, s.split(',')))
+
+    def float_list(s):
+        return list(map(float, s.split(',')))
+
+    def str_list(s):
+        return s.split(',')
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--output', help='The file to append the results to')
+    parser.add_argument('--profiles',
+                        help='Also append the results to this profiling table, '
+                             'typically the one configured in CELLXGENE_PROFILES.')
+    parser.add_argument('--workdir', default='.benchmark',
+                        help='The directory for the synthetic matrix files')
+    parser.add_argument('--large', action='store_true',
+                        help='Extend the default grid to matrices the size of the largest studies')
+    parser.add_argument('--cells', type=int_list)
+    parser.add_argument('--genes', type=int_list)
+    parser.add_argument('--density', type=float_list)
+    parser.add_argument('--dtype', type=str_list, default=['float32', 'float64'])
+    parser.add_argument('--embeddings', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=1800)
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.output is None:
+        parser.error('--output is required unless --compare is given')
+    for name, default in (large_grid if args.large else default_grid).items():
+        if getattr(args, name) is None:
+            setattr(args, name, default)
+    version = cellxgene_version()
+    os.makedirs(args.workdir, exist_ok=True)
+    for synthetic in grid(args):
+        path = os.path.join(args.workdir, synthetic.name)
+        if not os.path.exists(path):
+            log.info('Generating %s', path)
+            synthetic.generate(path)
+        for _ in range(args.repeat):
+            measurement = measure(synthetic, path, version, args.timeout)
+            log.info('Measured %r', measurement)
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(asdict(measurement)) + '\n')
+            if args.profiles:
+                append_profiles(args.profiles, [measurement.as_profile()])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
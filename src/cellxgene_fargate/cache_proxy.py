@@ -0,0 +1,401 @@
+"""
+A caching reverse proxy in front of a cellxgene server.
+
+The matrix served by a container never changes while the container is
+running, so neither do the responses to GET requests, be it the schema, the
+config, the annotations, the embeddings or the expression of a gene. The
+proxy keeps successful responses in a memory cache backed by a larger cache on
+disk, both of them bounded in size and evicting the least recently used
+response first. Concurrent identical requests are coalesced into a single
+request to cellxgene.
+
+cellxgene's client requests the expression of genes with a PUT request to
+`/api/v0.2/data/var` whose body holds the query. Such requests don't modify
+anything and are cached like GET requests, with the body being part of the key.
+
+Responses are keyed by the digest of the dataset, the method, path, query and
+body of the request and the request headers that cellxgene varies its
+response on. Other requests and responses other than 200 OK are passed
+through uncached.
+
+Usage:
+
+    python -m cellxgene_fargate.cache_proxy --port=PORT \
+        --backend=http://127.0.0.1:BACKEND_PORT --digest=ETAG --cache-dir=DIR
+"""
+import argparse
+import asyncio
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Mapping,
+    Optional,
+    Sequence,
+)
+
+import aiohttp
+from aiohttp import web
+from dataclasses import dataclass
+
+from cellxgene_fargate.launch import (
+    readiness_path,
+)
+
+log = logging.getLogger(__name__)
+
+# https://tools.ietf.org/html/rfc2616#section-13.5.1
+hop_by_hop_headers = frozenset(map(str.lower, (
+    'Connection',
+    'Keep-Alive',
+    'Proxy-Authenticate',
+    'Proxy-Authorization',
+    'TE',
+    'Trailers',
+    'Transfer-Encoding',
+    'Upgrade',
+    # Recomputed by aiohttp
+    'Content-Length',
+    'Host'
+)))
+
+# The response headers kept with a cached response
+cached_headers = ('Content-Type', 'Content-Encoding', 'Vary', 'Cache-Control')
+
+# Responses larger than this are passed through but not cached
+max_entry_size = 64 * 1024 * 1024
+
+# The same fields as the access log of `cellxgene_fargate.serve`, so that
+# `cellxgene_fargate.request_metrics` can parse both
+access_log_format = '%a - - %t "%r" %s %b "%{User-Agent}i" %D'
+
+# Paths of read-only endpoints queried with a PUT request
+read_only_put_paths = frozenset([
+    '/api/v0.2/data/var'
+])
+
+
+@dataclass(frozen=True)
+class Entry:
+    status: int
+    headers: Mapping[str, str]
+    body: bytes
+
+    def to_bytes(self) -> bytes:
+        header = json.dumps({'status': self.status, 'headers': dict(self.headers)})
+        return header.encode() + b'\n' + self.body
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Entry':
+        header, _, body = data.partition(b'\n')
+        header = json.loads(header)
+        return cls(status=header['status'], headers=header['headers'], body=body)
+
+
+class MemoryCache:
+    """
+    An LRU cache of entries, bounded by the total size of their bodies
+
+    >>> c = MemoryCache(10)
+    >>> c.put('a', Entry(200, {}, b'12345'))
+    >>> c.put('b', Entry(200, {}, b'12345'))
+    >>> c.get('a').body
+    b'12345'
+    >>> c.put('c', Entry(200, {}, b'1'))
+    >>> c.get('b') is None, c.size
+    (True, 6)
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.size = 0
+        self.entries: Dict[str, Entry] = OrderedDict()
+
+    def get(self, key: str) -> Optional[Entry]:
+        try:
+            self.entries.move_to_end(key)
+        except KeyError:
+            return None
+        else:
+            return self.entries[key]
+
+    def put(self, key: str, entry: Entry):
+        if len(entry.body) > self.capacity:
+            return
+        old_entry = self.entries.pop(key, None)
+        if old_entry is not None:
+            self.size -= len(old_entry.body)
+        self.entries[key] = entry
+        self.size += len(entry.body)
+        while self.size > self.capacity:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.body)
+
+
+class DiskCache:
+    """
+    An LRU cache of entries in a directory, one file per entry, bounded by the
+    total size of the files. The index is kept in memory, so the directory is
+    emptied when the cache is created. The files are read and written in the
+    default executor of the event loop, so that serving other requests doesn't
+    wait for the disk. The index is only touched on the event loop, and a new
+    entry is added to it once its file is complete.
+    """
+
+    def __init__(self, path: str, capacity: int):
+        self.path = path
+        self.capacity = capacity
+        self.size = 0
+        self.sizes: Dict[str, int] = OrderedDict()
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    async def get(self, key: str) -> Optional[Entry]:
+        try:
+            self.sizes.move_to_end(key)
+        except KeyError:
+            return None
+        loop = asyncio.get_event_loop()
+        try:
+            data = await loop.run_in_executor(None, self._read, key)
+        except FileNotFoundError:
+            # Evicted while being read
+            self._forget(key)
+            return None
+        return Entry.from_bytes(data)
+
+    async def put(self, key: str, entry: Entry):
+        data = entry.to_bytes()
+        if len(data) > self.capacity:
+            return
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._write, key, data)
+        self._forget(key)
+        self.sizes[key] = len(data)
+        self.size += len(data)
+        evicted = []
+        while self.size > self.capacity:
+            evicted_key = next(iter(self.sizes))
+            self._forget(evicted_key)
+            evicted.append(evicted_key)
+        if evicted:
+            await loop.run_in_executor(None, self._unlink, evicted)
+
+    def _forget(self, key: str):
+        size = self.sizes.pop(key, None)
+        if size is not None:
+            self.size -= size
+
+    def _read(self, key: str) -> bytes:
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def _write(self, key: str, data: bytes):
+        tmp_path = self._path(key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, self._path(key))
+
+    def _unlink(self, keys: Sequence[str]):
+        for key in keys:
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                pass
+
+
+class Cache:
+    """
+    A memory cache in front of a disk cache. Entries evicted from memory
+    remain on disk and are promoted back into memory when requested again.
+    """
+
+    def __init__(self, memory: MemoryCache, disk: DiskCache):
+        self.memory = memory
+        self.disk = disk
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[Entry]:
+        entry = self.memory.get(key)
+        if entry is None:
+            entry = await self.disk.get(key)
+            if entry is not None:
+                self.memory.put(key, entry)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def put(self, key: str, entry: Entry):
+        self.memory.put(key, entry)
+        await self.disk.put(key, entry)
+
+
+class Coalescer:
+    """
+    Runs at most one fetch per key at a time. Callers requesting a key that
+    is already being fetched wait for and share the result of that fetch. The
+    fetch runs in its own task so that it completes even if the caller that
+    started it goes away.
+    """
+
+    def __init__(self):
+        self.pending: Dict[str, asyncio.Future] = {}
+
+    async def fetch(self, key: str, fetch: Callable[[], Awaitable[Entry]]) -> Entry:
+        try:
+            task = self.pending[key]
+        except KeyError:
+            task = asyncio.ensure_future(fetch())
+            self.pending[key] = task
+            task.add_done_callback(lambda _: self._done(key, task))
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Future):
+        del self.pending[key]
+        if not task.cancelled():
+            # Avoid "exception never retrieved" if all callers went away
+            task.exception()
+
+
+def is_cacheable(request: web.Request) -> bool:
+    if request.path == readiness_path:
+        # The load balancer asks whether the backend is ready, not the proxy
+        return False
+    return (request.method in ('GET', 'HEAD')
+            or request.method == 'PUT' and request.path in read_only_put_paths)
+
+
+def cache_key(digest: str, request: web.Request, body: bytes) -> str:
+    """
+    cellxgene picks the representation of a response based on the Accept
+    header and compresses it if the Accept-Encoding header allows it.
+    """
+    accept_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    parts = [
+        digest,
+        # HEAD and GET requests share their entries
+        'PUT' if request.method == 'PUT' else 'GET',
+        request.path_qs,
+        hashlib.sha256(body).hexdigest(),
+        request.headers.get('Accept', ''),
+        str(accept_gzip)
+    ]
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+
+def forwarded_headers(headers: Mapping[str, str]) -> Dict[str, str]:
+    return {k: v for k, v in headers.items() if k.lower() not in hop_by_hop_headers}
+
+
+class Proxy:
+
+    def __init__(self, backend: str, digest: str, cache: Cache):
+        self.backend = backend.rstrip('/')
+        self.digest = digest
+        self.cache = cache
+        self.coalescer = Coalescer()
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self, app: web.Application):
+        self.session = aiohttp.ClientSession(auto_decompress=False,
+                                             timeout=aiohttp.ClientTimeout(total=None))
+
+    async def stop(self, app: web.Application):
+        await self.session.close()
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        if not is_cacheable(request):
+            return await self.pass_through(request)
+        body = await request.read()
+        key = cache_key(self.digest, request, body)
+        entry = await self.cache.get(key)
+        if entry is None:
+            try:
+                entry = await self.coalescer.fetch(key, lambda: self.fetch(key, request, body))
+            except aiohttp.ClientConnectionError as e:
+                # Most likely, cellxgene is still loading the matrix
+                log.info('Backend unavailable: %s', e)
+                raise web.HTTPBadGateway()
+            cache_status = 'MISS'
+        else:
+            cache_status = 'HIT'
+        return web.Response(status=entry.status,
+                            body=entry.body,
+                            headers={**entry.headers, 'X-Cache': cache_status})
+
+    async def fetch(self, key: str, request: web.Request, body: bytes) -> Entry:
+        method = 'PUT' if request.method == 'PUT' else 'GET'
+        async with self.session.request(method,
+                                        self.backend + request.path_qs,
+                                        headers=forwarded_headers(request.headers),
+                                        data=body if method == 'PUT' else None,
+                                        allow_redirects=False) as upstream:
+            body = await upstream.read()
+            entry = Entry(status=upstream.status,
+                          headers={k: upstream.headers[k] for k in cached_headers if k in upstream.headers},
+                          body=body)
+            if (upstream.status == 200
+                and 'Set-Cookie' not in upstream.headers
+                and len(body) <= max_entry_size):
+                await self.cache.put(key, entry)
+            return entry
+
+    async def pass_through(self, request: web.Request) -> web.StreamResponse:
+        try:
+            async with self.session.request(request.method,
+                                            self.backend + request.path_qs,
+                                            headers=forwarded_headers(request.headers),
+                                            data=await request.read(),
+                                            allow_redirects=False) as upstream:
+                return web.Response(status=upstream.status,
+                                    body=await upstream.read(),
+                                    headers=forwarded_headers(upstream.headers))
+        except aiohttp.ClientConnectionError as e:
+            log.info('Backend unavailable: %s', e)
+            raise web.HTTPBadGateway()
+
+
+def create_app(backend: str, digest: str, cache: Cache) -> web.Application:
+    proxy = Proxy(backend, digest, cache)
+    app = web.Application()
+    app.on_startup.append(proxy.start)
+    app.on_cleanup.append(proxy.stop)
+    app.router.add_route('*', '/{path:.*}', proxy.handle)
+    return app
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--backend', required=True, help='The base URL of the cellxgene server')
+    parser.add_argument('--digest', required=True,
+                        help='Identifies the dataset served by the backend, typically the ETag of the matrix file')
+    parser.add_argument('--cache-dir', required=True)
+    parser.add_argument('--memory-cache-size', type=int, default=64 * 1024 * 1024)
+    parser.add_argument('--disk-cache-size', type=int, default=2 * 1024 * 1024 * 1024)
+    args = parser.parse_args(argv)
+    cache = Cache(MemoryCache(args.memory_cache_size),
+                  DiskCache(args.cache_dir, args.disk_cache_size))
+    app = create_app(args.backend, args.digest, cache)
+    web.run_app(app, host=args.host, port=args.port, access_log_format=access_log_format)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,246 @@
+"""
+Split the generated Terraform configuration into a shared component and one
+component per study.
+
+Planning the configuration for all studies in one state refreshes every
+study's resources, even if only one matrix file changed. In split mode, the
+resources of each study, or of each pack of studies, are moved out of the
+configuration emitted by `terraform/cellxgene.tf.json.template.py` into a
+component of their own, with a state of its own, below `terraform/studies`.
+What remains, the VPC, the load balancer, the cluster and so on, is the shared
+component.
+
+A reference from a study's resource to a shared resource is replaced with a
+reference to an output of the shared component, read through a
+`terraform_remote_state` data source. The shared component must not refer to
+the resources of a study.
+
+Every study component records a digest of its inputs in its state, passed in
+as a variable by `cellxgene_fargate.deploy`, which uses it to skip the
+components that haven't changed since they were last applied.
+"""
+import hashlib
+import json
+import os
+import re
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+)
+
+JSON = Dict[str, Any]
+
+# The name of the data source for the state of the shared component
+remote_state = 'cellxgene'
+
+# The component generated for each study is a subdirectory of this one,
+# relative to the `terraform` directory
+studies_dir = 'studies'
+
+reference_re = re.compile(r'\$\{((?:data\.)?[a-z0-9_]+\.[A-Za-z0-9_-]+)\.([A-Za-z0-9_.]+)\}')
+
+output_reference_re = re.compile(r'\$\{data\.terraform_remote_state\.' + remote_state + r'\.outputs\.([A-Za-z0-9_-]+)\}')
+
+
+def state_key(component: str) -> str:
+    """
+    The key of the state of the given component in the backend bucket, as
+    configured by `terraform/backend.tf.json.template.py`
+
+    >>> state_key('')
+    'cellxgene-fargate.tfstate'
+    >>> state_key('2020marfoo')
+    'cellxgene-fargate-2020marfoo.tfstate'
+    """
+    suffix = '-' + component if component else ''
+    return f'cellxgene-fargate{suffix}.tfstate'
+
+
+def output_name(address: str, attribute: str) -> str:
+    """
+    >>> output_name('data.aws_ecr_image.cellxgene', 'image_digest')
+    'data_aws_ecr_image_cellxgene_image_digest'
+    """
+    return '_'.join((address + '.' + attribute).split('.'))
+
+
+def _substitute(value, f):
+    if isinstance(value, str):
+        return f(value)
+    elif isinstance(value, dict):
+        return {k: _substitute(v, f) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_substitute(v, f) for v in value]
+    else:
+        return value
+
+
+def references(value) -> Set[str]:
+    """
+    The addresses of the resources and data sources referenced by the given
+    part of a configuration
+
+    >>> sorted(references({'a': ['${aws_vpc.cellxgene.id}/${data.aws_ecr_image.cellxgene.image_digest}']}))
+    ['aws_vpc.cellxgene', 'data.aws_ecr_image.cellxgene']
+    """
+    found = set()
+
+    def collect(s: str) -> str:
+        found.update(match.group(1) for match in reference_re.finditer(s))
+        return s
+
+    _substitute(value, collect)
+    return found
+
+
+def split(tf: JSON,
+          components: Mapping[str, Iterable[Tuple[str, str]]],
+          remote_state_config: JSON) -> Tuple[JSON, Dict[str, JSON]]:
+    """
+    Move the resources of each component, given as pairs of resource type and
+    name, out of the given configuration. Returns the configuration of the
+    shared component and that of each of the other components.
+    """
+    resources = {type_: dict(resources) for type_, resources in tf['resource'].items()}
+    owner = {}
+    for component, addresses in components.items():
+        for type_, name in addresses:
+            assert f'{type_}.{name}' not in owner, (type_, name)
+            owner[f'{type_}.{name}'] = component
+    docs = {}
+    outputs = {}
+    for component in components:
+        component_resources = {}
+        for type_, name in components[component]:
+            component_resources.setdefault(type_, {})[name] = resources[type_].pop(name)
+
+        def localize(s: str) -> str:
+            def replace(match) -> str:
+                address, attribute = match.groups()
+                if owner.get(address) == component:
+                    return match.group(0)
+                assert address not in owner, f'{component} refers to {address} of {owner[address]}'
+                name = output_name(address, attribute)
+                outputs[name] = {'value': match.group(0)}
+                return '${data.terraform_remote_state.' + remote_state + '.outputs.' + name + '}'
+
+            return reference_re.sub(replace, s)
+
+        for type_, named in component_resources.items():
+            for name, resource in named.items():
+                resource = _substitute(resource, localize)
+                if 'depends_on' in resource:
+                    # The shared component is applied before any study
+                    resource['depends_on'] = [
+                        address for address in resource['depends_on']
+                        if owner.get(address) == component
+                    ]
+                named[name] = resource
+        docs[component] = {
+            'data': {
+                'terraform_remote_state': {
+                    remote_state: {
+                        'backend': 's3',
+                        'config': remote_state_config
+                    }
+                }
+            },
+            'variable': {
+                'digest': {
+                    'default': ''
+                }
+            },
+            'resource': component_resources,
+            'output': {
+                'digest': {
+                    'value': '${var.digest}'
+                }
+            }
+        }
+    shared = {
+        **tf,
+        'resource': {type_: named for type_, named in resources.items() if named},
+        'output': {**tf.get('output', {}), **outputs}
+    }
+    leaked = references(shared) & owner.keys()
+    assert not leaked, f'The shared component refers to {sorted(leaked)}'
+    return shared, docs
+
+
+def referenced_outputs(doc: JSON) -> Set[str]:
+    """
+    >>> sorted(referenced_outputs({'a': '${data.terraform_remote_state.cellxgene.outputs.aws_vpc_cellxgene_id}'}))
+    ['aws_vpc_cellxgene_id']
+    """
+    return set(output_reference_re.findall(json.dumps(doc)))
+
+
+def digest(doc: JSON, shared_outputs: Mapping[str, Any]) -> str:
+    """
+    A digest of the configuration of a component and the values of the
+    outputs of the shared component it refers to
+    """
+    values = {name: shared_outputs.get(name) for name in sorted(referenced_outputs(doc))}
+    inputs = json.dumps([doc, values], sort_keys=True)
+    return hashlib.sha256(inputs.encode()).hexdigest()
+
+
+def write_components(terraform_dir: str, docs: Mapping[str, JSON]):
+    """
+    Write the configuration of each component into a directory of its own
+    that mirrors the `terraform/cloudfront` component. Directories of
+    components that are no longer generated are left alone, since their
+    resources need to be destroyed first.
+    """
+    root = os.path.join(terraform_dir, studies_dir)
+    links = {
+        'Makefile': '../../study.mk',
+        'backend.tf.json.template.py': '../../backend.tf.json.template.py',
+        'providers.tf.json.template.py': '../../providers.tf.json.template.py'
+    }
+    for component, doc in docs.items():
+        path = os.path.join(root, component)
+        os.makedirs(path, exist_ok=True)
+        for name, target in links.items():
+            link = os.path.join(path, name)
+            if not os.path.islink(link):
+                os.symlink(target, link)
+        tmp = os.path.join(path, 'cellxgene.tf.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(doc, f, indent=4)
+        os.replace(tmp, os.path.join(path, 'cellxgene.tf.json'))
+    for component in sorted(generated_components(terraform_dir) - docs.keys()):
+        print(f'Component {component} is no longer generated. Run `make -C {studies_dir}/{component} destroy`'
+              f' and remove the directory.')
+
+
+def generated_components(terraform_dir: str) -> Set[str]:
+    root = os.path.join(terraform_dir, studies_dir)
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return set()
+    return {name for name in names if os.path.exists(os.path.join(root, name, 'cellxgene.tf.json'))}
+
+
+def load_component(terraform_dir: str, component: str) -> JSON:
+    with open(os.path.join(terraform_dir, studies_dir, component, 'cellxgene.tf.json')) as f:
+        return json.load(f)
+
+
+def state_outputs(s3, bucket: str, component: str) -> Optional[Dict[str, Any]]:
+    """
+    The values of the outputs in the state of the given component, or None if
+    the component has no state yet
+    """
+    try:
+        response = s3.get_object(Bucket=bucket, Key=state_key(component))
+    except s3.exceptions.NoSuchKey:
+        return None
+    state = json.load(response['Body'])
+    return {name: output['value'] for name, output in state.get('outputs', {}).items()}
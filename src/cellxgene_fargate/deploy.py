@@ -0,0 +1,119 @@
+"""
+Apply the Terraform components of the studies whose inputs changed.
+
+Expects the shared component to be applied, and the components of the studies
+to be generated by it, see `cellxgene_fargate.components`. For every study
+component, the digest of its configuration and of the outputs of the shared
+component it uses is compared to the digest recorded in the component's
+state. Only the components whose digest differs are applied, several of them
+at a time. The output of each `terraform apply` is written to `apply.log` in
+the directory of the component.
+
+Usage:
+
+    python -m cellxgene_fargate.deploy [--jobs=N] [--dry-run] [--force]
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import subprocess
+import sys
+from typing import (
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+)
+
+from dataclasses import dataclass
+
+from cellxgene_fargate.components import (
+    digest,
+    generated_components,
+    load_component,
+    state_outputs,
+    studies_dir,
+)
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Component:
+    name: str
+    digest: str
+    # The digest recorded by the last successful apply, None if never applied
+    applied_digest: Optional[str]
+
+    @property
+    def changed(self) -> bool:
+        return self.digest != self.applied_digest
+
+
+def terraform_dir() -> str:
+    return os.path.join(os.environ['project_root'], 'terraform')
+
+
+def components(s3, bucket: str) -> List[Component]:
+    shared_outputs = state_outputs(s3, bucket, '')
+    assert shared_outputs is not None, 'Apply the shared component first'
+    result = []
+    for name in sorted(generated_components(terraform_dir())):
+        doc = load_component(terraform_dir(), name)
+        outputs = state_outputs(s3, bucket, name)
+        result.append(Component(name=name,
+                                digest=digest(doc, shared_outputs),
+                                applied_digest=None if outputs is None else outputs.get('digest')))
+    return result
+
+
+def apply(component: Component, env: Mapping[str, str]) -> bool:
+    path = os.path.join(terraform_dir(), studies_dir, component.name)
+    log.info('Applying %s', component.name)
+    with open(os.path.join(path, 'apply.log'), 'w') as f:
+        process = subprocess.run(['make', 'auto_apply'],
+                                 cwd=path,
+                                 stdout=f,
+                                 stderr=subprocess.STDOUT,
+                                 env={**env, 'TF_VAR_digest': component.digest, 'TF_IN_AUTOMATION': '1'})
+    if process.returncode == 0:
+        log.info('Applied %s', component.name)
+        return True
+    else:
+        log.error('Failed to apply %s, see %s', component.name, os.path.join(path, 'apply.log'))
+        return False
+
+
+def main(argv: Sequence[str]):
+    import boto3
+    from azul import config
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=8,
+                        help='The number of components to apply concurrently')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only list the components that would be applied')
+    parser.add_argument('--force', action='store_true',
+                        help='Apply every component, changed or not')
+    args = parser.parse_args(argv)
+    found = components(boto3.client('s3'), config.terraform_backend_bucket)
+    pending = [component for component in found if args.force or component.changed]
+    log.info('%i of %i study components to apply: %s',
+             len(pending), len(found), ', '.join(component.name for component in pending))
+    if args.dry_run or not pending:
+        return
+    env = dict(os.environ)
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(lambda component: apply(component, env), pending))
+    failed = [component.name for component, ok in zip(pending, results) if not ok]
+    if failed:
+        log.error('Failed to apply %s', ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
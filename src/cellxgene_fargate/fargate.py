@@ -0,0 +1,41 @@
+from typing import Optional
+
+from dataclasses import dataclass
+
+# https://aws.amazon.com/fargate/pricing/
+#
+fargate_vcpu_to_memory_in_MiB = {
+    256: [512, 1024, 2048],
+    512: [i * 1024 for i in range(1, 5)],
+    1024: [i * 1024 for i in range(2, 9)],
+    2048: [i * 1024 for i in range(4, 17)],
+    4096: [i * 1024 for i in range(8, 31)]
+}
+
+fargate_vcpu_dollars_per_hour = 0.04048
+fargate_GB_ram_dollars_per_hour = 0.004445
+
+
+@dataclass(frozen=True)
+class FargateSpec:
+    vcpu: int
+    memory_in_MiB: int
+
+    # noinspection PyPep8Naming
+    @classmethod
+    def for_required_memory(cls, memory_in_MiB: int, min_vcpu: int = 0) -> Optional['FargateSpec']:
+        """
+        Return the cheapest spec with at least the given amount of memory and
+        at least the given number of vCPU units (1/1024 of a vCPU), or None if
+        Fargate has no such spec.
+        """
+        for vcpu, mems in sorted(fargate_vcpu_to_memory_in_MiB.items()):
+            if vcpu >= min_vcpu:
+                for mem in sorted(mems):
+                    if mem >= memory_in_MiB:
+                        return cls(vcpu=vcpu, memory_in_MiB=mem)
+
+    @property
+    def cost_per_hour(self):
+        return (fargate_vcpu_dollars_per_hour * self.vcpu/1024,
+                fargate_GB_ram_dollars_per_hour * self.memory_in_MiB/1024)
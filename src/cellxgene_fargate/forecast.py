@@ -0,0 +1,393 @@
+"""
+Predict the demand for each study from its past traffic, so that it can be
+scaled out, or woken up, before the demand arrives.
+
+The traffic of many studies follows the week: business hours, courses taught
+on certain days. From a history of the number of requests per hour to each
+study, a profile of the demand in every hour of the week is built, as a high
+percentile of the number of requests in that hour over the weeks in the
+history. If the history covers too few weeks, the profile repeats the demand
+in every hour of the day instead, over all days in the history.
+
+The demand in each hour is turned into the number of replicas needed to serve
+it, with the target number of requests per replica from the study's scaling
+policy, see `cellxgene_fargate.scaling`. An hour with too few requests needs
+no replica. The result is written to a JSON file checked in with the
+deployment, since the traffic of each deployment is different. It has the
+number of replicas per hour of the week, starting on Monday at midnight UTC,
+for every study that needs more than its minimum at some point:
+
+    {
+        "studies": {
+            "2020-mar-foo": [0, 0, 0, 0, 0, 0, 0, 0, 2, 3, ...]
+        }
+    }
+
+The Terraform template turns these into scheduled actions that raise the
+minimum capacity of the study's service a little before the predicted demand
+and lower it again afterwards, see `scheduled_actions`. A sleeping study
+whose minimum capacity is raised wakes up. Its minimum capacity isn't lowered
+again by a scheduled action, as that would wake it up if it went to sleep in
+the meantime. The study keeps the raised minimum until it goes to sleep.
+
+The history is fetched from the request counts of the studies' target groups
+in CloudWatch with `--fetch`, which doesn't work when the studies are routed
+through `cellxgene_fargate.router`, since they have no target groups then. The
+history is kept in a file of its own, so that the prediction can be repeated
+and examined offline:
+
+    {
+        "studies": {
+            "2020-mar-foo": {"2020-10-12T09": 1234, ...}
+        }
+    }
+
+Usage:
+
+    python -m cellxgene_fargate.forecast --fetch --history=FILE [--weeks=N]
+    python -m cellxgene_fargate.forecast --history=FILE [--output=FILE] [--report]
+"""
+import argparse
+from collections import defaultdict
+from datetime import (
+    datetime,
+    timedelta,
+    timezone,
+)
+import json
+import logging
+import math
+import os
+import sys
+from typing import (
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+)
+
+from dataclasses import dataclass
+
+from cellxgene_fargate.scaling import (
+    ScalingPolicies,
+    ScalingPolicy,
+)
+from cellxgene_fargate.sleep import (
+    arn_suffix,
+)
+
+log = logging.getLogger(__name__)
+
+hours_per_week = 7 * 24
+
+minutes_per_week = hours_per_week * 60
+
+# The format of the hours in the history file
+hour_format = '%Y-%m-%dT%H'
+
+# Requests per hour below which a study isn't scaled ahead of time
+min_requests_per_hour = 10
+
+# The ratio of the busiest minute in an hour to the average minute
+peak_factor = 2
+
+# The percentile of the requests in the same hour over several weeks or days
+# that a study is scaled for
+demand_percentile = 90
+
+# The number of weeks of history needed for a weekly profile
+min_weeks = 3
+
+weekdays = ('MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT', 'SUN')
+
+# A study's requests per hour, by the UTC hour they were made in
+History = Mapping[str, Mapping[datetime, float]]
+
+
+def load_history(path: str) -> History:
+    with open(path) as f:
+        history = json.load(f)
+    return {
+        subdomain: {
+            datetime.strptime(hour, hour_format).replace(tzinfo=timezone.utc): count
+            for hour, count in counts.items()
+        }
+        for subdomain, counts in history['studies'].items()
+    }
+
+
+def save_history(path: str, history: History):
+    with open(path, 'w') as f:
+        json.dump({
+            'studies': {
+                subdomain: {hour.strftime(hour_format): count for hour, count in sorted(counts.items())}
+                for subdomain, counts in history.items()
+            }
+        }, f, indent=4, sort_keys=True)
+        f.write('\n')
+
+
+def hour_of_week(hour: datetime) -> int:
+    """
+    >>> hour_of_week(datetime(2020, 10, 12, 9)), hour_of_week(datetime(2020, 10, 18, 23))
+    (9, 167)
+    """
+    return hour.weekday() * 24 + hour.hour
+
+
+def percentile(values: Sequence[float], p: float) -> float:
+    """
+    >>> percentile([1, 2, 3, 4], 50), percentile([1, 2, 3, 4], 90), percentile([5], 90)
+    (2.5, 3.7, 5.0)
+    """
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    lower = math.floor(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return float(values[lower] + (values[upper] - values[lower]) * (rank - lower))
+
+
+def profile(counts: Mapping[datetime, float]) -> List[float]:
+    """
+    The predicted requests in every hour of the week. Hours without a count
+    within the history count as hours without requests.
+
+    >>> monday = datetime(2020, 10, 5, tzinfo=timezone.utc)
+    >>> counts = {monday + timedelta(weeks=w, hours=9): 100 * (w + 1) for w in range(4)}
+    >>> p = profile(counts)
+    >>> len(p), p[9], p[10], p[24 + 9]
+    (168, 370.0, 0.0, 0.0)
+
+    With less than three weeks of history, every day looks the same.
+
+    >>> p = profile({monday + timedelta(days=d, hours=9): 100 for d in range(7)})
+    >>> p[9], p[24 + 9], p[10]
+    (100.0, 100.0, 0.0)
+    """
+    if not counts:
+        return [0.0] * hours_per_week
+    start, end = min(counts), max(counts)
+    hours = int((end - start) / timedelta(hours=1)) + 1
+    weekly = hours >= min_weeks * hours_per_week
+    slots = defaultdict(list)
+    for i in range(hours):
+        hour = start + timedelta(hours=i)
+        slot = hour_of_week(hour) if weekly else hour.hour
+        slots[slot].append(counts.get(hour, 0))
+    demand = {slot: percentile(values, demand_percentile) for slot, values in slots.items()}
+    return [demand.get(slot if weekly else slot % 24, 0.0) for slot in range(hours_per_week)]
+
+
+def capacities(requests: Sequence[float], policy: ScalingPolicy) -> List[int]:
+    """
+    The number of replicas needed in every hour of the week for the given
+    requests per hour, zero for hours that need no more than the minimum
+
+    >>> policy = ScalingPolicy(min_capacity=1, max_capacity=4, requests_per_target=600)
+    >>> capacities([5, 600, 60000, 18000, 36000], policy)
+    [0, 0, 4, 0, 2]
+    """
+    result = []
+    for count in requests:
+        if count < min_requests_per_hour:
+            replicas = 0
+        else:
+            replicas = min(math.ceil(count / 60 * peak_factor / policy.requests_per_target), policy.max_capacity)
+            replicas = max(1, replicas)
+        # A study that sleeps is at zero replicas between requests
+        baseline = 0 if policy.sleeps else policy.min_capacity
+        result.append(replicas if replicas > baseline else 0)
+    return result
+
+
+def forecast(history: History, policies: ScalingPolicies) -> Dict[str, List[int]]:
+    """
+    The replicas needed in every hour of the week by each study that needs
+    more than its minimum at some point
+    """
+    schedules = {}
+    for subdomain, counts in sorted(history.items()):
+        schedule = capacities(profile(counts), policies[subdomain])
+        if any(schedule):
+            schedules[subdomain] = schedule
+    return schedules
+
+
+@dataclass(frozen=True)
+class ScheduledAction:
+    # Minutes since Monday midnight UTC
+    minute_of_week: int
+    min_capacity: int
+    max_capacity: int
+
+    @property
+    def schedule(self) -> str:
+        """
+        >>> ScheduledAction(24 * 60 + 9 * 60 + 55, 2, 4).schedule
+        'cron(55 9 ? * TUE *)'
+        """
+        day, minute_of_day = divmod(self.minute_of_week, 24 * 60)
+        hour, minute = divmod(minute_of_day, 60)
+        return f'cron({minute} {hour} ? * {weekdays[day]} *)'
+
+
+def scheduled_actions(schedule: Sequence[int],
+                      policy: ScalingPolicy,
+                      lead_minutes: int) -> List[ScheduledAction]:
+    """
+    The actions that set the minimum capacity of a study to the number of
+    replicas scheduled for each hour of the week. Raising the minimum happens
+    the given number of minutes ahead. Lowering it happens at the end of the
+    hour, except for studies that sleep.
+
+    >>> policy = ScalingPolicy(min_capacity=1, max_capacity=4)
+    >>> schedule = [0] * 168
+    >>> schedule[9:12] = [2, 3, 3]
+    >>> [(a.schedule, a.min_capacity) for a in scheduled_actions(schedule, policy, 10)]
+    [('cron(50 8 ? * MON *)', 2), ('cron(50 9 ? * MON *)', 3), ('cron(0 12 ? * MON *)', 1)]
+
+    >>> policy = ScalingPolicy(min_capacity=1, max_capacity=4, sleep_after_minutes=30)
+    >>> [(a.schedule, a.min_capacity) for a in scheduled_actions(schedule, policy, 10)]
+    [('cron(50 8 ? * MON *)', 2), ('cron(50 9 ? * MON *)', 3)]
+    """
+    assert len(schedule) == hours_per_week, len(schedule)
+    actions = []
+    for hour in range(hours_per_week):
+        previous, current = schedule[hour - 1], schedule[hour]
+        if current == previous:
+            continue
+        min_capacity = max(current, policy.min_capacity)
+        if current > previous:
+            minute = hour * 60 - lead_minutes
+        elif policy.sleeps:
+            continue
+        else:
+            minute = hour * 60
+        actions.append(ScheduledAction(minute_of_week=minute % minutes_per_week,
+                                       min_capacity=min_capacity,
+                                       max_capacity=max(min_capacity, policy.max_capacity)))
+    return sorted(actions, key=lambda action: action.minute_of_week)
+
+
+def schedules_path() -> str:
+    return os.environ['CELLXGENE_SCHEDULES']
+
+
+def load_schedules(path: Optional[str] = None) -> Dict[str, List[int]]:
+    if path is None:
+        path = schedules_path()
+    try:
+        with open(path) as f:
+            return json.load(f)['studies']
+    except FileNotFoundError:
+        return {}
+
+
+def save_schedules(path: str, schedules: Mapping[str, Sequence[int]]):
+    with open(path, 'w') as f:
+        f.write('{\n    "studies": {')
+        f.write(','.join(
+            f'\n        {json.dumps(subdomain)}: {json.dumps(list(schedule))}'
+            for subdomain, schedule in sorted(schedules.items())
+        ))
+        f.write('\n    }\n}\n')
+
+
+def fetch_history(cloudwatch, elbv2, weeks: int, now: datetime) -> History:
+    """
+    The requests per hour to every study with a target group, from the
+    metrics of the load balancer. The target groups are named by their tags.
+    """
+    load_balancer = elbv2.describe_load_balancers(Names=['cellxgene'])['LoadBalancers'][0]
+    target_groups = [
+        target_group
+        for page in elbv2.get_paginator('describe_target_groups').paginate(
+            LoadBalancerArn=load_balancer['LoadBalancerArn'])
+        for target_group in page['TargetGroups']
+    ]
+    subdomains = {}
+    arns = [target_group['TargetGroupArn'] for target_group in target_groups]
+    for i in range(0, len(arns), 20):
+        for description in elbv2.describe_tags(ResourceArns=arns[i:i + 20])['TagDescriptions']:
+            tags = {tag['Key']: tag['Value'] for tag in description['Tags']}
+            subdomains[description['ResourceArn']] = tags.get('Name')
+    end = now.replace(minute=0, second=0, microsecond=0)
+    start = end - timedelta(weeks=weeks)
+    history = {}
+    for target_group in target_groups:
+        subdomain = subdomains.get(target_group['TargetGroupArn'])
+        if subdomain is None or subdomain.startswith('cellxgene-'):
+            # The waker and the router aren't studies
+            continue
+        counts = defaultdict(float)
+        # At most 1440 data points per request
+        for chunk_start in range(0, weeks * hours_per_week, 1440):
+            chunk_end = min(chunk_start + 1440, weeks * hours_per_week)
+            response = cloudwatch.get_metric_statistics(
+                Namespace='AWS/ApplicationELB',
+                MetricName='RequestCount',
+                Dimensions=[
+                    {'Name': 'LoadBalancer', 'Value': arn_suffix(load_balancer['LoadBalancerArn'])},
+                    {'Name': 'TargetGroup', 'Value': arn_suffix(target_group['TargetGroupArn'])}
+                ],
+                StartTime=start + timedelta(hours=chunk_start),
+                EndTime=start + timedelta(hours=chunk_end),
+                Period=3600,
+                Statistics=['Sum'])
+            for datapoint in response['Datapoints']:
+                hour = datapoint['Timestamp'].astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+                counts[hour] += datapoint['Sum']
+        # Marks the extent of the history even for hours without requests
+        counts[start] += 0
+        counts[end - timedelta(hours=1)] += 0
+        history[subdomain] = dict(counts)
+    return history
+
+
+def report(schedules: Mapping[str, Sequence[int]]):
+    print(f"{'study':<32} {'peak':>4}  busiest hours (UTC)")
+    for subdomain, schedule in sorted(schedules.items()):
+        peak = max(schedule)
+        hours = [
+            f'{weekdays[hour // 24]} {hour % 24:02d}:00'
+            for hour, replicas in enumerate(schedule) if replicas == peak
+        ]
+        print(f"{subdomain:<32} {peak:>4}  {', '.join(hours[:6])}{' ...' if len(hours) > 6 else ''}")
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--history', required=True,
+                        help='The file with the requests per hour to each study')
+    parser.add_argument('--fetch', action='store_true',
+                        help='Fetch the history from CloudWatch and write it to the history file')
+    parser.add_argument('--weeks', type=int, default=6,
+                        help='The number of weeks of history to fetch')
+    parser.add_argument('--output',
+                        help='The file to write the schedules to, typically the one configured in '
+                             'CELLXGENE_SCHEDULES')
+    parser.add_argument('--report', action='store_true',
+                        help='Print the peak of each schedule')
+    args = parser.parse_args(argv)
+    if args.fetch:
+        import boto3
+        history = fetch_history(boto3.client('cloudwatch'),
+                                boto3.client('elbv2'),
+                                weeks=args.weeks,
+                                now=datetime.now(timezone.utc))
+        save_history(args.history, history)
+        log.info('Fetched %i weeks of history for %i studies', args.weeks, len(history))
+    else:
+        schedules = forecast(load_history(args.history), ScalingPolicies.load())
+        if args.output:
+            save_schedules(args.output, schedules)
+        if args.report or not args.output:
+            report(schedules)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,284 @@
+"""
+Inspect the structure of remote `.h5ad` files without downloading them.
+
+The HDF5 library is handed a file-like object that satisfies reads with ranged
+GET requests against S3, so only the superblock, the object headers and the
+B-tree nodes needed to answer the questions below are fetched, typically a few
+MiB out of several GiB. The results are cached in a JSON file next to the
+manifest, keyed by object key and ETag. Inspect all files in the manifest that
+are missing from the cache with
+
+    python -m cellxgene_fargate.h5ad
+"""
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import logging
+import os
+import sys
+from typing import (
+    Dict,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import boto3
+import botocore.config
+from dataclasses import (
+    asdict,
+    dataclass,
+)
+import h5py
+import numpy
+
+from cellxgene_fargate.manifest import (
+    Manifest,
+    manifest_path,
+)
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class MatrixInfo:
+    n_obs: int
+    n_vars: int
+    # The number of stored elements of X. For a dense X this is the product of
+    # n_obs and n_vars.
+    nnz: int
+    x_dtype: str
+    # One of 'dense', 'csr_matrix' or 'csc_matrix'
+    x_encoding: str
+    layers: Tuple[str, ...]
+    embeddings: Tuple[str, ...]
+    has_raw: bool
+
+    @property
+    def x_itemsize(self) -> int:
+        return numpy.dtype(self.x_dtype).itemsize
+
+    @property
+    def density(self) -> float:
+        return self.nnz / (self.n_obs * self.n_vars) if self.n_obs and self.n_vars else 0.0
+
+    @classmethod
+    def from_json(cls, info: Mapping) -> 'MatrixInfo':
+        return cls(**{
+            **info,
+            'layers': tuple(info['layers']),
+            'embeddings': tuple(info['embeddings'])
+        })
+
+
+class RangeFile(io.RawIOBase):
+    """
+    A read-only, seekable file object backed by ranged GET requests against an
+    S3 object. Reads are rounded up to whole blocks which are kept in a small
+    LRU cache because HDF5 tends to read the same metadata blocks repeatedly.
+    """
+
+    def __init__(self,
+                 s3,
+                 bucket: str,
+                 key: str,
+                 size: int,
+                 etag: str,
+                 block_size: int = 256 * 1024,
+                 max_blocks: int = 64):
+        super().__init__()
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+        self.position = 0
+        self.bytes_fetched = 0
+        self.requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(whence)
+        return self.position
+
+    def _block(self, index: int) -> bytes:
+        try:
+            block = self.blocks.pop(index)
+        except KeyError:
+            start = index * self.block_size
+            end = min(start + self.block_size, self.size) - 1
+            response = self.s3.get_object(Bucket=self.bucket,
+                                          Key=self.key,
+                                          Range=f'bytes={start}-{end}',
+                                          IfMatch=self.etag)
+            block = response['Body'].read()
+            self.bytes_fetched += len(block)
+            self.requests += 1
+            if len(self.blocks) >= self.max_blocks:
+                self.blocks.popitem(last=False)
+        self.blocks[index] = block
+        return block
+
+    def readinto(self, buffer):
+        buffer = memoryview(buffer).cast('B')
+        n = min(len(buffer), max(0, self.size - self.position))
+        written = 0
+        while written < n:
+            index, offset = divmod(self.position, self.block_size)
+            block = self._block(index)
+            chunk = block[offset:offset + n - written]
+            buffer[written:written + len(chunk)] = chunk
+            written += len(chunk)
+            self.position += len(chunk)
+        return written
+
+
+def inspect(f: h5py.File) -> MatrixInfo:
+    """
+    Extract a MatrixInfo from an open `.h5ad` file, touching only metadata.
+    Both the pre-0.7 AnnData layout, with sparse matrices marked by an
+    `h5sparse_format` attribute and `obsm` as a compound dataset, and the
+    current one are supported.
+    """
+    x = f['X']
+    if isinstance(x, h5py.Dataset):
+        n_obs, n_vars = x.shape
+        nnz = n_obs * n_vars
+        x_dtype = x.dtype
+        x_encoding = 'dense'
+    else:
+        attrs = x.attrs
+        if 'encoding-type' in attrs:
+            x_encoding = _str(attrs['encoding-type'])
+            n_obs, n_vars = attrs['shape']
+        else:
+            x_encoding = _str(attrs['h5sparse_format']) + '_matrix'
+            n_obs, n_vars = attrs['h5sparse_shape']
+        nnz = x['data'].shape[0]
+        x_dtype = x['data'].dtype
+    layers = tuple(f['layers'].keys()) if 'layers' in f else ()
+    if 'obsm' in f:
+        obsm = f['obsm']
+        if isinstance(obsm, h5py.Group):
+            embeddings = tuple(obsm.keys())
+        else:
+            embeddings = tuple(obsm.dtype.names or ())
+    else:
+        embeddings = ()
+    return MatrixInfo(n_obs=int(n_obs),
+                      n_vars=int(n_vars),
+                      nnz=int(nnz),
+                      x_dtype=str(x_dtype),
+                      x_encoding=x_encoding,
+                      layers=layers,
+                      embeddings=embeddings,
+                      has_raw='raw' in f or 'raw.X' in f)
+
+
+def _str(value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def inspect_object(s3, bucket: str, key: str, size: int, etag: str) -> MatrixInfo:
+    with RangeFile(s3, bucket, key, size, etag) as range_file:
+        with h5py.File(range_file, 'r') as f:
+            info = inspect(f)
+        log.info('Inspected s3://%s/%s with %i requests for %i of %i bytes',
+                 bucket, key, range_file.requests, range_file.bytes_fetched, size)
+    return info
+
+
+def info_path(manifest_path: str) -> str:
+    """
+    >>> info_path('/foo/2020-mar.json')
+    '/foo/2020-mar.h5ad.json'
+    """
+    return os.path.splitext(manifest_path)[0] + '.h5ad.json'
+
+
+def load_info(manifest: Manifest, path: Optional[str] = None) -> Dict[str, MatrixInfo]:
+    """
+    Return the cached information for every file in the given manifest whose
+    cache entry is current.
+    """
+    if path is None:
+        path = info_path(manifest_path())
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        cache = {}
+    return {
+        entry.key: MatrixInfo.from_json(cache[entry.key]['info'])
+        for entry in manifest.entries
+        if entry.key in cache and cache[entry.key]['etag'] == entry.etag
+    }
+
+
+def refresh_info(s3, manifest: Manifest, path: str, concurrency: int) -> int:
+    """
+    Inspect the files in the given manifest that are missing from the cache
+    or whose cache entry is stale and return the number of files inspected.
+    """
+    current = load_info(manifest, path)
+    missing = [entry for entry in manifest.entries if entry.key not in current]
+
+    def inspect_entry(entry):
+        return inspect_object(s3, manifest.bucket, entry.key, entry.size, entry.etag)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        current.update(zip((entry.key for entry in missing), executor.map(inspect_entry, missing)))
+    etags = {entry.key: entry.etag for entry in manifest.entries}
+    cache = {
+        key: {'etag': etags[key], 'info': asdict(info)}
+        for key, info in sorted(current.items())
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=4)
+        f.write('\n')
+    os.rename(tmp_path, path)
+    return len(missing)
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--manifest', default=None,
+                        help='The manifest file. Defaults to the value of CELLXGENE_MANIFEST.')
+    parser.add_argument('--endpoint-url')
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args(argv)
+    path = manifest_path() if args.manifest is None else args.manifest
+    s3 = boto3.client('s3',
+                      endpoint_url=args.endpoint_url,
+                      config=botocore.config.Config(max_pool_connections=args.concurrency))
+    inspected = refresh_info(s3, Manifest.load(path), info_path(path), args.concurrency)
+    print(f'Inspected {inspected} files')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,290 @@
+"""
+Measure what the cellxgene image costs a container on every cold start, before
+the matrix is even loaded.
+
+For the given image, the following is recorded as one JSON object per line in
+the output file, together with the cellxgene version in the image, so that the
+output files of two releases can be compared with `--compare`:
+
+- the size of the image, uncompressed, as reported by Docker,
+
+- the number of bytes Fargate pulls for it, the sum of the sizes of its layers
+  compressed with gzip, the way a registry serves them,
+
+- the time spent importing modules while `cellxgene launch` starts up, and the
+  packages that take longest to import, as reported by `python -X importtime`,
+
+- the time from `docker run` to the first 200 OK on `/`, serving a tiny
+  synthetic matrix with the arguments the task definitions use.
+
+Python 3.6 doesn't support `-X importtime`, so on that version the import
+machinery is instrumented to produce the same report.
+
+Usage:
+
+    python -m cellxgene_fargate.image_benchmark --image=IMAGE:TAG --output=results.jsonl
+    python -m cellxgene_fargate.image_benchmark --compare old.jsonl new.jsonl
+"""
+import argparse
+from collections import defaultdict
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from typing import (
+    Dict,
+    Iterable,
+    Sequence,
+    Tuple,
+)
+import uuid
+import zlib
+
+from dataclasses import (
+    asdict,
+    dataclass,
+)
+
+from cellxgene_fargate.benchmark import (
+    Synthetic,
+    free_port,
+    load_measurements,
+    wait_for_200,
+)
+from cellxgene_fargate.launch import (
+    launch_args,
+)
+
+log = logging.getLogger(__name__)
+
+# The matrix served while measuring the startup time. Small enough for loading
+# it to not matter.
+synthetic = Synthetic(n_obs=1000, n_vars=2000, density=0.1, x_dtype='float32', n_embeddings=2)
+
+# The port cellxgene listens on inside the container
+container_port = 5005
+
+# Installs a replacement for `-X importtime` on Python 3.6. The interpreter
+# looks up `_find_and_load` on the frozen importlib for every module that
+# isn't imported yet.
+import_timer = r'''
+import sys
+if sys.version_info < (3, 7):
+    import _frozen_importlib, time
+    _find_and_load = _frozen_importlib._find_and_load
+    _children = [0.0]
+    def _timed_find_and_load(name, import_):
+        _children.append(0.0)
+        start = time.perf_counter()
+        try:
+            return _find_and_load(name, import_)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = _children.pop()
+            _children[-1] += elapsed
+            sys.stderr.write('import time: %9d | %10d | %s%s\n' % ((elapsed - children) * 1e6,
+                                                                  elapsed * 1e6,
+                                                                  '  ' * (len(_children) - 1),
+                                                                  name))
+    _frozen_importlib._find_and_load = _timed_find_and_load
+'''
+
+# Runs the `cellxgene` console script with the arguments in sys.argv
+run_cellxgene = r'''
+import runpy, shutil
+runpy.run_path(shutil.which('cellxgene'), run_name='__main__')
+'''
+
+import_time_re = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+
+@dataclass(frozen=True)
+class ImageMeasurement:
+    image: str
+    cellxgene_version: str
+    # The uncompressed size of the image
+    image_bytes: int
+    # The compressed size of the image's layers, roughly what is pulled
+    layer_bytes: int
+    layers: int
+    # The total time spent importing modules
+    import_seconds: float
+    # The top-level packages that took longest to import, including the
+    # modules they imported, in seconds
+    slowest_imports: Dict[str, float]
+    # The number of seconds from `docker run` to the first 200 OK on `/`
+    startup_seconds: float
+
+
+def docker(*args: str) -> str:
+    return subprocess.run(['docker', *args],
+                          stdout=subprocess.PIPE,
+                          check=True).stdout.decode()
+
+
+def image_cellxgene_version(image: str) -> str:
+    return docker('run', '--rm', image, '--version').split()[-1]
+
+
+def image_bytes(image: str) -> int:
+    return int(docker('image', 'inspect', '--format', '{{.Size}}', image))
+
+
+def compressed_size(f) -> int:
+    """
+    The size of the given stream when compressed like a layer pushed to a
+    registry, or its size as is if it is compressed already
+    """
+    chunk = f.read(1024 * 1024)
+    if chunk[:2] == b'\x1f\x8b':
+        size = len(chunk)
+        while chunk:
+            chunk = f.read(1024 * 1024)
+            size += len(chunk)
+        return size
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    size = 0
+    while chunk:
+        size += len(compressor.compress(chunk))
+        chunk = f.read(1024 * 1024)
+    return size + len(compressor.flush())
+
+
+def layer_bytes(image: str) -> Tuple[int, int]:
+    """
+    The number of layers of the given image and their total compressed size
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'image.tar')
+        subprocess.run(['docker', 'save', '--output', path, image], check=True)
+        with tarfile.open(path) as tar:
+            manifest = json.load(tar.extractfile('manifest.json'))
+            layers = manifest[0]['Layers']
+            return len(layers), sum(compressed_size(tar.extractfile(layer)) for layer in layers)
+
+
+def parse_import_times(lines: Iterable[str]) -> Tuple[float, Dict[str, float]]:
+    """
+    The total import time in seconds and the cumulative import time of each
+    top-level package from the output of `python -X importtime`
+
+    >>> parse_import_times([
+    ...     'import time: self [us] | cumulative | imported package',
+    ...     'import time:       100 |        100 |   numpy.core',
+    ...     'import time:       200 |        300 | numpy',
+    ...     'import time:       500 |        500 | numpy.linalg',
+    ...     'Serving on port 5005'
+    ... ])
+    (0.0008, {'numpy': 0.0008})
+    """
+    total = 0
+    packages = defaultdict(int)
+    for line in lines:
+        match = import_time_re.match(line.rstrip('\n'))
+        if match is not None:
+            self_us, cumulative_us, indent, name = match.groups()
+            total += int(self_us)
+            if not indent:
+                packages[name.split('.')[0]] += int(cumulative_us)
+    return total / 1e6, {package: us / 1e6 for package, us in packages.items()}
+
+
+def measure_startup(image: str, workdir: str, timeout: float) -> Tuple[float, float, Dict[str, float]]:
+    """
+    Launch cellxgene in a container of the given image on the synthetic matrix
+    in the given directory. Returns the startup time and the import times.
+    """
+    port = free_port()
+    name = 'cellxgene-benchmark-' + uuid.uuid4().hex[:8]
+    args = launch_args('benchmark', '/data/' + synthetic.name, container_port)
+    with tempfile.TemporaryFile(mode='w+') as stderr:
+        start = time.monotonic()
+        process = subprocess.Popen(['docker', 'run', '--rm', '--name', name,
+                                    '--publish', f'127.0.0.1:{port}:{container_port}',
+                                    '--volume', f'{os.path.abspath(workdir)}:/data:ro',
+                                    '--entrypoint', 'python',
+                                    image,
+                                    '-X', 'importtime',
+                                    '-c', import_timer + run_cellxgene,
+                                    *args],
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=stderr)
+        try:
+            ready = wait_for_200(f'http://127.0.0.1:{port}/', process, timeout)
+        finally:
+            if process.poll() is None:
+                subprocess.run(['docker', 'stop', '--time', '1', name], stdout=subprocess.DEVNULL)
+                process.wait()
+        stderr.seek(0)
+        import_seconds, packages = parse_import_times(stderr)
+    return ready - start, import_seconds, packages
+
+
+def measure(image: str, workdir: str, timeout: float, top: int) -> ImageMeasurement:
+    layers, compressed = layer_bytes(image)
+    startup_seconds, import_seconds, packages = measure_startup(image, workdir, timeout)
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return ImageMeasurement(image=image,
+                            cellxgene_version=image_cellxgene_version(image),
+                            image_bytes=image_bytes(image),
+                            layer_bytes=compressed,
+                            layers=layers,
+                            import_seconds=import_seconds,
+                            slowest_imports=dict(slowest),
+                            startup_seconds=startup_seconds)
+
+
+def compare(old_path: str, new_path: str):
+    """
+    Print the mean of each metric in two result files and its relative change
+    """
+    metrics = ('image_bytes', 'layer_bytes', 'import_seconds', 'startup_seconds')
+
+    def means(path):
+        measurements = load_measurements(path)
+        return {m: sum(r[m] for r in measurements) / len(measurements) for m in metrics}
+
+    old, new = means(old_path), means(new_path)
+    for m in metrics:
+        print(f'{m:<16} {old[m]:>14.2f} -> {new[m]:>14.2f} ({(new[m] / old[m] - 1) * 100:+.0f}%)')
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--image', help='The image to measure, as NAME:TAG')
+    parser.add_argument('--output', help='The file to append the results to')
+    parser.add_argument('--workdir', default='.benchmark',
+                        help='The directory for the synthetic matrix file')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=10,
+                        help='The number of slowest top-level imports to record')
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.image is None or args.output is None:
+        parser.error('--image and --output are required unless --compare is given')
+    os.makedirs(args.workdir, exist_ok=True)
+    path = os.path.join(args.workdir, synthetic.name)
+    if not os.path.exists(path):
+        log.info('Generating %s', path)
+        synthetic.generate(path)
+    for _ in range(args.repeat):
+        measurement = measure(args.image, args.workdir, args.timeout, args.top)
+        log.info('Measured %r', measurement)
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(asdict(measurement)) + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
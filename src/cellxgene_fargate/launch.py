@@ -0,0 +1,87 @@
+import os
+from typing import (
+    List,
+)
+
+# The number of threads per gunicorn worker process
+serve_threads = 4
+
+# The path of the endpoint of `cellxgene_fargate.serve` that responds once
+# the matrix is loaded, for the health checks of the load balancer
+readiness_path = '/ready'
+
+# The memory reserved in each task for the caching proxy, including its
+# in-memory cache
+cache_proxy_memory_in_MiB = 256
+cache_proxy_memory_cache_size = 64 * 1024 * 1024
+cache_proxy_disk_cache_size = 2 * 1024 * 1024 * 1024
+
+
+def launch_args(title: str, path: str, port: int) -> List[str]:
+    """
+    The arguments to `cellxgene` for serving the matrix at the given path the
+    way it is served in production.
+    """
+    return [
+        "launch",
+        "--verbose",
+        "--backed",
+        "--disable-diffexp",
+        "--disable-annotations",
+        "--title=" + title,
+        path,
+        "--host=0.0.0.0",
+        f"--port={port}"
+    ]
+
+
+def serve_workers(vcpu: int) -> int:
+    """
+    The number of gunicorn worker processes for a task with the given number
+    of vCPU units (1/1024 of a vCPU). Requests spend much of their time in
+    numpy and h5py, which release the GIL, so two workers per vCPU keep the
+    CPUs busy.
+
+    >>> [serve_workers(vcpu) for vcpu in (256, 512, 1024, 2048, 4096)]
+    [1, 1, 2, 4, 8]
+    """
+    return max(1, 2 * vcpu // 1024)
+
+
+def serve_args(title: str, path: str, port: int, vcpu: int) -> List[str]:
+    """
+    The arguments to `python` for serving the matrix at the given path with
+    `cellxgene_fargate.serve` in a task with the given number of vCPU units.
+    """
+    return [
+        "-m",
+        "cellxgene_fargate.serve",
+        "--title=" + title,
+        "--host=0.0.0.0",
+        f"--port={port}",
+        f"--workers={serve_workers(vcpu)}",
+        f"--threads={serve_threads}",
+        path
+    ]
+
+
+def cache_proxy_enabled() -> bool:
+    return bool(int(os.environ['CELLXGENE_CACHE_PROXY']))
+
+
+def cache_proxy_args(port: int, backend_port: int, digest: str, cache_dir: str) -> List[str]:
+    """
+    The arguments to `python` for running `cellxgene_fargate.cache_proxy` in
+    front of a cellxgene server listening on the given backend port.
+    """
+    return [
+        "-m",
+        "cellxgene_fargate.cache_proxy",
+        "--host=0.0.0.0",
+        f"--port={port}",
+        f"--backend=http://127.0.0.1:{backend_port}",
+        f"--digest={digest}",
+        f"--cache-dir={cache_dir}",
+        f"--memory-cache-size={cache_proxy_memory_cache_size}",
+        f"--disk-cache-size={cache_proxy_disk_cache_size}"
+    ]
@@ -0,0 +1,420 @@
+"""
+Put a study under the load of many users browsing it at once.
+
+Each simulated user replays the requests a browser makes in a cellxgene
+session: the page, the configuration and the schema, the cell annotations and
+all layouts, concurrently as the browser does, then a number of bursts of
+expression fetches for random genes, with a pause between bursts for the user
+to look at the result. A user starts a new session as soon as the previous one
+ends. The users are started at an even pace over the ramp-up period and run
+until the end of the test. All users share a pool of connections, like a
+proxy in front of many browsers would.
+
+The genes are drawn from the names of all genes in the study, which are
+decoded with cellxgene's own code, so cellxgene must be installed. Otherwise,
+they can be passed with `--genes`.
+
+The target is either a URL, typically that of a local container, or the
+subdomain of a deployed study. The throughput, the number of errors and the
+50th, 90th, 95th and 99th percentile of the latency of the requests, overall
+and per endpoint, are recorded as one JSON object per line in the output file,
+with the cellxgene version reported by the study and a label naming what is
+being tested, the Fargate size of the study, for example. The output files of
+two runs can be compared with `--compare`. With `--vcpu` and `--memory`, the
+size of the task serving the study is recorded as well. Results of one replica
+of each size under an increasing number of users are the throughput curves
+`cellxgene_fargate.planning` chooses the size of the studies with.
+
+Usage:
+
+    python -m cellxgene_fargate.loadtest (--url=URL | --study=SUBDOMAIN) --output=results.jsonl \
+        [--users=N] [--ramp=SECONDS] [--duration=SECONDS] [--label=LABEL]
+    python -m cellxgene_fargate.loadtest --compare old.jsonl new.jsonl
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from typing import (
+    Any,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+)
+from urllib.parse import (
+    urlsplit,
+)
+
+import aiohttp
+from dataclasses import (
+    asdict,
+    dataclass,
+    field,
+)
+
+from cellxgene_fargate.benchmark import (
+    load_measurements,
+)
+from cellxgene_fargate.request_metrics import (
+    endpoint,
+    percentile,
+)
+
+log = logging.getLogger(__name__)
+
+api_prefix = '/api/v0.2/'
+
+# The number of concurrent connections a browser opens to a host
+browser_connections = 6
+
+JSON = Dict[str, Any]
+
+
+@dataclass
+class Sample:
+    endpoint: str
+    status: int
+    bytes: int
+    latency_ms: float
+
+
+@dataclass
+class Recorder:
+    samples: List[Sample] = field(default_factory=list)
+    sessions: int = 0
+
+    async def request(self,
+                      client: aiohttp.ClientSession,
+                      method: str,
+                      url: str,
+                      **kwargs) -> Optional[bytes]:
+        """
+        Make the given request and record its outcome. Returns the body of
+        the response if it succeeded.
+        """
+        start = time.monotonic()
+        try:
+            async with client.request(method, url, **kwargs) as response:
+                body = await response.read()
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.debug('%s %s failed: %r', method, url, e)
+            body, status = b'', 0
+        latency_ms = (time.monotonic() - start) * 1000
+        self.samples.append(Sample(endpoint=endpoint(urlsplit(url).path),
+                                   status=status,
+                                   bytes=len(body),
+                                   latency_ms=latency_ms))
+        return body if 200 <= status < 300 else None
+
+
+@dataclass(frozen=True)
+class Scenario:
+    # The number of bursts of expression fetches per session
+    bursts: int = 5
+    # The number of genes fetched in each burst
+    genes_per_burst: int = 10
+    # The mean number of seconds between bursts
+    think_seconds: float = 5.0
+
+
+@dataclass(frozen=True)
+class Study:
+    """
+    What a session needs to know about the study to make its requests
+    """
+    url: str
+    schema: JSON
+    genes: Sequence[str]
+
+    @property
+    def obs_annotations(self) -> List[str]:
+        return [column['name'] for column in self.schema['annotations']['obs']['columns']]
+
+    @property
+    def var_index(self) -> str:
+        return self.schema['annotations']['var']['index']
+
+
+def api_url(url: str, path: str) -> str:
+    """
+    >>> api_url('http://localhost:5005/', 'schema')
+    'http://localhost:5005/api/v0.2/schema'
+    """
+    return url.rstrip('/') + api_prefix + path
+
+
+def var_filter(study: Study, gene: str) -> JSON:
+    """
+    The body of the request for the expression of the given gene
+
+    >>> var_filter(Study(url='', schema={'annotations': {'var': {'index': 'name_0'}}}, genes=[]), 'CD4')
+    {'filter': {'var': {'annotation_value': [{'name': 'name_0', 'values': ['CD4']}]}}}
+    """
+    return {'filter': {'var': {'annotation_value': [{'name': study.var_index, 'values': [gene]}]}}}
+
+
+async def gather_limited(coroutines, limit: int):
+    """
+    Await the given coroutines, at most the given number at a time
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def limited(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*map(limited, coroutines))
+
+
+async def session(client: aiohttp.ClientSession,
+                  recorder: Recorder,
+                  study: Study,
+                  scenario: Scenario,
+                  rng: random.Random,
+                  deadline: float):
+    """
+    Replay the requests of a browser session, until its end or the deadline
+    """
+    await recorder.request(client, 'GET', study.url)
+    await gather_limited([
+        recorder.request(client, 'GET', api_url(study.url, 'config')),
+        recorder.request(client, 'GET', api_url(study.url, 'schema'))
+    ], browser_connections)
+    await gather_limited([
+        *(
+            recorder.request(client, 'GET', api_url(study.url, 'annotations/obs'),
+                             params={'annotation-name': name})
+            for name in study.obs_annotations
+        ),
+        # cellxgene 0.15 ignores the `layout-name` parameter and returns all
+        # layouts at once, so the browser fetches them only once.
+        recorder.request(client, 'GET', api_url(study.url, 'layout/obs'))
+    ], browser_connections)
+    for _ in range(scenario.bursts):
+        if time.monotonic() >= deadline:
+            return
+        await asyncio.sleep(min(rng.expovariate(1 / scenario.think_seconds),
+                                max(0.0, deadline - time.monotonic())))
+        genes = rng.sample(study.genes, min(scenario.genes_per_burst, len(study.genes)))
+        await gather_limited([
+            recorder.request(client, 'PUT', api_url(study.url, 'data/var'),
+                             json=var_filter(study, gene),
+                             headers={'Accept': 'application/octet-stream'})
+            for gene in genes
+        ], browser_connections)
+    recorder.sessions += 1
+
+
+async def user(client: aiohttp.ClientSession,
+               recorder: Recorder,
+               study: Study,
+               scenario: Scenario,
+               rng: random.Random,
+               delay: float,
+               deadline: float):
+    await asyncio.sleep(delay)
+    while time.monotonic() < deadline:
+        await session(client, recorder, study, scenario, rng, deadline)
+
+
+async def fetch_study(client: aiohttp.ClientSession, url: str, genes: Optional[Sequence[str]]) -> Study:
+    async with client.get(api_url(url, 'schema')) as response:
+        response.raise_for_status()
+        schema = (await response.json())['schema']
+    if genes is None:
+        index = schema['annotations']['var']['index']
+        async with client.get(api_url(url, 'annotations/var'), params={'annotation-name': index}) as response:
+            response.raise_for_status()
+            genes = decode_genes(await response.read(), index)
+    return Study(url=url, schema=schema, genes=list(genes))
+
+
+async def fetch_version(client: aiohttp.ClientSession, url: str) -> Optional[str]:
+    async with client.get(api_url(url, 'config')) as response:
+        response.raise_for_status()
+        config = (await response.json())['config']
+    return config.get('library_versions', {}).get('cellxgene')
+
+
+def decode_genes(body: bytes, index: str) -> List[str]:
+    """
+    The gene names in the given response to a request for a var annotation
+    """
+    from server.common.fbs.matrix import (
+        decode_matrix_fbs,
+    )
+    return list(map(str, decode_matrix_fbs(body)[index]))
+
+
+@dataclass(frozen=True)
+class LoadTest:
+    url: str
+    users: int
+    ramp_seconds: float
+    duration_seconds: float
+    connections: int
+    scenario: Scenario
+    genes: Optional[Sequence[str]] = None
+    seed: int = 42
+
+    async def run(self) -> Mapping[str, Any]:
+        connector = aiohttp.TCPConnector(limit=self.connections)
+        timeout = aiohttp.ClientTimeout(total=300)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as client:
+            version = await fetch_version(client, self.url)
+            study = await fetch_study(client, self.url, self.genes)
+            log.info('Replaying sessions of %i users against %s, a study with %i genes',
+                     self.users, self.url, len(study.genes))
+            recorder = Recorder()
+            rng = random.Random(self.seed)
+            start = time.monotonic()
+            deadline = start + self.duration_seconds
+            await asyncio.gather(*(
+                user(client,
+                     recorder,
+                     study,
+                     self.scenario,
+                     random.Random(rng.random()),
+                     delay=i * self.ramp_seconds / self.users,
+                     deadline=deadline)
+                for i in range(self.users)
+            ))
+            elapsed = time.monotonic() - start
+        return {
+            'cellxgene_version': version,
+            'url': self.url,
+            'users': self.users,
+            'ramp_seconds': self.ramp_seconds,
+            'duration_seconds': self.duration_seconds,
+            'connections': self.connections,
+            **asdict(self.scenario),
+            'sessions': recorder.sessions,
+            **summarize(recorder.samples, elapsed)
+        }
+
+
+def summarize(samples: Sequence[Sample], elapsed: float) -> JSON:
+    """
+    The throughput and latency of the given requests, overall and by endpoint
+
+    >>> s = summarize([Sample('/api/v0.2/schema', 200, 10, 5.0), Sample('/api/v0.2/data/var', 500, 0, 15.0)], 2.0)
+    >>> s['requests'], s['errors'], s['requests_per_second'], s['p50_ms'], s['endpoints']['/api/v0.2/schema']['p99_ms']
+    (2, 1, 1.0, 5.0, 5.0)
+    """
+
+    def stats(samples_: Sequence[Sample]) -> JSON:
+        latencies = sorted(s.latency_ms for s in samples_)
+        return {
+            'requests': len(samples_),
+            'errors': sum(not 200 <= s.status < 300 for s in samples_),
+            'bytes': sum(s.bytes for s in samples_),
+            'requests_per_second': len(samples_) / elapsed,
+            **{f'p{q}_ms': percentile(latencies, q) if latencies else None for q in (50, 90, 95, 99)}
+        }
+
+    by_endpoint = {}
+    for sample in samples:
+        by_endpoint.setdefault(sample.endpoint, []).append(sample)
+    return {
+        **stats(samples),
+        'endpoints': {name: stats(samples_) for name, samples_ in sorted(by_endpoint.items())}
+    }
+
+
+def compare(old_path: str, new_path: str):
+    """
+    Print the mean of each metric in two result files and its relative
+    change, overall and for the endpoints present in both
+    """
+    metrics = ('requests_per_second', 'errors', 'p50_ms', 'p95_ms', 'p99_ms')
+
+    def means(results: Sequence[Mapping[str, Any]]) -> Dict[str, float]:
+        return {m: sum(r[m] for r in results) / len(results) for m in metrics}
+
+    old, new = load_measurements(old_path), load_measurements(new_path)
+    rows = [('all', means(old), means(new))]
+    endpoints = set.intersection(*(set(r['endpoints']) for r in old + new))
+    for name in sorted(endpoints):
+        rows.append((name,
+                     means([r['endpoints'][name] for r in old]),
+                     means([r['endpoints'][name] for r in new])))
+    row_fmt = '{:<32} ' + '| {:<26}' * len(metrics)
+    print(row_fmt.format('endpoint', *metrics))
+    for name, o, n in rows:
+        print(row_fmt.format(name, *(
+            f'{o[m]:.1f} -> {n[m]:.1f}' + (f' ({(n[m] / o[m] - 1) * 100:+.0f}%)' if o[m] else '')
+            for m in metrics
+        )))
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', help='The URL of the study, http://127.0.0.1:5005 for a local container')
+    target.add_argument('--study', metavar='SUBDOMAIN', help='The subdomain of a deployed study')
+    parser.add_argument('--output', help='The file to append the results to')
+    parser.add_argument('--label', default='',
+                        help='What is being tested, the image version or the size of the study, for example')
+    parser.add_argument('--vcpu', type=int,
+                        help='The vCPU units of the task serving the study, to record with the results')
+    parser.add_argument('--memory', type=int,
+                        help='The memory of the task serving the study in MiB, to record with the results')
+    parser.add_argument('--users', type=int, default=10,
+                        help='The number of users browsing the study at the same time')
+    parser.add_argument('--ramp', type=float, default=30,
+                        help='The number of seconds over which the users are started')
+    parser.add_argument('--duration', type=float, default=300,
+                        help='The number of seconds the test runs for, including the ramp-up')
+    parser.add_argument('--connections', type=int, default=100,
+                        help='The maximum number of connections shared by all users')
+    parser.add_argument('--bursts', type=int, default=Scenario.bursts,
+                        help='The number of bursts of expression fetches per session')
+    parser.add_argument('--genes-per-burst', type=int, default=Scenario.genes_per_burst)
+    parser.add_argument('--think', type=float, default=Scenario.think_seconds,
+                        help='The mean number of seconds between bursts')
+    parser.add_argument('--genes', help='A comma-separated list of the genes to fetch, instead of all genes')
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.url is None and args.study is None or args.output is None:
+        parser.error('--url or --study and --output are required unless --compare is given')
+    if args.url is None:
+        url = f"https://{args.study}.{os.environ['CELLXGENE_DOMAIN_NAME']}"
+    else:
+        url = args.url
+    load_test = LoadTest(url=url,
+                         users=args.users,
+                         ramp_seconds=args.ramp,
+                         duration_seconds=args.duration,
+                         connections=args.connections,
+                         scenario=Scenario(bursts=args.bursts,
+                                           genes_per_burst=args.genes_per_burst,
+                                           think_seconds=args.think),
+                         genes=None if args.genes is None else args.genes.split(','))
+    loop = asyncio.get_event_loop()
+    result = {
+        'label': args.label,
+        **({'vcpu': args.vcpu, 'memory_in_MiB': args.memory} if args.vcpu and args.memory else {}),
+        **loop.run_until_complete(load_test.run())
+    }
+    log.info('%i requests in %i sessions, %.1f per second, %i errors, p50 %.1f ms, p99 %.1f ms',
+             result['requests'], result['sessions'], result['requests_per_second'],
+             result['errors'], result['p50_ms'], result['p99_ms'])
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,201 @@
+"""
+A persistent manifest of the matrix files in the release bucket.
+
+Rendering the Terraform templates only reads the manifest, so it doesn't need
+network access, unless the manifest is missing, in which case it is created
+from a listing of the release bucket. The manifest is updated with
+
+    python -m cellxgene_fargate.manifest --refresh
+
+which lists the release prefix and all prefixes below it concurrently and
+reports the files that were added, removed or changed since the last refresh.
+For local testing, point `--endpoint-url` at an S3 stand-in like
+`moto_server`.
+"""
+import argparse
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+import json
+import logging
+import os
+import sys
+from typing import (
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import boto3
+import botocore.config
+from dataclasses import (
+    asdict,
+    dataclass,
+)
+
+log = logging.getLogger(__name__)
+
+release_bucket = 'release-files.data.humancellatlas.org'
+release_prefix = 'release-files/releases/2020-mar/'
+
+matrix_file_suffix = '.h5ad'
+
+
+def manifest_path() -> str:
+    return os.environ['CELLXGENE_MANIFEST']
+
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    key: str
+    size: int
+    etag: str
+    last_modified: str  # ISO 8601
+
+
+@dataclass(frozen=True)
+class ManifestDiff:
+    added: Tuple[ManifestEntry, ...]
+    removed: Tuple[ManifestEntry, ...]
+    changed: Tuple[ManifestEntry, ...]
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+
+@dataclass(frozen=True)
+class Manifest:
+    bucket: str
+    prefix: str
+    entries: Tuple[ManifestEntry, ...]
+
+    @classmethod
+    def load(cls, path: Optional[str] = None) -> 'Manifest':
+        if path is None:
+            path = manifest_path()
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            # Deployments that predate the manifest list the bucket when
+            # rendering, so the first render after upgrading does that once
+            # more and leaves the manifest behind, to be committed.
+            log.warning('The manifest at %s is missing, listing s3://%s/%s to create it',
+                        path, release_bucket, release_prefix)
+            manifest = cls.list(boto3.client('s3'), release_bucket, release_prefix)
+            manifest.save(path)
+            return manifest
+        return cls(bucket=manifest['bucket'],
+                   prefix=manifest['prefix'],
+                   entries=tuple(ManifestEntry(**entry) for entry in manifest['entries']))
+
+    def save(self, path: Optional[str] = None):
+        if path is None:
+            path = manifest_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(asdict(self), f, indent=4)
+            f.write('\n')
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def list(cls,
+             s3,
+             bucket: str,
+             prefix: str,
+             suffix: str = matrix_file_suffix,
+             concurrency: int = 8) -> 'Manifest':
+        """
+        List all objects below the given prefix whose key ends in the given
+        suffix. Every prefix is listed in a separate thread, as soon as it is
+        discovered.
+        """
+
+        def list_prefix(prefix: str) -> Tuple[List[ManifestEntry], List[str]]:
+            entries, prefixes = [], []
+            paginator = s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+                entries.extend(ManifestEntry(key=obj['Key'],
+                                             size=obj['Size'],
+                                             etag=obj['ETag'],
+                                             last_modified=obj['LastModified'].isoformat())
+                               for obj in page.get('Contents', ())
+                               if obj['Key'].endswith(suffix))
+                prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', ()))
+            return entries, prefixes
+
+        entries = []
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = {executor.submit(list_prefix, prefix)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    new_entries, new_prefixes = future.result()
+                    entries.extend(new_entries)
+                    pending.update(executor.submit(list_prefix, p) for p in new_prefixes)
+        entries.sort(key=lambda entry: entry.key)
+        return cls(bucket=bucket, prefix=prefix, entries=tuple(entries))
+
+    def by_key(self) -> Mapping[str, ManifestEntry]:
+        return {entry.key: entry for entry in self.entries}
+
+    def diff(self, new: 'Manifest') -> ManifestDiff:
+        old_entries, new_entries = self.by_key(), new.by_key()
+        return ManifestDiff(
+            added=tuple(e for k, e in new_entries.items() if k not in old_entries),
+            removed=tuple(e for k, e in old_entries.items() if k not in new_entries),
+            changed=tuple(e for k, e in new_entries.items()
+                          if k in old_entries and (e.size, e.etag) != (old_entries[k].size, old_entries[k].etag))
+        )
+
+
+def refresh(s3, path: str, concurrency: int) -> ManifestDiff:
+    if os.path.exists(path):
+        old = Manifest.load(path)
+    else:
+        old = Manifest(bucket=release_bucket, prefix=release_prefix, entries=())
+    new = Manifest.list(s3, old.bucket, old.prefix, concurrency=concurrency)
+    diff = old.diff(new)
+    if new != old:
+        new.save(path)
+    return diff
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--refresh', action='store_true',
+                        help='List the bucket and update the manifest.')
+    parser.add_argument('--path', default=None,
+                        help='The manifest file. Defaults to the value of CELLXGENE_MANIFEST.')
+    parser.add_argument('--endpoint-url')
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args(argv)
+    path = manifest_path() if args.path is None else args.path
+    if args.refresh:
+        s3 = boto3.client('s3',
+                          endpoint_url=args.endpoint_url,
+                          config=botocore.config.Config(max_pool_connections=args.concurrency))
+        diff = refresh(s3, path, args.concurrency)
+        for change, entries in (('Added', diff.added),
+                                ('Removed', diff.removed),
+                                ('Changed', diff.changed)):
+            for entry in entries:
+                print(f'{change}: {entry.key} ({entry.size} bytes, ETag {entry.etag})')
+        if not diff:
+            print('No changes')
+    else:
+        manifest = Manifest.load(path)
+        print(f'{len(manifest.entries)} files below s3://{manifest.bucket}/{manifest.prefix}, '
+              f'{sum(entry.size for entry in manifest.entries)} bytes in total')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,261 @@
+import json
+import os
+import re
+from typing import (
+    Dict,
+    List,
+    Mapping,
+    Optional,
+)
+
+from boltons.cacheutils import cachedproperty
+from dataclasses import (
+    dataclass,
+    replace,
+)
+
+from cellxgene_fargate.fargate import (
+    FargateSpec,
+)
+from cellxgene_fargate.h5ad import (
+    MatrixInfo,
+)
+from cellxgene_fargate.launch import (
+    cache_proxy_enabled,
+    cache_proxy_memory_in_MiB,
+)
+from cellxgene_fargate.manifest import (
+    Manifest,
+    manifest_path,
+)
+from cellxgene_fargate.sizing import (
+    SizingOverride,
+    default_model,
+    default_overrides,
+    startup_seconds_target,
+)
+
+# Conservative estimates of the rate at which a container stages a matrix file
+# from S3 and, without a sizing model, of the rate at which one vCPU loads it,
+# both in bytes per second
+staging_bytes_per_second = 50 * 1024 * 1024
+loading_bytes_per_vcpu_second = 20 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class MatrixFile:
+    bucket: str
+    key: str
+    size: int
+    etag: str
+    study_name: str
+    public_url: str
+    subdomain: str
+    tfid: str
+    # The shape and structure of the matrix, if the file has been inspected
+    info: Optional[MatrixInfo] = None
+    # The size of the original file if this describes an optimized copy of it
+    source_size: Optional[int] = None
+    # The size chosen for the study's concurrency target, if it has one, see
+    # `cellxgene_fargate.planning`
+    planned_specs: Optional[FargateSpec] = None
+    slug_prefix = '2020-mar-'
+
+    @classmethod
+    def for_key(cls,
+                bucket: str,
+                key: str,
+                size: int,
+                etag: str,
+                info: Optional[MatrixInfo] = None) -> 'MatrixFile':
+        prefix, _, filename = key.rpartition('/')
+        study_name, _, suffix = filename.partition('_')
+        # https://docs.aws.amazon.com/Route53/latest/DeveloperGuide/DomainNameFormat.html
+        # has nothing against - and _ at the beginning/end or repeating them but
+        # we'll enforce those things anyways.
+        assert re.fullmatch(r'[a-z0-9]+([-_][a-z0-9]+)*', study_name, re.I), study_name
+        assert len(study_name) < 64
+        return cls(bucket=bucket,
+                   key=key,
+                   size=size,
+                   etag=etag,
+                   study_name=study_name,
+                   public_url='https://data.humancellatlas.org/' + key,
+                   subdomain=study_name.lower(),
+                   tfid='cellxgene_' + study_name.replace('-', '_').lower(),
+                   info=info)
+
+    @property
+    def slug(self):
+        assert self.subdomain.startswith(self.slug_prefix)
+        return self.subdomain[len(self.slug_prefix):]
+
+    # noinspection PyPep8Naming
+    @property
+    def required_memory_in_MiB(self) -> int:
+        model = default_model()
+        if model is None or self.info is None:
+            # Formula inferred from linear regression on optimized services and
+            # verified to successfully deploy for all March 2020 HCA files.
+            # Resting memory usage is typically low but but lowering the allocation
+            # causes health checks to fail.
+            #
+            # The regression was fitted to the original files. Optimizing a file
+            # shrinks it far more than the memory needed to serve it, which is
+            # mostly the unchanged cell and gene annotations and embeddings, so
+            # an optimized copy is sized like its original until a sizing model
+            # is fitted.
+            size = self.size if self.source_size is None else self.source_size
+            return round(size * 2.5601e-6 - 16.5)
+        else:
+            return model.required_memory_in_MiB(self.info)
+
+    @property
+    def required_vcpu(self) -> int:
+        model = default_model()
+        if model is None or self.info is None:
+            return 0
+        else:
+            vcpu = model.required_vcpu(self.info, startup_seconds_target())
+            if vcpu is None:
+                raise RuntimeError(f'No Fargate task is expected to load the matrix of {self.study_name} '
+                                   f'within {startup_seconds_target():g} seconds. '
+                                   f'Raise CELLXGENE_STARTUP_SECONDS_TARGET.')
+            return vcpu
+
+    # noinspection PyPep8Naming
+    @property
+    def sidecar_memory_in_MiB(self) -> int:
+        return cache_proxy_memory_in_MiB if cache_proxy_enabled() else 0
+
+    def startup_seconds(self, vcpu: int) -> float:
+        """
+        The predicted number of seconds from the start of the container until
+        the matrix is loaded, if the container gets the given number of vCPU
+        units (1/1024 of a vCPU).
+        """
+        staging = self.size / staging_bytes_per_second
+        model = default_model()
+        if model is None or self.info is None:
+            loading = self.size / loading_bytes_per_vcpu_second
+        else:
+            loading = model.startup_cpu_seconds(self.info) * (1 + model.margin)
+        return staging + loading * 1024 / vcpu
+
+    @cachedproperty
+    def estimated_fargate_specs(self) -> FargateSpec:
+        memory_in_MiB = self.required_memory_in_MiB + self.sidecar_memory_in_MiB
+        specs = FargateSpec.for_required_memory(memory_in_MiB, min_vcpu=self.required_vcpu)
+        if specs is None:
+            raise RuntimeError(f'No Fargate task has the {memory_in_MiB} MiB of memory required by '
+                               f'{self.study_name}')
+        return specs
+
+    @property
+    def sizing_override(self) -> Optional[SizingOverride]:
+        override = default_overrides().get(self.subdomain)
+        return override if override is not None and override.etag == self.etag else None
+
+    @cachedproperty
+    def unplanned_fargate_specs(self) -> FargateSpec:
+        override = self.sizing_override
+        return self.estimated_fargate_specs if override is None else override.fargate_specs
+
+    @property
+    def fargate_specs(self) -> FargateSpec:
+        return self.unplanned_fargate_specs if self.planned_specs is None else self.planned_specs
+
+
+@dataclass(frozen=True)
+class OptimizedFile:
+    """
+    A copy of a matrix file rewritten for serving by `cellxgene_fargate.optimize`
+    """
+    # The ETag of the matrix file the copy was made from
+    source_etag: str
+    bucket: str
+    key: str
+    size: int
+    etag: str
+    info: MatrixInfo
+
+
+def optimized_bucket() -> str:
+    return os.environ['CELLXGENE_OPTIMIZED_BUCKET']
+
+
+def optimized_path(manifest_path: str, bucket: str) -> str:
+    """
+    The record of the optimized copies in the given bucket. Every deployment
+    has a bucket of its own and therefore a record of its own.
+
+    >>> optimized_path('/foo/2020-mar.json', 'bar')
+    '/foo/2020-mar.optimized.bar.json'
+    """
+    return os.path.splitext(manifest_path)[0] + f'.optimized.{bucket}.json'
+
+
+def load_optimized(manifest: Manifest,
+                   path: Optional[str] = None,
+                   bucket: Optional[str] = None) -> Dict[str, OptimizedFile]:
+    """
+    Return the optimized copy in the given bucket of every file in the given
+    manifest that has one made from the current version of the file. There
+    are none if the deployment has no bucket for optimized copies.
+    """
+    if bucket is None:
+        bucket = optimized_bucket()
+    if not bucket:
+        return {}
+    if path is None:
+        path = optimized_path(manifest_path(), bucket)
+    try:
+        with open(path) as f:
+            records = json.load(f)
+    except FileNotFoundError:
+        records = {}
+    optimized = {
+        key: OptimizedFile(**{**record, 'info': MatrixInfo.from_json(record['info'])})
+        for key, record in records.items()
+    }
+    return {
+        entry.key: optimized[entry.key]
+        for entry in manifest.entries
+        if (entry.key in optimized
+            and optimized[entry.key].source_etag == entry.etag
+            # Other deployments can't read the copies in this one's bucket
+            and optimized[entry.key].bucket == bucket)
+    }
+
+
+def matrix_files(manifest: Manifest,
+                 info: Optional[Mapping[str, MatrixInfo]] = None,
+                 optimized: Optional[Mapping[str, OptimizedFile]] = None) -> List[MatrixFile]:
+    """
+    :param info: the result of inspecting the files in the manifest by key
+
+    :param optimized: the optimized copies of the files in the manifest by
+                      key. The returned instances describe the optimized copy
+                      of a file, if there is one, and the file itself otherwise.
+    """
+    info = {} if info is None else info
+    optimized = {} if optimized is None else optimized
+    matrix_files = []
+    for entry in manifest.entries:
+        matrix_file = MatrixFile.for_key(manifest.bucket, entry.key, entry.size, entry.etag, info.get(entry.key))
+        try:
+            copy = optimized[entry.key]
+        except KeyError:
+            pass
+        else:
+            matrix_file = replace(matrix_file,
+                                  source_size=matrix_file.size,
+                                  bucket=copy.bucket,
+                                  key=copy.key,
+                                  size=copy.size,
+                                  etag=copy.etag,
+                                  info=copy.info)
+        matrix_files.append(matrix_file)
+    assert len(set(m.subdomain for m in matrix_files)) == len(matrix_files)
+    assert len(set(m.tfid for m in matrix_files)) == len(matrix_files)
+    return matrix_files
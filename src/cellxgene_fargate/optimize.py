@@ -0,0 +1,248 @@
+"""
+Rewrite matrix files into copies optimized for serving by cellxgene.
+
+The viewer runs with differential expression and annotations disabled, so it
+only ever reads X, the cell and gene annotations and the embeddings. The
+optimized copy
+
+ - stores X as float32,
+
+ - stores a sparse X in canonical CSC form, with sorted indices and without
+   duplicate entries, so that the expression of a gene is a single contiguous
+   slice of the `data` and `indices` datasets,
+
+ - chunks and LZF-compresses the datasets of X with a chunk size derived from
+   the average number of non-zero entries per gene, so reading a gene touches
+   few chunks that are cheap to decompress,
+
+ - drops `layers`, `raw`, `varm` and pairwise annotations.
+
+Copies are uploaded to the bucket named in CELLXGENE_OPTIMIZED_BUCKET under
+the key of the original file and recorded next to the manifest, in a file per
+bucket and therefore per deployment, together with their size and structure,
+which the Terraform template then uses to point the task definitions at the
+copy and to size the tasks for it. Process every file that has no current
+optimized copy with
+
+    python -m cellxgene_fargate.optimize
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from typing import (
+    Optional,
+    Sequence,
+)
+
+import anndata
+from boto3.s3.transfer import TransferConfig
+from dataclasses import asdict
+import h5py
+import numpy
+import scipy.sparse
+
+from cellxgene_fargate.h5ad import (
+    inspect,
+    load_info,
+)
+from cellxgene_fargate.manifest import (
+    Manifest,
+    manifest_path,
+)
+from cellxgene_fargate.matrix import (
+    OptimizedFile,
+    load_optimized,
+    matrix_files,
+    optimized_bucket,
+    optimized_path,
+)
+from cellxgene_fargate.stage import (
+    s3_client,
+    stage,
+)
+
+log = logging.getLogger(__name__)
+
+serving_dtype = numpy.float32
+
+# A sparse X denser than this is stored as a dense array
+max_sparse_density = 0.5
+
+min_chunk_length = 4 * 1024
+max_chunk_length = 1024 * 1024
+
+# The target size of a chunk of a dense X, in bytes
+dense_chunk_size = 1024 * 1024
+
+
+def sparse_chunk_length(nnz: int, n_vars: int) -> int:
+    """
+    The chunk length for the `data` and `indices` datasets of a CSC matrix,
+    enough to hold the entries of a few average genes.
+
+    >>> sparse_chunk_length(100_000_000, 20_000)
+    20000
+    >>> sparse_chunk_length(1000, 20_000)
+    1000
+    >>> sparse_chunk_length(10**10, 10)
+    1048576
+    """
+    length = 4 * nnz // max(1, n_vars)
+    return min(nnz, max(min_chunk_length, min(max_chunk_length, length)))
+
+
+def write_x(f: h5py.File, x):
+    """
+    Write the given matrix as X to the given file in the layout described in
+    the module docstring.
+    """
+    n_obs, n_vars = x.shape
+    if scipy.sparse.issparse(x):
+        x = x.tocsc()
+        # Canonicalizes the matrix and sorts its indices
+        x.sum_duplicates()
+        group = f.create_group('X')
+        group.attrs['encoding-type'] = 'csc_matrix'
+        group.attrs['encoding-version'] = '0.1.0'
+        group.attrs['shape'] = numpy.array(x.shape)
+        chunk_length = sparse_chunk_length(x.nnz, n_vars)
+        for name, array in (('data', x.data.astype(serving_dtype, copy=False)),
+                            ('indices', x.indices)):
+            if x.nnz:
+                group.create_dataset(name, data=array, chunks=(chunk_length,), compression='lzf')
+            else:
+                group.create_dataset(name, data=array)
+        group.create_dataset('indptr', data=x.indptr)
+    else:
+        # Whole columns so that reading a gene reads contiguous chunks
+        columns = max(1, min(n_vars, dense_chunk_size // (n_obs * numpy.dtype(serving_dtype).itemsize)))
+        f.create_dataset('X',
+                         data=numpy.asarray(x, dtype=serving_dtype),
+                         chunks=(n_obs, columns),
+                         compression='lzf')
+
+
+def optimize(source_path: str, path: str):
+    """
+    Write an optimized copy of the `.h5ad` file at the given source path to
+    the given path.
+    """
+    adata = anndata.read_h5ad(source_path)
+    x = adata.X
+    if scipy.sparse.issparse(x):
+        if x.nnz > max_sparse_density * x.shape[0] * x.shape[1]:
+            x = x.toarray()
+    elif numpy.count_nonzero(x) <= max_sparse_density * x.size:
+        x = scipy.sparse.csc_matrix(x)
+    # Let AnnData write everything but X, including the dataframes with all
+    # their categorical encodings, then replace its placeholder X with ours.
+    skeleton = anndata.AnnData(X=scipy.sparse.csc_matrix(adata.shape, dtype=serving_dtype),
+                               obs=adata.obs,
+                               var=adata.var,
+                               obsm=dict(adata.obsm),
+                               uns=dict(adata.uns))
+    skeleton.write(path)
+    del skeleton, adata
+    with h5py.File(path, 'a') as f:
+        del f['X']
+        write_x(f, x)
+
+
+def optimize_all(s3,
+                 manifest: Manifest,
+                 bucket: str,
+                 workdir: str,
+                 keys: Optional[Sequence[str]] = None) -> int:
+    """
+    Optimize the files in the manifest that don't have a current optimized
+    copy and return the number of files optimized.
+    """
+    path = optimized_path(manifest_path(), bucket)
+    optimized = load_optimized(manifest, path, bucket)
+    todo = [
+        entry for entry in manifest.entries
+        if entry.key not in optimized and (keys is None or entry.key in keys)
+    ]
+    transfer_config = TransferConfig(multipart_chunksize=64 * 1024 * 1024, max_concurrency=16)
+    for entry in todo:
+        source_path = os.path.join(workdir, 'source.h5ad')
+        optimized_file_path = os.path.join(workdir, 'optimized.h5ad')
+        try:
+            stage(s3, manifest.bucket, entry.key, source_path, size=entry.size, etag=entry.etag)
+            log.info('Optimizing %s', entry.key)
+            optimize(source_path, optimized_file_path)
+            with h5py.File(optimized_file_path, 'r') as f:
+                info = inspect(f)
+            s3.upload_file(optimized_file_path, bucket, entry.key, Config=transfer_config)
+            response = s3.head_object(Bucket=bucket, Key=entry.key)
+        finally:
+            for p in (source_path, source_path + '.etag', optimized_file_path):
+                if os.path.exists(p):
+                    os.unlink(p)
+        optimized[entry.key] = OptimizedFile(source_etag=entry.etag,
+                                             bucket=bucket,
+                                             key=entry.key,
+                                             size=response['ContentLength'],
+                                             etag=response['ETag'],
+                                             info=info)
+        # Save after every file so that an interruption doesn't lose work
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({key: asdict(copy) for key, copy in sorted(optimized.items())}, f, indent=4)
+            f.write('\n')
+        os.rename(tmp_path, path)
+    return len(todo)
+
+
+def savings_report(manifest: Manifest):
+    info = load_info(manifest)
+    originals = matrix_files(manifest, info)
+    optimized = matrix_files(manifest, info, load_optimized(manifest))
+    row_fmt = '{:<45} ' + '| {:>10} ' * 4
+    print(row_fmt.format('container', 'MiB', 'opt. MiB', 'RAM MiB', 'opt. RAM MiB'))
+    totals = numpy.zeros(4)
+    for original, copy in zip(originals, optimized):
+        if copy.etag != original.etag:
+            row = numpy.array([original.size / 2 ** 20,
+                               copy.size / 2 ** 20,
+                               original.fargate_specs.memory_in_MiB,
+                               copy.fargate_specs.memory_in_MiB])
+            totals += row
+            print(row_fmt.format(original.study_name, *map(round, row)))
+    print(row_fmt.format('Total', *map(round, totals)))
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', nargs='*', help='Only optimize these files')
+    parser.add_argument('--workdir', help='Defaults to a temporary directory')
+    parser.add_argument('--report', action='store_true',
+                        help='Only print the size and memory savings of the existing copies')
+    args = parser.parse_args(argv)
+    if not optimized_bucket():
+        parser.error('CELLXGENE_OPTIMIZED_BUCKET is empty, so there is nowhere to put the optimized copies')
+    manifest = Manifest.load()
+    if not args.report:
+        workdir = tempfile.mkdtemp() if args.workdir is None else args.workdir
+        try:
+            optimized = optimize_all(s3_client(),
+                                     manifest,
+                                     bucket=optimized_bucket(),
+                                     workdir=workdir,
+                                     keys=args.keys)
+        finally:
+            if args.workdir is None:
+                shutil.rmtree(workdir)
+        print(f'Optimized {optimized} files')
+    savings_report(manifest)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
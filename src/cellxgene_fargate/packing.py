@@ -0,0 +1,141 @@
+"""
+Group small studies into shared Fargate tasks.
+
+Fargate rounds the size of every task up to the next supported combination
+of vCPU and memory, and the smallest one is 0.25 vCPU with 512 MiB. Running
+each small study in a task of its own pays for that rounding once per study.
+A pack is a group of studies served by a single task, with one container, or
+one container and its cache proxy, per study, each listening on a port of its
+own and registered in the study's own target group.
+
+Studies are packed first-fit decreasing by the memory they are predicted to
+need, into tasks of at most `capacity_in_MiB`. A pack that would cost more
+than running its members separately is split up again. Studies that are put
+to sleep when idle are never packed, since that would stop the other studies
+in the pack as well.
+"""
+import hashlib
+import os
+from typing import (
+    Callable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from dataclasses import (
+    dataclass,
+)
+
+from cellxgene_fargate.fargate import (
+    FargateSpec,
+)
+from cellxgene_fargate.matrix import (
+    MatrixFile,
+)
+
+# An ECS service can register its tasks with at most five target groups
+max_members = 5
+
+
+def required_memory_in_MiB(m: MatrixFile) -> int:
+    return m.required_memory_in_MiB + m.sidecar_memory_in_MiB
+
+
+@dataclass(frozen=True)
+class Pack:
+    members: Tuple[MatrixFile, ...]
+
+    @property
+    def packed(self) -> bool:
+        return len(self.members) > 1
+
+    @property
+    def tfid(self) -> str:
+        """
+        A study on its own keeps the resource names it would have without
+        packing.
+        """
+        if self.packed:
+            return 'cellxgene_pack_' + self._digest
+        else:
+            return self.members[0].tfid
+
+    @property
+    def name(self) -> str:
+        if self.packed:
+            return 'cellxgene-pack-' + self._digest
+        else:
+            return 'cellxgene-' + self.members[0].subdomain
+
+    @property
+    def _digest(self) -> str:
+        subdomains = ' '.join(sorted(m.subdomain for m in self.members))
+        return hashlib.sha256(subdomains.encode()).hexdigest()[:8]
+
+    @property
+    def fargate_specs(self) -> Optional[FargateSpec]:
+        """
+        The cheapest spec that fits all members, or None if there is none
+        """
+        if self.packed:
+            return FargateSpec.for_required_memory(sum(map(required_memory_in_MiB, self.members)),
+                                                   min_vcpu=sum(m.required_vcpu for m in self.members))
+        else:
+            return self.members[0].fargate_specs
+
+    @property
+    def cost_per_hour(self) -> float:
+        return sum(self.fargate_specs.cost_per_hour)
+
+    @property
+    def unpacked_cost_per_hour(self) -> float:
+        return sum(sum(m.fargate_specs.cost_per_hour) for m in self.members)
+
+    def fits(self, capacity_in_MiB: int) -> bool:
+        specs = self.fargate_specs
+        return (len(self.members) <= max_members
+                and specs is not None
+                and specs.memory_in_MiB <= capacity_in_MiB)
+
+
+def pack(matrix_files: Sequence[MatrixFile],
+         capacity_in_MiB: int,
+         packable: Callable[[MatrixFile], bool] = lambda m: True) -> List[Pack]:
+    """
+    Group the given studies into packs, leaving every study that isn't
+    packable or doesn't fit with others in a pack of its own. The packs are
+    returned in the order of their first member in the argument.
+    """
+    order = {m.subdomain: i for i, m in enumerate(matrix_files)}
+    bins: List[Pack] = []
+    singles = []
+    candidates = sorted((m for m in matrix_files if packable(m)),
+                        key=required_memory_in_MiB,
+                        reverse=True)
+    for m in candidates:
+        for i, bin_ in enumerate(bins):
+            candidate = Pack(bin_.members + (m,))
+            if candidate.fits(capacity_in_MiB):
+                bins[i] = candidate
+                break
+        else:
+            bins.append(Pack((m,)))
+    packs = []
+    for bin_ in bins:
+        if bin_.packed and bin_.cost_per_hour < bin_.unpacked_cost_per_hour:
+            packs.append(Pack(tuple(sorted(bin_.members, key=lambda m: order[m.subdomain]))))
+        else:
+            singles.extend(bin_.members)
+    singles.extend(m for m in matrix_files if not packable(m))
+    packs.extend(Pack((m,)) for m in singles)
+    packs.sort(key=lambda p: order[p.members[0].subdomain])
+    return packs
+
+
+def packing_capacity_in_MiB() -> int:
+    """
+    The maximum memory of a shared task, zero if packing is disabled
+    """
+    return int(os.environ['CELLXGENE_PACKING_MEMORY'])
@@ -0,0 +1,238 @@
+"""
+Choose the size and the number of replicas of the task of each study such that
+it serves a given number of concurrent users within a given latency, at the
+lowest cost.
+
+The number of users and the 95th percentile of the latency are part of a
+study's scaling policy, see `cellxgene_fargate.scaling`:
+
+    {
+        "studies": {
+            "2020-mar-foo": {"concurrent_users": 50, "latency_ms": 1000}
+        }
+    }
+
+How many users a replica of a given size serves is taken from throughput
+curves, the results of `cellxgene_fargate.loadtest` run with `--vcpu` and
+`--memory` against a study with a single replica of that size and an
+increasing number of users, appended to the file configured in
+CELLXGENE_CURVES. The results for the same size form a curve of the 95th
+percentile of the latency over the number of users. The number of users within
+a given latency is interpolated from the curve, but not extrapolated beyond
+the most users measured. Since serving is bound by CPU, sizes that weren't
+measured serve as many users as the best measured size with the same vCPUs.
+Sizes with vCPUs that weren't measured at all aren't considered.
+
+The candidates for a study are all Fargate sizes with at least as much memory
+as the study's task is sized with otherwise, and at least as many vCPUs as
+the sizing model requires for loading its matrix in time, see
+`cellxgene_fargate.sizing`, each with as many replicas as needed to serve the
+users. The cheapest candidate is chosen for all studies at once, with array
+operations over the studies and the sizes. The Terraform template uses the
+chosen size for the study's task definition and the number of replicas as its
+minimum capacity. Studies with a plan are never packed with others, see
+`cellxgene_fargate.packing`.
+
+Usage:
+
+    python -m cellxgene_fargate.planning
+"""
+import argparse
+from collections import defaultdict
+import json
+import logging
+import os
+import sys
+from typing import (
+    Dict,
+    List,
+    Mapping,
+    Sequence,
+)
+
+from dataclasses import (
+    dataclass,
+)
+import numpy
+
+from cellxgene_fargate.fargate import (
+    FargateSpec,
+    fargate_GB_ram_dollars_per_hour,
+    fargate_vcpu_dollars_per_hour,
+    fargate_vcpu_to_memory_in_MiB,
+)
+from cellxgene_fargate.h5ad import (
+    load_info,
+)
+from cellxgene_fargate.manifest import (
+    Manifest,
+)
+from cellxgene_fargate.matrix import (
+    MatrixFile,
+    load_optimized,
+    matrix_files,
+)
+from cellxgene_fargate.scaling import (
+    ScalingPolicies,
+)
+
+log = logging.getLogger(__name__)
+
+# The most replicas a plan may have
+max_replicas = 100
+
+
+@dataclass(frozen=True)
+class Curve:
+    vcpu: int
+    memory_in_MiB: int
+    # The numbers of users measured, in increasing order
+    users: Sequence[float]
+    # The 95th percentile of the latency with each number of users
+    p95_ms: Sequence[float]
+
+    def capacity(self, latency_ms: numpy.ndarray) -> numpy.ndarray:
+        """
+        The number of users a replica serves within each of the given
+        latencies
+
+        >>> c = Curve(vcpu=1024, memory_in_MiB=4096, users=[10, 20, 40], p95_ms=[200, 400, 1200])
+        >>> c.capacity(numpy.array([100, 300, 800, 5000])).tolist()
+        [0.0, 15.0, 30.0, 40.0]
+        """
+        # Noise in the measurements mustn't make more users look faster
+        p95_ms = numpy.maximum.accumulate(numpy.asarray(self.p95_ms, dtype=float))
+        users = numpy.asarray(self.users, dtype=float)
+        capacity = numpy.interp(latency_ms, p95_ms, users, right=users[-1])
+        return numpy.where(latency_ms < p95_ms[0], 0.0, capacity)
+
+
+def curves_path() -> str:
+    return os.environ['CELLXGENE_CURVES']
+
+
+def load_curves(path: str) -> List[Curve]:
+    """
+    The curves in the given file of load test results. Results without the
+    size of the task are ignored.
+    """
+    points = defaultdict(dict)
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    if 'vcpu' in result and result['p95_ms'] is not None:
+                        size = result['vcpu'], result['memory_in_MiB']
+                        # The latest result for the same number of users wins
+                        points[size][result['users']] = result['p95_ms']
+    except FileNotFoundError:
+        pass
+    return [
+        Curve(vcpu=vcpu,
+              memory_in_MiB=memory_in_MiB,
+              users=sorted(curve),
+              p95_ms=[curve[users] for users in sorted(curve)])
+        for (vcpu, memory_in_MiB), curve in sorted(points.items())
+    ]
+
+
+@dataclass(frozen=True)
+class Plan:
+    fargate_specs: FargateSpec
+    replicas: int
+    # The number of users each replica is expected to serve within the
+    # study's latency objective
+    users_per_replica: float
+
+    @property
+    def cost_per_hour(self) -> float:
+        return self.replicas * sum(self.fargate_specs.cost_per_hour)
+
+
+def fargate_sizes() -> numpy.ndarray:
+    """
+    All Fargate sizes as rows of vCPU units and MiB of memory
+    """
+    return numpy.array([
+        (vcpu, memory_in_MiB)
+        for vcpu, mems in sorted(fargate_vcpu_to_memory_in_MiB.items())
+        for memory_in_MiB in mems
+    ])
+
+
+def plan(files: Sequence[MatrixFile],
+         policies: ScalingPolicies,
+         curves: Sequence[Curve]) -> Dict[str, Plan]:
+    """
+    The cheapest plan for every study with a concurrency target that can be
+    met, by subdomain
+    """
+    files = [m for m in files if policies[m.subdomain].concurrent_users]
+    if not files or not curves:
+        return {}
+    sizes = fargate_sizes()
+    vcpu, memory = sizes[:, 0], sizes[:, 1]
+    cost = vcpu / 1024 * fargate_vcpu_dollars_per_hour + memory / 1024 * fargate_GB_ram_dollars_per_hour
+    users = numpy.array([policies[m.subdomain].concurrent_users for m in files], dtype=float)
+    latency_ms = numpy.array([policies[m.subdomain].latency_ms for m in files], dtype=float)
+    required_memory = numpy.array([m.unplanned_fargate_specs.memory_in_MiB for m in files])
+    required_vcpu = numpy.array([m.required_vcpu for m in files])
+    # The users per replica of each study and size
+    capacity = numpy.zeros((len(files), len(sizes)))
+    for curve in curves:
+        columns = vcpu == curve.vcpu
+        capacity[:, columns] = numpy.maximum(capacity[:, columns], curve.capacity(latency_ms)[:, None])
+    with numpy.errstate(divide='ignore'):
+        replicas = numpy.ceil(users[:, None] / capacity)
+    feasible = ((memory >= required_memory[:, None])
+                & (vcpu >= required_vcpu[:, None])
+                & (replicas <= max_replicas))
+    total_cost = numpy.where(feasible, replicas * cost, numpy.inf)
+    best = total_cost.argmin(axis=1)
+    plans = {}
+    for i, m in enumerate(files):
+        j = best[i]
+        if numpy.isfinite(total_cost[i, j]):
+            plans[m.subdomain] = Plan(fargate_specs=FargateSpec(vcpu=int(vcpu[j]), memory_in_MiB=int(memory[j])),
+                                      replicas=int(replicas[i, j]),
+                                      users_per_replica=float(capacity[i, j]))
+        else:
+            log.warning('No size serves %i users of %s within %i ms, keeping its size',
+                        users[i], m.subdomain, latency_ms[i])
+    return plans
+
+
+def report(files: Sequence[MatrixFile], policies: ScalingPolicies, plans: Mapping[str, Plan]) -> List[str]:
+    row_fmt = '{:<45} | {:>6} | {:>8} | {:<13} | {:>8} | {:>10} | {:>10}'
+    lines = [row_fmt.format('container', 'users', 'p95 ms', 'vCPU / GiB', 'replicas', 'cost', 'was')]
+    for m in files:
+        p = plans.get(m.subdomain)
+        if p is not None:
+            policy = policies[m.subdomain]
+            was = policy.min_capacity * sum(m.unplanned_fargate_specs.cost_per_hour)
+            lines.append(row_fmt.format(m.study_name,
+                                        policy.concurrent_users,
+                                        policy.latency_ms,
+                                        f'{p.fargate_specs.vcpu / 1024:g} / {p.fargate_specs.memory_in_MiB / 1024:g}',
+                                        p.replicas,
+                                        f'${p.cost_per_hour:.4f}',
+                                        f'${was:.4f}'))
+    return lines
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args(argv)
+    manifest = Manifest.load()
+    files = matrix_files(manifest, load_info(manifest), load_optimized(manifest))
+    policies = ScalingPolicies.load()
+    for line in report(files, policies, plan(files, policies, load_curves(curves_path()))):
+        print(line)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
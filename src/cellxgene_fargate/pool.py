@@ -0,0 +1,339 @@
+"""
+A warm pool of generic cellxgene containers that are assigned a study on
+demand.
+
+Starting a container for a study takes pulling the image, starting Python,
+importing cellxgene and its dependencies and loading the matrix. Only the last
+step depends on the study. The pool is a number of tasks, started from the
+same image, that run the pool agent in this module. The agent imports
+everything cellxgene needs and then waits for an assignment. Once assigned a
+study, it stages the study's matrix file and serves it.
+
+The pool manager runs every minute and whenever the waker starts a sleeping
+study. It assigns an idle pool task to every study whose service has fewer
+healthy tasks than it wants, registering the pool task in the study's target
+group. A study only ever borrows one pool task at a time. Once the study's own
+tasks are healthy, or the study goes to sleep, the manager deregisters and
+stops the borrowed task. Finally, it starts as many new pool tasks as needed
+to keep the configured number of idle ones.
+
+Assignments are SSM parameters named after the pool task, holding the
+subdomain of the study. The details of each study eligible for the pool are
+kept in SSM parameters written by the Terraform template. The manager is
+packaged into the Lambda functions together with `cellxgene_fargate.sleep`
+and must not import anything outside the standard library and boto3 at the
+module level.
+
+Usage of the agent:
+
+    python -m cellxgene_fargate.pool --port=PORT --dest=DIR [--cache=DIR]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from typing import (
+    Any,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+)
+import urllib.request
+
+from dataclasses import (
+    asdict,
+    dataclass,
+)
+
+log = logging.getLogger(__name__)
+
+study_parameter_prefix = '/cellxgene/pool/studies/'
+task_parameter_prefix = '/cellxgene/pool/tasks/'
+
+# The value of the `startedBy` property of the pool tasks
+started_by = 'cellxgene-pool'
+
+# The number of seconds between two checks for an assignment by the agent
+poll_interval = 1
+
+
+@dataclass(frozen=True)
+class PoolStudy:
+    """
+    A study that can borrow a task from the pool
+    """
+    subdomain: str
+    service: str
+    target_group_arn: str
+    title: str
+    bucket: str
+    key: str
+    size: int
+    etag: str
+    memory_in_MiB: int
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, s: str) -> 'PoolStudy':
+        return cls(**json.loads(s))
+
+
+@dataclass(frozen=True)
+class PoolConfig:
+    cluster: str
+    task_definition: str
+    # The number of idle tasks to keep in the pool
+    size: int
+    # The memory of each pool task. Studies that need more can't borrow one.
+    memory_in_MiB: int
+    # The port the agent serves the assigned study on
+    port: int
+    subnets: Sequence[str]
+    security_groups: Sequence[str]
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, s: str) -> 'PoolConfig':
+        return cls(**json.loads(s))
+
+
+@dataclass(frozen=True)
+class PoolTask:
+    arn: str
+    status: str
+    # The private IP address, None while the task is provisioning
+    ip: Optional[str]
+
+    @property
+    def id(self) -> str:
+        return self.arn.rsplit('/', 1)[1]
+
+
+def get_parameters(ssm, prefix: str) -> Dict[str, str]:
+    """
+    The value of every SSM parameter below the given prefix, by the remainder
+    of its name
+    """
+    paginator = ssm.get_paginator('get_parameters_by_path')
+    return {
+        parameter['Name'][len(prefix):]: parameter['Value']
+        for page in paginator.paginate(Path=prefix)
+        for parameter in page['Parameters']
+    }
+
+
+def pool_tasks(ecs, cluster: str) -> List[PoolTask]:
+    tasks = []
+    paginator = ecs.get_paginator('list_tasks')
+    for page in paginator.paginate(cluster=cluster, startedBy=started_by):
+        if page['taskArns']:
+            response = ecs.describe_tasks(cluster=cluster, tasks=page['taskArns'])
+            for task in response['tasks']:
+                ip = next((detail['value']
+                           for attachment in task.get('attachments', [])
+                           for detail in attachment['details']
+                           if detail['name'] == 'privateIPv4Address'), None)
+                tasks.append(PoolTask(arn=task['taskArn'], status=task['lastStatus'], ip=ip))
+    return tasks
+
+
+def own_healthy_targets(elbv2, study: PoolStudy, borrowed_ips: Sequence[str]) -> int:
+    response = elbv2.describe_target_health(TargetGroupArn=study.target_group_arn)
+    return sum(1 for target in response['TargetHealthDescriptions']
+               if target['TargetHealth']['State'] == 'healthy'
+               and target['Target']['Id'] not in borrowed_ips)
+
+
+def manage(config: PoolConfig, ecs, ssm, elbv2) -> Mapping[str, Any]:
+    """
+    Assign idle pool tasks to the studies that need them, release the
+    borrowed tasks that are no longer needed and refill the pool. Returns a
+    summary of the actions taken.
+    """
+    studies = {
+        subdomain: PoolStudy.from_json(value)
+        for subdomain, value in get_parameters(ssm, study_parameter_prefix).items()
+    }
+    assignments = get_parameters(ssm, task_parameter_prefix)
+    tasks = {task.id: task for task in pool_tasks(ecs, config.cluster) if task.status != 'STOPPED'}
+    summary = {'assigned': [], 'released': [], 'started': 0}
+
+    def release(task_id: str, subdomain: str):
+        task = tasks.pop(task_id, None)
+        study = studies.get(subdomain)
+        if task is not None:
+            if study is not None and task.ip is not None:
+                elbv2.deregister_targets(TargetGroupArn=study.target_group_arn,
+                                         Targets=[{'Id': task.ip, 'Port': config.port}])
+            ecs.stop_task(cluster=config.cluster, task=task.arn, reason=f'Released by {subdomain}')
+        ssm.delete_parameter(Name=task_parameter_prefix + task_id)
+        summary['released'].append(subdomain)
+
+    borrowers = {}
+    for task_id, subdomain in list(assignments.items()):
+        study = studies.get(subdomain)
+        if task_id not in tasks or study is None:
+            release(task_id, subdomain)
+        else:
+            borrowers[subdomain] = tasks[task_id]
+
+    services = {}
+    study_list = list(studies.values())
+    # DescribeServices accepts at most 10 services per call
+    for i in range(0, len(study_list), 10):
+        response = ecs.describe_services(cluster=config.cluster,
+                                         services=[study.service for study in study_list[i:i + 10]])
+        for service in response['services']:
+            services[service['serviceName']] = service
+
+    idle_tasks = [
+        task for task_id, task in tasks.items()
+        if task_id not in assignments and task.status == 'RUNNING' and task.ip is not None
+    ]
+    for study in study_list:
+        service = services.get(study.service)
+        if service is None:
+            continue
+        borrowed = borrowers.get(study.subdomain)
+        wanted = service['desiredCount']
+        healthy = own_healthy_targets(elbv2, study, [borrowed.ip] if borrowed else [])
+        if borrowed is not None:
+            if wanted == 0 or healthy >= wanted:
+                release(borrowed.id, study.subdomain)
+        elif 0 < wanted and healthy < wanted and study.memory_in_MiB <= config.memory_in_MiB and idle_tasks:
+            task = idle_tasks.pop()
+            log.info('Assigning pool task %s to %s', task.id, study.subdomain)
+            ssm.put_parameter(Name=task_parameter_prefix + task.id,
+                              Value=study.subdomain,
+                              Type='String',
+                              Overwrite=True)
+            elbv2.register_targets(TargetGroupArn=study.target_group_arn,
+                                   Targets=[{'Id': task.ip, 'Port': config.port}])
+            summary['assigned'].append(study.subdomain)
+
+    # Tasks that are still starting up count as idle
+    idle = sum(1 for task_id in tasks if task_id not in assignments) - len(summary['assigned'])
+    missing = config.size - idle
+    while missing > 0:
+        # RunTask starts at most 10 tasks per call
+        count = min(missing, 10)
+        ecs.run_task(cluster=config.cluster,
+                     taskDefinition=config.task_definition,
+                     count=count,
+                     launchType='FARGATE',
+                     platformVersion='1.4.0',
+                     startedBy=started_by,
+                     networkConfiguration={
+                         'awsvpcConfiguration': {
+                             'subnets': list(config.subnets),
+                             'securityGroups': list(config.security_groups),
+                             'assignPublicIp': 'DISABLED'
+                         }
+                     })
+        summary['started'] += count
+        missing -= count
+    log.info('Pool summary: %r', summary)
+    return summary
+
+
+def clients():
+    import boto3
+    return dict(ecs=boto3.client('ecs'),
+                ssm=boto3.client('ssm'),
+                elbv2=boto3.client('elbv2'))
+
+
+def manager_handler(event, context):
+    logging.getLogger().setLevel(logging.INFO)
+    return manage(PoolConfig.from_json(os.environ['CELLXGENE_POOL']), **clients())
+
+
+def task_arn() -> str:
+    """
+    The ARN of the ECS task this process is running in
+    """
+    url = os.environ['ECS_CONTAINER_METADATA_URI_V4'] + '/task'
+    with urllib.request.urlopen(url) as response:
+        return json.load(response)['TaskARN']
+
+
+def warm_up():
+    """
+    Import the modules needed for loading and serving a matrix
+    """
+    import anndata  # noqa
+    import h5py  # noqa
+    import gunicorn.app.base  # noqa
+    import server.app.app  # noqa
+    import server.common.app_config  # noqa
+    import server.data_common.matrix_loader  # noqa
+    import server.data_anndata.anndata_adaptor  # noqa
+
+
+def wait_for_assignment(ssm, task_id: str) -> PoolStudy:
+    name = task_parameter_prefix + task_id
+    while True:
+        try:
+            response = ssm.get_parameter(Name=name)
+        except ssm.exceptions.ParameterNotFound:
+            time.sleep(poll_interval)
+        else:
+            subdomain = response['Parameter']['Value']
+            response = ssm.get_parameter(Name=study_parameter_prefix + subdomain)
+            return PoolStudy.from_json(response['Parameter']['Value'])
+
+
+def main(argv: Sequence[str]):
+    import boto3
+    from cellxgene_fargate.launch import (
+        serve_threads,
+        serve_workers,
+    )
+    from cellxgene_fargate.serve import (
+        serve,
+    )
+    from cellxgene_fargate.stage import (
+        local_copy,
+        s3_client,
+    )
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--dest', required=True)
+    parser.add_argument('--cache')
+    parser.add_argument('--vcpu', type=int, default=1024,
+                        help='The vCPU units of the task, for sizing the server')
+    args = parser.parse_args(argv)
+    warm_up()
+    task_id = task_arn().rsplit('/', 1)[1]
+    log.info('Pool task %s waiting for an assignment', task_id)
+    study = wait_for_assignment(boto3.client('ssm'), task_id)
+    log.info('Assigned to %s', study.subdomain)
+    path = local_copy(s3_client(),
+                      bucket=study.bucket,
+                      key=study.key,
+                      dest=args.dest,
+                      size=study.size,
+                      etag=study.etag,
+                      cache=args.cache)
+    serve(path,
+          title=study.title,
+          host='0.0.0.0',
+          port=args.port,
+          workers=serve_workers(args.vcpu),
+          threads=serve_threads)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
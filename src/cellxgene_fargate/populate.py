@@ -0,0 +1,96 @@
+"""
+Populate the shared dataset cache with copies of the given matrix files.
+
+Each object is copied to the path given by its bucket and key relative to the
+cache directory, where `cellxgene_fargate.stage --cache` will find it. Objects
+whose copy already matches in size and ETag are skipped so the job can be
+rerun after every release. Several objects are copied at once, each with several
+concurrent ranged requests.
+
+Usage:
+
+    python -m cellxgene_fargate.populate --dest DIR s3://BUCKET/KEY ...
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import sys
+from typing import (
+    Sequence,
+    Tuple,
+)
+
+from cellxgene_fargate.stage import (
+    cache_path,
+    default_concurrency,
+    default_part_size,
+    s3_client,
+    stage,
+)
+
+log = logging.getLogger(__name__)
+
+
+def parse_url(url: str) -> Tuple[str, str]:
+    """
+    >>> parse_url('s3://foo/bar/baz.h5ad')
+    ('foo', 'bar/baz.h5ad')
+    """
+    scheme, _, path = url.partition('://')
+    assert scheme == 's3', url
+    bucket, _, key = path.partition('/')
+    return bucket, key
+
+
+def populate(s3,
+             objects: Sequence[Tuple[str, str]],
+             cache_dir: str,
+             parallel_files: int,
+             part_size: int = default_part_size,
+             concurrency: int = default_concurrency) -> int:
+    """
+    Copy the given objects into the cache and return the number of objects
+    that were actually copied.
+
+    :param objects: the bucket and key of each object
+    """
+
+    def populate_one(bucket_and_key: Tuple[str, str]) -> bool:
+        bucket, key = bucket_and_key
+        return stage(s3,
+                     bucket=bucket,
+                     key=key,
+                     path=cache_path(cache_dir, bucket, key),
+                     part_size=part_size,
+                     concurrency=concurrency)
+
+    with ThreadPoolExecutor(max_workers=parallel_files) as executor:
+        copied = sum(executor.map(populate_one, objects))
+    log.info('Copied %i of %i objects, skipped %i that were already cached',
+             copied, len(objects), len(objects) - copied)
+    return copied
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dest', required=True)
+    parser.add_argument('--endpoint-url')
+    parser.add_argument('--parallel-files', type=int, default=4)
+    parser.add_argument('--part-size', type=int, default=default_part_size)
+    parser.add_argument('--concurrency', type=int, default=default_concurrency)
+    parser.add_argument('urls', nargs='+', metavar='URL')
+    args = parser.parse_args(argv)
+    s3 = s3_client(args.endpoint_url, args.parallel_files * args.concurrency)
+    populate(s3,
+             objects=list(map(parse_url, args.urls)),
+             cache_dir=args.dest,
+             parallel_files=args.parallel_files,
+             part_size=args.part_size,
+             concurrency=args.concurrency)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,387 @@
+"""
+Extract the latency, status and size of the responses of every study from the
+access log lines its containers write to CloudWatch Logs.
+
+The log stream of a container is named after the study's subdomain, the name
+of the container and the ID of the task. Only the lines of the container the
+load balancer forwards to are counted, the cache proxy if there is one, so that
+requests passed on to cellxgene aren't counted twice. Three formats of access
+log lines are understood: gunicorn's and the cache proxy's, which include the
+bytes sent and the request duration, and the one werkzeug writes when
+`cellxgene launch` runs with `--verbose`, which includes neither. Requests for
+the readiness check of the load balancer are ignored.
+
+The requests are aggregated per study and endpoint, the path of the request up
+to the query, with all static assets counted as `/static` and all paths
+cellxgene doesn't serve as `other`. For every study
+and endpoint, a document in CloudWatch's embedded metric format (EMF) is
+written to stdout, with the number of requests, of client and server errors,
+the bytes sent and the latency of each request. In a Lambda function, which is
+how this module runs when subscribed to the log group, CloudWatch extracts the
+metrics from these documents and computes percentiles of the latency over any
+period.
+
+Given saved log files instead, the module prints a report with the same
+aggregates and the 50th, 90th and 99th percentile of the latency. With
+`--emf`, it prints the EMF documents instead. The study of each file is its
+name without extension unless `--study` is given.
+
+This module is packaged into a Lambda function on its own and must not import
+anything outside the standard library at the module level.
+
+Usage:
+
+    python -m cellxgene_fargate.request_metrics [--study=SUBDOMAIN] [--emf] FILE...
+"""
+import argparse
+import base64
+from datetime import (
+    datetime,
+    timezone,
+)
+import gzip
+import json
+import logging
+import math
+import os
+import re
+import sys
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from dataclasses import (
+    dataclass,
+    field,
+)
+
+log = logging.getLogger(__name__)
+
+JSON = Dict[str, Any]
+
+# The namespace of the metrics in CloudWatch
+namespace = 'cellxgene'
+
+# An EMF document can hold at most this many values of a metric
+max_emf_values = 100
+
+# Not imported from `cellxgene_fargate.launch` to keep the Lambda function small
+readiness_path = '/ready'
+
+# The routes of cellxgene 0.15, from server/app/app.py. Every other path is
+# lumped together, so that the number of endpoints, and therefore of metrics,
+# is bounded.
+api_prefix = '/api/v0.2/'
+api_routes = frozenset([
+    'schema',
+    'config',
+    'userinfo',
+    'annotations/obs',
+    'annotations/var',
+    'data/var',
+    'colors',
+    'diffexp/obs',
+    'layout/obs'
+])
+web_routes = frozenset(['/', '/health', '/favicon.png'])
+
+# The request time, request line, status, bytes sent and, optionally, the user
+# agent and the duration in microseconds
+access_log_re = re.compile(r'\[(?P<time>[^\]]+)\] '
+                           r'"(?P<method>[A-Z]+) (?P<target>\S+) HTTP/[0-9.]+" '
+                           r'(?P<status>\d{3}) (?P<bytes>\d+|-)'
+                           r'(?: "(?:[^"\\]|\\.)*" (?P<duration>\d+))?')
+
+# The formats of the request time of gunicorn and aiohttp and of werkzeug
+time_formats = ('%d/%b/%Y:%H:%M:%S %z', '%d/%b/%Y %H:%M:%S')
+
+
+@dataclass(frozen=True)
+class Request:
+    endpoint: str
+    status: int
+    bytes: int
+    # None if the log line doesn't include the duration
+    latency_ms: Optional[float]
+    # Milliseconds since the epoch, None if the time couldn't be parsed
+    timestamp: Optional[int]
+
+
+def endpoint(target: str) -> Optional[str]:
+    """
+    The endpoint of the given request target, None for the readiness check.
+    Paths that cellxgene doesn't serve are lumped together so that scanners
+    probing for vulnerabilities don't create a metric each.
+
+    >>> endpoint('/api/v0.2/annotations/obs?annotation-name=louvain')
+    '/api/v0.2/annotations/obs'
+    >>> endpoint('/static/main-d2e1.js')
+    '/static'
+    >>> endpoint('/wp-login.php')
+    'other'
+    >>> endpoint('/api/v0.2/../../etc/passwd'), endpoint('/api/v0.1/schema')
+    ('other', 'other')
+    >>> endpoint('/ready') is None
+    True
+    """
+    path = target.split('?', 1)[0]
+    if path == readiness_path:
+        return None
+    elif path.startswith('/static/'):
+        return '/static'
+    elif path in web_routes:
+        return path
+    elif path.startswith(api_prefix) and path[len(api_prefix):] in api_routes:
+        return path
+    else:
+        return 'other'
+
+
+def parse_time(s: str) -> Optional[int]:
+    """
+    >>> parse_time('18/Oct/2026:09:00:00 +0000'), parse_time('18/Oct/2026 09:00:00')
+    (1792314000000, 1792314000000)
+    """
+    for time_format in time_formats:
+        try:
+            t = datetime.strptime(s, time_format)
+        except ValueError:
+            pass
+        else:
+            if t.tzinfo is None:
+                # werkzeug logs the local time, which is UTC in the containers
+                t = t.replace(tzinfo=timezone.utc)
+            return int(t.timestamp() * 1000)
+    return None
+
+
+def parse(line: str) -> Optional[Request]:
+    """
+    The request logged in the given line, or None if it isn't an access log
+    line or logs the readiness check
+
+    >>> parse('10.0.1.5 - - [18/Oct/2026:09:00:00 +0000] "GET /api/v0.2/schema HTTP/1.1" 200 1234 "Mozilla/5.0" 5300')
+    Request(endpoint='/api/v0.2/schema', status=200, bytes=1234, latency_ms=5.3, timestamp=1792314000000)
+    >>> parse('10.0.1.5 - - [18/Oct/2026 09:00:00] "PUT /api/v0.2/data/var HTTP/1.1" 500 -')
+    Request(endpoint='/api/v0.2/data/var', status=500, bytes=0, latency_ms=None, timestamp=1792314000000)
+    >>> parse('Loading data from /data/foo.h5ad') is None
+    True
+    """
+    match = access_log_re.search(line)
+    if match is None:
+        return None
+    endpoint_ = endpoint(match.group('target'))
+    if endpoint_ is None:
+        return None
+    duration = match.group('duration')
+    size = match.group('bytes')
+    return Request(endpoint=endpoint_,
+                   status=int(match.group('status')),
+                   bytes=0 if size == '-' else int(size),
+                   latency_ms=None if duration is None else int(duration) / 1000,
+                   timestamp=parse_time(match.group('time')))
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """
+    The q-th percentile of the given sorted values, by the nearest-rank method
+
+    >>> values = list(range(1, 101))
+    >>> percentile(values, 50), percentile(values, 99), percentile(values, 100)
+    (50, 99, 100)
+    """
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+@dataclass
+class Stats:
+    requests: int = 0
+    client_errors: int = 0
+    server_errors: int = 0
+    bytes: int = 0
+    latencies_ms: List[float] = field(default_factory=list)
+    # The time of the first request, in milliseconds since the epoch
+    timestamp: Optional[int] = None
+
+    def add(self, request: Request):
+        self.requests += 1
+        if 400 <= request.status < 500:
+            self.client_errors += 1
+        elif request.status >= 500:
+            self.server_errors += 1
+        self.bytes += request.bytes
+        if request.latency_ms is not None:
+            self.latencies_ms.append(request.latency_ms)
+        if self.timestamp is None:
+            self.timestamp = request.timestamp
+
+    def percentiles(self, *qs: float) -> Optional[List[float]]:
+        if self.latencies_ms:
+            values = sorted(self.latencies_ms)
+            return [percentile(values, q) for q in qs]
+        else:
+            return None
+
+
+def aggregate(requests: Iterable[Tuple[str, Request]]) -> Dict[Tuple[str, str], Stats]:
+    """
+    The statistics of the given requests by study and endpoint
+    """
+    stats = {}
+    for study, request in requests:
+        key = study, request.endpoint
+        try:
+            s = stats[key]
+        except KeyError:
+            s = stats[key] = Stats()
+        s.add(request)
+    return stats
+
+
+def emf_documents(study: str, endpoint_: str, stats: Stats, timestamp: int) -> List[JSON]:
+    """
+    The EMF documents for the given statistics. Since a document holds a
+    limited number of latencies, there may be several. Only the first one has
+    the counts.
+    """
+
+    def document(metrics: JSON, units: JSON) -> JSON:
+        return {
+            '_aws': {
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [
+                    {
+                        'Namespace': namespace,
+                        'Dimensions': [['Study', 'Endpoint'], ['Study']],
+                        'Metrics': [{'Name': name, 'Unit': units[name]} for name in metrics]
+                    }
+                ]
+            },
+            'Study': study,
+            'Endpoint': endpoint_,
+            **metrics
+        }
+
+    units = {
+        'Requests': 'Count',
+        'ClientErrors': 'Count',
+        'ServerErrors': 'Count',
+        'Bytes': 'Bytes',
+        'Latency': 'Milliseconds'
+    }
+    latencies = stats.latencies_ms
+    documents = [
+        document({
+            'Requests': stats.requests,
+            'ClientErrors': stats.client_errors,
+            'ServerErrors': stats.server_errors,
+            'Bytes': stats.bytes,
+            **({'Latency': latencies[:max_emf_values]} if latencies else {})
+        }, units)
+    ]
+    documents.extend(document({'Latency': latencies[i:i + max_emf_values]}, units)
+                     for i in range(max_emf_values, len(latencies), max_emf_values))
+    return documents
+
+
+def report(stats: Dict[Tuple[str, str], Stats]) -> List[str]:
+    row_format = '{:<32} {:<32} {:>9} {:>7} {:>7} {:>10} {:>9} {:>9} {:>9}'
+    lines = [row_format.format('study', 'endpoint', 'requests', '4xx', '5xx', 'MiB', 'p50 ms', 'p90 ms', 'p99 ms')]
+    for (study, endpoint_), s in sorted(stats.items()):
+        percentiles = s.percentiles(50, 90, 99)
+        lines.append(row_format.format(study,
+                                       endpoint_,
+                                       s.requests,
+                                       s.client_errors,
+                                       s.server_errors,
+                                       f'{s.bytes / 1024 / 1024:.1f}',
+                                       *(['-'] * 3 if percentiles is None else [f'{p:.1f}' for p in percentiles])))
+    return lines
+
+
+def parse_stream(stream: str, frontend: str) -> Optional[str]:
+    """
+    The study whose frontend container writes to the given log stream, None
+    if the stream belongs to another container
+
+    >>> parse_stream('2020-mar-foo/cache-proxy/0123abcd', 'cache-proxy')
+    '2020-mar-foo'
+    >>> parse_stream('2020-mar-foo/cache-proxy-1/0123abcd', 'cache-proxy')
+    '2020-mar-foo'
+    >>> parse_stream('2020-mar-foo/cellxgene/0123abcd', 'cache-proxy') is None
+    True
+    """
+    study, _, rest = stream.partition('/')
+    container = rest.partition('/')[0]
+    if re.fullmatch(re.escape(frontend) + r'(-\d+)?', container):
+        return study
+    else:
+        return None
+
+
+def handler(event, context):
+    """
+    Receives batches of log events from a subscription filter on the log
+    group of the containers
+    """
+    logging.getLogger().setLevel(logging.INFO)
+    data = json.loads(gzip.decompress(base64.b64decode(event['awslogs']['data'])))
+    if data['messageType'] != 'DATA_MESSAGE':
+        return
+    study = parse_stream(data['logStream'], os.environ['CELLXGENE_FRONTEND_CONTAINER'])
+    if study is None:
+        return
+    requests = []
+    for log_event in data['logEvents']:
+        request = parse(log_event['message'])
+        if request is not None:
+            # The time of the event is more reliable than the one in the line
+            requests.append((study, Request(endpoint=request.endpoint,
+                                            status=request.status,
+                                            bytes=request.bytes,
+                                            latency_ms=request.latency_ms,
+                                            timestamp=log_event['timestamp'])))
+    for (study, endpoint_), stats in aggregate(requests).items():
+        for document in emf_documents(study, endpoint_, stats, stats.timestamp):
+            print(json.dumps(document))
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--study', help='The subdomain of the study all files belong to')
+    parser.add_argument('--emf', action='store_true',
+                        help='Print the EMF documents instead of a report')
+    parser.add_argument('files', nargs='+', metavar='FILE')
+    args = parser.parse_args(argv)
+
+    def requests():
+        for path in args.files:
+            study = args.study or os.path.splitext(os.path.basename(path))[0]
+            with open(path) as f:
+                for line in f:
+                    request = parse(line)
+                    if request is not None:
+                        yield study, request
+
+    stats = aggregate(requests())
+    if args.emf:
+        now = int(datetime.now(timezone.utc).timestamp() * 1000)
+        for (study, endpoint_), s in sorted(stats.items()):
+            for document in emf_documents(study, endpoint_, s, now if s.timestamp is None else s.timestamp):
+                print(json.dumps(document))
+    else:
+        for line in report(stats):
+            print(line)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
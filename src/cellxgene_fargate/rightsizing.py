@@ -0,0 +1,363 @@
+"""
+Size the task of each study by the memory and CPU its containers were
+observed to use, instead of by the memory predicted for its matrix.
+
+The usage is taken from the Container Insights metrics of the study's
+service, over a window of up to two weeks. These metrics are the sum over the
+service's tasks, so only the minutes and hours in which the service ran
+exactly one task are considered: the highest memory used in any such minute,
+and the highest CPU used in any such hour, averaged over the hour so that the
+burst while loading the matrix doesn't dominate. Studies whose scaling policy
+keeps more than one task running are therefore never sized this way, and
+neither are studies packed with others, see `cellxgene_fargate.packing`.
+The observations are kept in a file of their own, so that recommendations can
+be repeated and examined offline:
+
+    {
+        "start": "2020-10-01T00:00:00+00:00",
+        "end": "2020-10-15T00:00:00+00:00",
+        "studies": {
+            "2020-mar-foo": {
+                "etag": "...",
+                "vcpu": 1024,
+                "memory_in_MiB": 8192,
+                "max_memory_MiB": 3150.5,
+                "max_cpu_units": 180.2,
+                "hours": 336
+            }
+        }
+    }
+
+The recommended task has the observed peaks plus a headroom, and at least as
+many vCPUs as the sizing model requires for loading the matrix in time, see
+`cellxgene_fargate.sizing`. A task can't use more memory than it has, so the
+recommendation for a task that used all of it is larger by the headroom.
+Recommendations that differ from the prediction are written to the overrides
+file configured in CELLXGENE_SIZING_OVERRIDES, which the Terraform template
+honors until the study's matrix file changes. The report printed alongside
+shows the change in the hourly cost of the cluster.
+
+Usage:
+
+    python -m cellxgene_fargate.rightsizing --fetch --observations=FILE [--days=N]
+    python -m cellxgene_fargate.rightsizing --observations=FILE [--output=FILE]
+"""
+import argparse
+from datetime import (
+    datetime,
+    timedelta,
+    timezone,
+)
+import json
+import logging
+import math
+import sys
+from typing import (
+    Dict,
+    List,
+    Mapping,
+    Sequence,
+)
+
+from dataclasses import (
+    asdict,
+    dataclass,
+)
+
+from cellxgene_fargate.fargate import (
+    FargateSpec,
+)
+from cellxgene_fargate.h5ad import (
+    load_info,
+)
+from cellxgene_fargate.manifest import (
+    Manifest,
+)
+from cellxgene_fargate.matrix import (
+    MatrixFile,
+    load_optimized,
+    matrix_files,
+)
+from cellxgene_fargate.scaling import (
+    ScalingPolicies,
+)
+from cellxgene_fargate.sizing import (
+    SizingOverride,
+    load_overrides,
+    overrides_path,
+    save_overrides,
+)
+
+log = logging.getLogger(__name__)
+
+# The fraction by which the recommended memory and CPU exceed the observed
+# peaks
+default_headroom = 0.25
+
+# The number of hours a study must have been observed for to be sized by its
+# usage
+default_min_hours = 24
+
+# Metrics at a resolution of one minute are kept for 15 days
+max_days = 14
+
+
+@dataclass(frozen=True)
+class Observation:
+    # The ETag of the matrix file and the size of the task while observing
+    etag: str
+    vcpu: int
+    memory_in_MiB: int
+    # The highest memory used in any minute in which the study had one task
+    max_memory_MiB: float
+    # The highest CPU used in any hour in which the study had one task, in
+    # units of 1/1024 vCPU
+    max_cpu_units: float
+    # The number of hours in which the study had one task throughout
+    hours: int
+
+
+def load_observations(path: str) -> Dict[str, Observation]:
+    with open(path) as f:
+        observations = json.load(f)
+    return {
+        subdomain: Observation(**observation)
+        for subdomain, observation in observations['studies'].items()
+    }
+
+
+def save_observations(path: str, start: datetime, end: datetime, observations: Mapping[str, Observation]):
+    with open(path, 'w') as f:
+        json.dump({
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'studies': {subdomain: asdict(o) for subdomain, o in sorted(observations.items())}
+        }, f, indent=4)
+        f.write('\n')
+
+
+def service_name(m: MatrixFile) -> str:
+    # Not imported from `cellxgene_fargate.packing` to not depend on whether
+    # packing is enabled
+    return 'cellxgene-' + m.subdomain
+
+
+def single_task_values(values: Mapping[str, Mapping[datetime, float]], metric: str) -> List[float]:
+    """
+    The values of the given metric in the periods in which the service ran
+    exactly one task throughout
+
+    >>> t1, t2, t3 = (datetime(2020, 10, 1, h, tzinfo=timezone.utc) for h in range(3))
+    >>> single_task_values({
+    ...     'memory': {t1: 100.0, t2: 300.0, t3: 150.0},
+    ...     'memory_min_tasks': {t1: 1.0, t2: 1.0, t3: 1.0},
+    ...     'memory_max_tasks': {t1: 1.0, t2: 2.0, t3: 1.0}
+    ... }, 'memory')
+    [100.0, 150.0]
+    """
+    min_tasks, max_tasks = values[metric + '_min_tasks'], values[metric + '_max_tasks']
+    return [
+        value
+        for timestamp, value in sorted(values[metric].items())
+        if min_tasks.get(timestamp) == 1 and max_tasks.get(timestamp) == 1
+    ]
+
+
+def fetch_observations(cloudwatch,
+                       files: Sequence[MatrixFile],
+                       start: datetime,
+                       end: datetime) -> Dict[str, Observation]:
+    """
+    The usage of the given studies in the given period, from the Container
+    Insights metrics of their services. A service's metrics are summed over
+    its tasks, and the number of tasks changes within a period, so dividing
+    by the average number of tasks would yield the average task, not the
+    largest one. Only periods with a single task are used instead.
+    """
+
+    def metric(id_, name, statistic, period, dimensions):
+        return {
+            'Id': id_,
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': 'ECS/ContainerInsights',
+                    'MetricName': name,
+                    'Dimensions': dimensions
+                },
+                'Period': period,
+                'Stat': statistic
+            },
+            'ReturnData': True
+        }
+
+    observations = {}
+    for m in files:
+        dimensions = [
+            {'Name': 'ClusterName', 'Value': 'cellxgene'},
+            {'Name': 'ServiceName', 'Value': service_name(m)}
+        ]
+        queries = [
+            metric('memory', 'MemoryUtilized', 'Maximum', 60, dimensions),
+            metric('memory_min_tasks', 'RunningTaskCount', 'Minimum', 60, dimensions),
+            metric('memory_max_tasks', 'RunningTaskCount', 'Maximum', 60, dimensions),
+            metric('cpu', 'CpuUtilized', 'Average', 3600, dimensions),
+            metric('cpu_min_tasks', 'RunningTaskCount', 'Minimum', 3600, dimensions),
+            metric('cpu_max_tasks', 'RunningTaskCount', 'Maximum', 3600, dimensions)
+        ]
+        values = {query['Id']: {} for query in queries}
+        kwargs = {}
+        while True:
+            response = cloudwatch.get_metric_data(MetricDataQueries=queries,
+                                                  StartTime=start,
+                                                  EndTime=end,
+                                                  **kwargs)
+            for result in response['MetricDataResults']:
+                values[result['Id']].update(zip(result['Timestamps'], result['Values']))
+            try:
+                kwargs['NextToken'] = response['NextToken']
+            except KeyError:
+                break
+        memory = single_task_values(values, 'memory')
+        cpu = single_task_values(values, 'cpu')
+        if memory and cpu:
+            spec = m.fargate_specs
+            observations[m.subdomain] = Observation(etag=m.etag,
+                                                    vcpu=spec.vcpu,
+                                                    memory_in_MiB=spec.memory_in_MiB,
+                                                    max_memory_MiB=max(memory),
+                                                    max_cpu_units=max(cpu),
+                                                    hours=len(cpu))
+        else:
+            log.info('No metrics for %s with a single task', service_name(m))
+    return observations
+
+
+def recommend(observation: Observation, headroom: float, min_vcpu: int) -> FargateSpec:
+    """
+    The cheapest task with the observed peaks plus the given headroom
+
+    >>> o = Observation(etag='', vcpu=2048, memory_in_MiB=8192, max_memory_MiB=3000, max_cpu_units=300, hours=100)
+    >>> recommend(o, 0.25, 0)
+    FargateSpec(vcpu=512, memory_in_MiB=4096)
+    >>> recommend(o, 0.25, 1024)
+    FargateSpec(vcpu=1024, memory_in_MiB=4096)
+
+    A task that was out of memory gets more.
+
+    >>> recommend(Observation(etag='', vcpu=512, memory_in_MiB=1024, max_memory_MiB=1024, max_cpu_units=100, hours=100),
+    ...           0.25, 0)
+    FargateSpec(vcpu=256, memory_in_MiB=2048)
+    """
+    memory = math.ceil(observation.max_memory_MiB * (1 + headroom))
+    vcpu = math.ceil(observation.max_cpu_units * (1 + headroom))
+    spec = FargateSpec.for_required_memory(memory, min_vcpu=max(vcpu, min_vcpu))
+    return FargateSpec(vcpu=observation.vcpu, memory_in_MiB=observation.memory_in_MiB) if spec is None else spec
+
+
+def rightsize(files: Sequence[MatrixFile],
+              observations: Mapping[str, Observation],
+              overrides: Mapping[str, SizingOverride],
+              headroom: float,
+              min_hours: int) -> Dict[str, SizingOverride]:
+    """
+    The overrides for the given studies. Studies observed for long enough
+    get a new override unless the recommendation matches the prediction.
+    Existing overrides of other studies are kept unless their matrix file
+    changed.
+    """
+    result = {}
+    for m in files:
+        observation = observations.get(m.subdomain)
+        if observation is not None and observation.etag == m.etag and observation.hours >= min_hours:
+            spec = recommend(observation, headroom, m.required_vcpu)
+            if spec != m.estimated_fargate_specs:
+                result[m.subdomain] = SizingOverride(etag=m.etag,
+                                                     vcpu=spec.vcpu,
+                                                     memory_in_MiB=spec.memory_in_MiB)
+        else:
+            override = overrides.get(m.subdomain)
+            if override is not None and override.etag == m.etag:
+                result[m.subdomain] = override
+    return result
+
+
+def report(files: Sequence[MatrixFile], overrides: Mapping[str, SizingOverride]) -> List[str]:
+    """
+    The studies whose size changes and the change in the totals of the cost
+    report of the Terraform template
+    """
+    policies = ScalingPolicies.load()
+
+    def spec(m: MatrixFile) -> FargateSpec:
+        override = overrides.get(m.subdomain)
+        return m.estimated_fargate_specs if override is None else override.fargate_specs
+
+    row_fmt = '{:<45} | {:<13} | {:<13} | {:>10}'
+    lines = [row_fmt.format('container', 'current', 'recommended', 'change')]
+    for m in files:
+        old, new = m.fargate_specs, spec(m)
+        if old != new:
+            lines.append(row_fmt.format(m.study_name,
+                                        f'{old.vcpu / 1024:g} / {old.memory_in_MiB / 1024:g}',
+                                        f'{new.vcpu / 1024:g} / {new.memory_in_MiB / 1024:g}',
+                                        f'${sum(new.cost_per_hour) - sum(old.cost_per_hour):+.4f}'))
+    for label, replicas in [
+        ('Total', lambda m: 1),
+        ('Total with every study scaled to its min capacity', lambda m: policies[m.subdomain].min_capacity),
+        ('Total with every study scaled to its max capacity', lambda m: policies[m.subdomain].max_capacity)
+    ]:
+        old = sum(replicas(m) * sum(m.fargate_specs.cost_per_hour) for m in files)
+        new = sum(replicas(m) * sum(spec(m).cost_per_hour) for m in files)
+        change = f' ({(new / old - 1) * 100:+.0f}%)' if old else ''
+        lines.append(f'{label}: ${old:.4} -> ${new:.4}{change}')
+    return lines
+
+
+def load_matrix_files() -> List[MatrixFile]:
+    manifest = Manifest.load()
+    return matrix_files(manifest, load_info(manifest), load_optimized(manifest))
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--observations', required=True,
+                        help='The file with the usage observed for each study')
+    parser.add_argument('--fetch', action='store_true',
+                        help='Fetch the usage from CloudWatch and write it to the observations file')
+    parser.add_argument('--days', type=int, default=max_days,
+                        help='The number of days of usage to fetch')
+    parser.add_argument('--headroom', type=float, default=default_headroom,
+                        help='The fraction by which to exceed the observed peaks')
+    parser.add_argument('--min-hours', type=int, default=default_min_hours,
+                        help='The number of hours a study must have been observed for')
+    parser.add_argument('--output',
+                        help='The file to write the overrides to, typically the one configured in '
+                             'CELLXGENE_SIZING_OVERRIDES. Without it, only the report is printed.')
+    args = parser.parse_args(argv)
+    if not 0 < args.days <= max_days:
+        parser.error(f'--days must be between 1 and {max_days}')
+    files = load_matrix_files()
+    if args.fetch:
+        import boto3
+        end = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        start = end - timedelta(days=args.days)
+        observations = fetch_observations(boto3.client('cloudwatch'), files, start, end)
+        save_observations(args.observations, start, end, observations)
+        log.info('Fetched %i days of usage for %i studies', args.days, len(observations))
+    else:
+        overrides = rightsize(files,
+                              load_observations(args.observations),
+                              load_overrides(overrides_path()),
+                              headroom=args.headroom,
+                              min_hours=args.min_hours)
+        for line in report(files, overrides):
+            print(line)
+        if args.output:
+            save_overrides(args.output, overrides)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
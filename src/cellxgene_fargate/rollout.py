@@ -0,0 +1,383 @@
+"""
+Roll the services of the studies forward to the latest revisions of their task
+definitions, a few services at a time.
+
+Changing the containers of every study at once, by bumping CELLXGENE_VERSION
+for example, has Terraform update every service at once. With
+CELLXGENE_ROLLOUT=1, Terraform only registers the new revisions of the task
+definitions and leaves updating the services to this tool.
+
+The services are updated in batches, smallest studies first, so that a broken
+image is noticed on the studies that are quickest to start. A batch is done
+once every service in it runs the new revision alone, with as many running
+tasks as it wants, and all of its targets in the load balancer are healthy.
+Only then is the next batch started. If a service doesn't get there within its
+health check grace period plus the given timeout, or if too many of its new
+tasks stop, the rollout stops and every service updated by it is rolled back to
+the revision it ran before. Requests throttled by ECS or the load balancer are
+retried with exponential backoff.
+
+The services, their task definition families and the size of their matrix
+files are read from the `rollout` output of the shared Terraform component, or
+from a file with the same content. For trying the rollout locally, point the
+tool at a stand-in for ECS and ELB, such as moto's server, with
+`--endpoint-url`.
+
+Usage:
+
+    python -m cellxgene_fargate.rollout [--batch-size=N] [--timeout=SECONDS] \
+        [--plan=FILE] [--endpoint-url=URL] [--dry-run]
+"""
+import argparse
+from datetime import (
+    datetime,
+    timezone,
+)
+import json
+import logging
+import random
+import sys
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from botocore.exceptions import (
+    ClientError,
+)
+from dataclasses import dataclass
+
+log = logging.getLogger(__name__)
+
+JSON = Dict[str, Any]
+
+# The error codes with which AWS APIs reject requests exceeding a rate limit
+throttling_errors = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded'
+])
+
+# DescribeServices accepts at most this many services per request
+describe_services_limit = 10
+
+# The attributes of a task definition needed to register a copy of it
+task_definition_attributes = (
+    'family',
+    'taskRoleArn',
+    'executionRoleArn',
+    'networkMode',
+    'containerDefinitions',
+    'volumes',
+    'placementConstraints',
+    'requiresCompatibilities',
+    'cpu',
+    'memory'
+)
+
+
+@dataclass(frozen=True)
+class Service:
+    name: str
+    # The family of the service's task definition
+    family: str
+    # The total size of the matrix files served by the service, in bytes
+    size: int
+    # The number of seconds the service's new tasks may take to become healthy
+    grace_period: int
+
+
+def load_plan(plan: str) -> Tuple[str, List[Service]]:
+    """
+    The cluster and the services in the given JSON, as emitted by the
+    Terraform template
+
+    >>> load_plan('{"cluster": "c", "services": [{"name": "a", "family": "b", "size": 1, "grace_period": 60}]}')
+    ('c', [Service(name='a', family='b', size=1, grace_period=60)])
+    """
+    plan = json.loads(plan)
+    return plan['cluster'], [Service(**service) for service in plan['services']]
+
+
+def batches(services: Sequence[Service], batch_size: int) -> List[List[Service]]:
+    """
+    >>> services = [Service(name=n, family=n, size=s, grace_period=0) for n, s in [('a', 3), ('b', 1), ('c', 2)]]
+    >>> [[s.name for s in batch] for batch in batches(services, 2)]
+    [['b', 'c'], ['a']]
+    """
+    ordered = sorted(services, key=lambda s: (s.size, s.name))
+    return [ordered[i:i + batch_size] for i in range(0, len(ordered), batch_size)]
+
+
+def backoff_seconds(attempt: int, base: float = 1, cap: float = 30) -> float:
+    """
+    The delay before retrying a throttled request for the given attempt, with
+    full jitter
+
+    >>> 0 <= backoff_seconds(0) <= 1, 0 <= backoff_seconds(10) <= 30
+    (True, True)
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RolloutFailed(Exception):
+    pass
+
+
+class Rollout:
+
+    def __init__(self,
+                 ecs,
+                 elbv2,
+                 cluster: str,
+                 timeout: float,
+                 poll_interval: float = 15,
+                 max_failed_tasks: int = 3,
+                 max_attempts: int = 8,
+                 sleep: Callable[[float], None] = time.sleep,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ecs = ecs
+        self.elbv2 = elbv2
+        self.cluster = cluster
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_failed_tasks = max_failed_tasks
+        self.max_attempts = max_attempts
+        self.sleep = sleep
+        self.clock = clock
+
+    def _call(self, method: Callable, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return method(**kwargs)
+            except ClientError as e:
+                attempt += 1
+                if e.response['Error']['Code'] not in throttling_errors or attempt == self.max_attempts:
+                    raise
+                delay = backoff_seconds(attempt)
+                log.info('Throttled, retrying %s in %.1fs', method.__name__, delay)
+                self.sleep(delay)
+
+    def describe(self, names: Sequence[str]) -> Dict[str, JSON]:
+        services = {}
+        for i in range(0, len(names), describe_services_limit):
+            response = self._call(self.ecs.describe_services,
+                                  cluster=self.cluster,
+                                  services=names[i:i + describe_services_limit])
+            if response['failures']:
+                raise RolloutFailed(f"Failed to describe services: {response['failures']}")
+            services.update((service['serviceName'], service) for service in response['services'])
+        return services
+
+    def latest_revision(self, family: str) -> str:
+        response = self._call(self.ecs.describe_task_definition, taskDefinition=family)
+        return response['taskDefinition']['taskDefinitionArn']
+
+    def plan(self, services: Sequence[Service], batch_size: int) -> List[Dict[str, Tuple[str, str]]]:
+        """
+        The services to be updated in each batch, mapped to their current and
+        latest revision. Services that already run the latest revision are
+        left out, and so are batches without a service to update.
+        """
+        result = []
+        for batch in batches(services, batch_size):
+            current = self.describe([service.name for service in batch])
+            updates = {}
+            for service in batch:
+                old = current[service.name]['taskDefinition']
+                new = self.latest_revision(service.family)
+                if old != new:
+                    updates[service.name] = (old, new)
+            if updates:
+                result.append(updates)
+        return result
+
+    def run(self, services: Sequence[Service], batch_size: int):
+        grace_periods = {service.name: service.grace_period for service in services}
+        # The revisions the updated services ran before, for rolling back
+        previous = {}
+        for batch in batches(services, batch_size):
+            current = self.describe([service.name for service in batch])
+            updates = {}
+            for service in batch:
+                new = self.latest_revision(service.family)
+                if current[service.name]['taskDefinition'] != new:
+                    updates[service.name] = new
+            if not updates:
+                continue
+            log.info('Rolling out %s', ', '.join(updates))
+            since = datetime.now(timezone.utc)
+            try:
+                for name, task_definition in updates.items():
+                    previous[name] = current[name]['taskDefinition']
+                    self.update(name, task_definition)
+                self.wait(updates, since, max(grace_periods[name] for name in updates))
+            except (RolloutFailed, ClientError) as e:
+                log.error('Rollout failed: %s', e)
+                self.roll_back(previous, grace_periods)
+                raise
+            log.info('Rolled out %s', ', '.join(updates))
+
+    def update(self, name: str, task_definition: str):
+        log.info('Updating %s to %s', name, task_definition)
+        self._call(self.ecs.update_service,
+                   cluster=self.cluster,
+                   service=name,
+                   taskDefinition=task_definition)
+
+    def wait(self, task_definitions: Mapping[str, str], since: datetime, grace_period: int):
+        """
+        Wait for the given services to run the given revisions and nothing else
+        """
+        deadline = self.clock() + grace_period + self.timeout
+        pending = dict(task_definitions)
+        while True:
+            for name, service in self.describe(list(pending)).items():
+                reason = self.status(service, pending[name], since)
+                if reason is None:
+                    log.info('%s is running %s', name, pending.pop(name))
+                else:
+                    log.info('Waiting for %s: %s', name, reason)
+            if not pending:
+                break
+            elif self.clock() > deadline:
+                raise RolloutFailed(f"Timed out waiting for {', '.join(pending)}")
+            else:
+                self.sleep(self.poll_interval)
+
+    def status(self, service: JSON, task_definition: str, since: datetime) -> Optional[str]:
+        """
+        None if the given service runs the given revision and all of its targets
+        are healthy, or what it is waiting for otherwise
+        """
+        name = service['serviceName']
+        deployments = service['deployments']
+        primary = next(d for d in deployments if d['status'] == 'PRIMARY')
+        if primary['taskDefinition'] != task_definition:
+            raise RolloutFailed(f"{name} was updated to {primary['taskDefinition']} by someone else")
+        failed = self.failed_tasks(name, task_definition, since)
+        if failed > self.max_failed_tasks:
+            raise RolloutFailed(f'{failed} new tasks of {name} stopped')
+        if len(deployments) > 1:
+            return f'{len(deployments) - 1} older deployments still active'
+        if primary['runningCount'] < primary['desiredCount']:
+            return f"{primary['runningCount']} of {primary['desiredCount']} tasks running"
+        for load_balancer in service.get('loadBalancers', []):
+            response = self._call(self.elbv2.describe_target_health,
+                                  TargetGroupArn=load_balancer['targetGroupArn'])
+            states = [target['TargetHealth']['State'] for target in response['TargetHealthDescriptions']]
+            unhealthy = sum(state not in ('healthy', 'draining') for state in states)
+            if unhealthy:
+                return f"{unhealthy} targets not yet healthy in {load_balancer['targetGroupArn']}"
+        return None
+
+    def failed_tasks(self, name: str, task_definition: str, since: datetime) -> int:
+        """
+        The number of tasks of the given service and revision that stopped
+        since the given time
+        """
+        task_arns = self._call(self.ecs.list_tasks,
+                               cluster=self.cluster,
+                               serviceName=name,
+                               desiredStatus='STOPPED')['taskArns']
+        if not task_arns:
+            return 0
+        tasks = self._call(self.ecs.describe_tasks, cluster=self.cluster, tasks=task_arns[:100])['tasks']
+        return sum(task['taskDefinitionArn'] == task_definition and task['createdAt'] >= since
+                   for task in tasks)
+
+    def active_revision(self, task_definition: str) -> str:
+        """
+        The given revision or, if Terraform deregistered it, a copy of it. ECS
+        can't start new tasks from a deregistered revision.
+        """
+        response = self._call(self.ecs.describe_task_definition, taskDefinition=task_definition)
+        description = response['taskDefinition']
+        if description['status'] == 'ACTIVE':
+            return task_definition
+        else:
+            response = self._call(self.ecs.register_task_definition, **{
+                k: description[k] for k in task_definition_attributes if k in description
+            })
+            copy = response['taskDefinition']['taskDefinitionArn']
+            log.info('Registered %s as a copy of the inactive %s', copy, task_definition)
+            return copy
+
+    def roll_back(self, task_definitions: Mapping[str, str], grace_periods: Mapping[str, int]):
+        """
+        Update the given services back to the given revisions and wait for
+        them, logging rather than raising any failure
+        """
+        if not task_definitions:
+            return
+        log.info('Rolling back %s', ', '.join(task_definitions))
+        try:
+            since = datetime.now(timezone.utc)
+            restored = {}
+            for name, task_definition in task_definitions.items():
+                restored[name] = self.active_revision(task_definition)
+                self.update(name, restored[name])
+            self.wait(restored, since, max(grace_periods[name] for name in restored))
+        except (RolloutFailed, ClientError) as e:
+            log.error('Rollback failed: %s', e)
+        else:
+            log.info('Rolled back %s', ', '.join(task_definitions))
+
+
+def main(argv: Sequence[str]):
+    import boto3
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=4,
+                        help='The number of services to update at a time')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='The number of seconds to wait for a batch beyond its health check grace period')
+    parser.add_argument('--poll-interval', type=float, default=15,
+                        help='The number of seconds between checks of the services being updated')
+    parser.add_argument('--plan',
+                        help='A JSON file with the services to roll out, instead of the output of the shared '
+                             'Terraform component')
+    parser.add_argument('--endpoint-url',
+                        help='The URL of a stand-in for the ECS and ELB APIs')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only list the services that would be updated')
+    args = parser.parse_args(argv)
+    if args.plan is None:
+        from azul import config
+        from cellxgene_fargate.components import state_outputs
+        outputs = state_outputs(boto3.client('s3'), config.terraform_backend_bucket, '')
+        assert outputs is not None and 'rollout' in outputs, 'Apply the shared component with CELLXGENE_ROLLOUT=1'
+        cluster, services = load_plan(outputs['rollout'])
+    else:
+        with open(args.plan) as f:
+            cluster, services = load_plan(f.read())
+    rollout = Rollout(ecs=boto3.client('ecs', endpoint_url=args.endpoint_url),
+                      elbv2=boto3.client('elbv2', endpoint_url=args.endpoint_url),
+                      cluster=cluster,
+                      timeout=args.timeout,
+                      poll_interval=args.poll_interval)
+    if args.dry_run:
+        for i, batch in enumerate(rollout.plan(services, args.batch_size)):
+            for name, (old, new) in batch.items():
+                print(f'Batch {i + 1}: {name} {old} -> {new}')
+    else:
+        try:
+            rollout.run(services, args.batch_size)
+        except (RolloutFailed, ClientError):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,299 @@
+"""
+A reverse proxy that routes requests to the studies by their Host header.
+
+By default, the load balancer routes the requests for each study with a
+listener rule of its own to a target group of its own. A listener has room
+for at most 100 rules, and every study added to a release changes the load
+balancer. In routing mode, the load balancer forwards all requests for the
+studies to a service running this proxy instead. The proxy takes the study's
+subdomain from the first label of the Host header and forwards the request to
+one of the study's tasks.
+
+The proxy discovers the tasks of each study in a Cloud Map namespace with
+which ECS registers them. Only tasks that pass their container health check
+are returned by Cloud Map. The addresses are refreshed every few seconds in
+the background, so looking them up doesn't delay a request. Connections to the
+tasks are pooled and kept alive between requests.
+
+If a study has several tasks, the proxy keeps each client on the same task
+with a cookie, the way the load balancer does with its stickiness cookie.
+Rendezvous hashing moves as few clients as possible when tasks come and go.
+
+For trying the proxy locally, the backends of each study can be given on the
+command line instead, typically instances of `cellxgene_fargate.stub`.
+
+Usage:
+
+    python -m cellxgene_fargate.router --port=PORT \
+        --namespace=NAMESPACE --routes=JSON
+
+    python -m cellxgene_fargate.router --port=PORT \
+        --backend=SUBDOMAIN=http://127.0.0.1:BACKEND_PORT ...
+"""
+from abc import (
+    ABC,
+    abstractmethod,
+)
+import argparse
+import asyncio
+from collections import defaultdict
+import hashlib
+import json
+import logging
+import secrets
+import sys
+from typing import (
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import aiohttp
+from aiohttp import web
+from dataclasses import (
+    asdict,
+    dataclass,
+)
+
+from cellxgene_fargate.cache_proxy import (
+    forwarded_headers,
+)
+from cellxgene_fargate.launch import (
+    readiness_path,
+)
+
+log = logging.getLogger(__name__)
+
+# The cookie that keeps a client on the same task of a study
+sticky_cookie = 'cellxgene-router'
+sticky_cookie_max_age = 24 * 3600
+
+chunk_size = 64 * 1024
+
+
+@dataclass(frozen=True)
+class Route:
+    # The name of the Cloud Map service with which the tasks serving the study
+    # are registered
+    service: str
+    # The port of the study's container in those tasks
+    port: int
+
+
+def routes_to_json(routes: Mapping[str, Route]) -> str:
+    return json.dumps({subdomain: asdict(route) for subdomain, route in routes.items()})
+
+
+def routes_from_json(s: str) -> Dict[str, Route]:
+    return {subdomain: Route(**route) for subdomain, route in json.loads(s).items()}
+
+
+class Registry(ABC):
+    """
+    The base URLs of the backends of each study
+    """
+
+    @abstractmethod
+    def backends(self, subdomain: str) -> Optional[Sequence[str]]:
+        """
+        The backends of the given study or None if there is no such study
+        """
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class StaticRegistry(Registry):
+
+    def __init__(self, backends: Mapping[str, Sequence[str]]):
+        self._backends = backends
+
+    def backends(self, subdomain: str) -> Optional[Sequence[str]]:
+        return self._backends.get(subdomain)
+
+
+class CloudMapRegistry(Registry):
+
+    def __init__(self, client, namespace: str, routes: Mapping[str, Route], refresh_seconds: float = 5):
+        self.client = client
+        self.namespace = namespace
+        self.routes = routes
+        self.refresh_seconds = refresh_seconds
+        self._backends: Dict[str, List[str]] = {}
+        self._refresher: Optional[asyncio.Future] = None
+
+    def backends(self, subdomain: str) -> Optional[Sequence[str]]:
+        if subdomain in self.routes:
+            return self._backends.get(subdomain, [])
+        else:
+            return None
+
+    def _discover(self, route: Route) -> List[str]:
+        # A Boto3 client can be shared between threads
+        response = self.client.discover_instances(NamespaceName=self.namespace,
+                                                  ServiceName=route.service,
+                                                  HealthStatus='HEALTHY',
+                                                  MaxResults=100)
+        return sorted(f"http://{instance['Attributes']['AWS_INSTANCE_IPV4']}:{route.port}"
+                      for instance in response['Instances'])
+
+    async def refresh(self):
+        loop = asyncio.get_event_loop()
+        subdomains = list(self.routes.keys())
+        results = await asyncio.gather(*(
+            loop.run_in_executor(None, self._discover, self.routes[subdomain])
+            for subdomain in subdomains
+        ), return_exceptions=True)
+        for subdomain, result in zip(subdomains, results):
+            if isinstance(result, Exception):
+                # Keep the backends from the last successful refresh
+                log.warning('Failed to discover the backends of %s: %s', subdomain, result)
+            else:
+                self._backends[subdomain] = result
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            await self.refresh()
+
+    async def start(self):
+        await self.refresh()
+        self._refresher = asyncio.ensure_future(self._refresh_periodically())
+
+    async def stop(self):
+        self._refresher.cancel()
+
+
+def pick_backend(backends: Sequence[str], token: str) -> str:
+    """
+    The backend for the client with the given token. Adding or removing a
+    backend only moves the clients of that backend.
+
+    >>> backends = [f'http://10.0.0.{i}:5005' for i in range(3)]
+    >>> tokens = [str(i) for i in range(100)]
+    >>> picks = [pick_backend(backends, token) for token in tokens]
+    >>> len(set(picks))
+    3
+    >>> moved = [pick_backend(backends[:2], token) != pick for token, pick in zip(tokens, picks)]
+    >>> all(pick == backends[2] for pick, m in zip(picks, moved) if m)
+    True
+    """
+    return max(backends, key=lambda backend: hashlib.sha256(f'{token} {backend}'.encode()).digest())
+
+
+class Router:
+
+    def __init__(self, registry: Registry, connections_per_backend: int = 32):
+        self.registry = registry
+        self.connections_per_backend = connections_per_backend
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self, app: web.Application):
+        # Stays below the keep-alive timeout of the backends so that the
+        # router doesn't reuse connections the backends are about to close
+        connector = aiohttp.TCPConnector(limit=0,
+                                         limit_per_host=self.connections_per_backend,
+                                         keepalive_timeout=30)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             auto_decompress=False,
+                                             timeout=aiohttp.ClientTimeout(total=None))
+        await self.registry.start()
+
+    async def stop(self, app: web.Application):
+        await self.registry.stop()
+        await self.session.close()
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        subdomain = request.host.split('.', 1)[0].lower()
+        backends = self.registry.backends(subdomain)
+        if backends is None:
+            if request.path == readiness_path:
+                # The health check of the load balancer, which uses the address
+                # of the router as the Host header
+                return web.Response(text='ready\n', headers={'Cache-Control': 'no-store'})
+            raise web.HTTPNotFound(text=f'No such study: {request.host}')
+        elif not backends:
+            raise web.HTTPServiceUnavailable(text=f'The study {subdomain} is starting up',
+                                             headers={'Retry-After': '10'})
+        token = request.cookies.get(sticky_cookie)
+        new_token = token is None
+        if new_token:
+            token = secrets.token_hex(8)
+        backend = pick_backend(backends, token)
+        headers = forwarded_headers(request.headers)
+        forwarded_for = request.headers.get('X-Forwarded-For')
+        headers['X-Forwarded-For'] = request.remote if forwarded_for is None else f'{forwarded_for}, {request.remote}'
+        try:
+            async with self.session.request(request.method,
+                                            backend + request.path_qs,
+                                            headers=headers,
+                                            data=await request.read(),
+                                            allow_redirects=False) as upstream:
+                response = web.StreamResponse(status=upstream.status,
+                                              headers=forwarded_headers(upstream.headers))
+                if new_token:
+                    response.set_cookie(sticky_cookie, token, max_age=sticky_cookie_max_age, httponly=True)
+                await response.prepare(request)
+                async for chunk in upstream.content.iter_chunked(chunk_size):
+                    await response.write(chunk)
+                await response.write_eof()
+                return response
+        except aiohttp.ClientConnectionError as e:
+            log.info('Backend %s of %s unavailable: %s', backend, subdomain, e)
+            raise web.HTTPBadGateway()
+
+
+def create_app(registry: Registry) -> web.Application:
+    router = Router(registry)
+    app = web.Application()
+    app.on_startup.append(router.start)
+    app.on_cleanup.append(router.stop)
+    app.router.add_route('*', '/{path:.*}', router.handle)
+    return app
+
+
+def parse_backend(s: str) -> Tuple[str, str]:
+    """
+    >>> parse_backend('2020-mar-foo=http://127.0.0.1:5006')
+    ('2020-mar-foo', 'http://127.0.0.1:5006')
+    """
+    subdomain, _, url = s.partition('=')
+    if not url:
+        raise argparse.ArgumentTypeError(f'Expected SUBDOMAIN=URL, not {s!r}')
+    return subdomain, url.rstrip('/')
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--namespace', help='The Cloud Map namespace to discover the backends in')
+    parser.add_argument('--routes', type=routes_from_json,
+                        help='The Cloud Map service and container port of each study by subdomain, as JSON')
+    parser.add_argument('--backend', type=parse_backend, action='append', default=[],
+                        help='A backend of a study as SUBDOMAIN=URL, instead of discovering them')
+    args = parser.parse_args(argv)
+    if args.backend:
+        backends = defaultdict(list)
+        for subdomain, url in args.backend:
+            backends[subdomain].append(url)
+        registry = StaticRegistry(dict(backends))
+    elif args.namespace and args.routes is not None:
+        import boto3
+        registry = CloudMapRegistry(boto3.client('servicediscovery'), args.namespace, args.routes)
+    else:
+        parser.error('Either --backend or both --namespace and --routes are required')
+    web.run_app(create_app(registry), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
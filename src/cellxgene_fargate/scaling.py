@@ -0,0 +1,134 @@
+"""
+The bounds and targets for scaling the number of replicas of each study.
+
+They are kept in a JSON file, checked in next to the profiling table, with
+defaults for all studies and overrides for individual studies by subdomain:
+
+    {
+        "default": {"min_capacity": 1, "max_capacity": 4},
+        "studies": {
+            "2020-mar-foo": {"max_capacity": 8, "requests_per_target": 300}
+        }
+    }
+
+Any property missing from an override is taken from the defaults, and any
+property missing from the defaults is taken from `ScalingPolicy`.
+"""
+import json
+import os
+from typing import (
+    Mapping,
+    Optional,
+    Sequence,
+)
+
+from dataclasses import (
+    dataclass,
+    replace,
+)
+
+
+@dataclass(frozen=True)
+class ScalingPolicy:
+    min_capacity: int = 1
+    max_capacity: int = 4
+    # The number of requests per minute a replica should handle, on average
+    requests_per_target: int = 600
+    # The average CPU utilization of the replicas, in percent
+    cpu_utilization: int = 60
+    # The number of seconds to wait after a scaling activity before removing
+    # replicas
+    scale_in_cooldown: int = 300
+    # The number of seconds to wait after a scaling activity before adding
+    # more replicas
+    scale_out_cooldown: int = 60
+    # The number of minutes without requests after which the study is scaled
+    # to zero until the next request, see `cellxgene_fargate.sleep`. Zero
+    # keeps the study running.
+    sleep_after_minutes: int = 0
+    # The number of users the study should serve at the same time. If
+    # non-zero, the size of its task and its minimum capacity are chosen for
+    # that, see `cellxgene_fargate.planning`.
+    concurrent_users: int = 0
+    # The 95th percentile of the latency of the requests, in milliseconds,
+    # that the study should stay below while serving `concurrent_users`
+    latency_ms: int = 1000
+
+    def __post_init__(self):
+        assert 0 <= self.min_capacity <= self.max_capacity, self
+
+    @property
+    def replicated(self) -> bool:
+        return self.max_capacity > 1
+
+    @property
+    def sleeps(self) -> bool:
+        return self.sleep_after_minutes > 0
+
+
+@dataclass(frozen=True)
+class ScalingPolicies:
+    default: ScalingPolicy
+    studies: Mapping[str, ScalingPolicy]
+
+    @classmethod
+    def load(cls, path: Optional[str] = None) -> 'ScalingPolicies':
+        if path is None:
+            path = scaling_path()
+        try:
+            with open(path) as f:
+                policies = json.load(f)
+        except FileNotFoundError:
+            policies = {}
+        default = ScalingPolicy(**policies.get('default', {}))
+        studies = {
+            subdomain: replace(default, **overrides)
+            for subdomain, overrides in policies.get('studies', {}).items()
+        }
+        return cls(default=default, studies=studies)
+
+    def __getitem__(self, subdomain: str) -> ScalingPolicy:
+        return self.studies.get(subdomain, self.default)
+
+    def with_replicas(self, replicas: Mapping[str, int]) -> 'ScalingPolicies':
+        """
+        The policies with the minimum capacity of the given studies raised to
+        the given number of replicas
+
+        >>> ScalingPolicies(default=ScalingPolicy(), studies={}).with_replicas({'2020-mar-foo': 6})['2020-mar-foo']
+        ScalingPolicy(min_capacity=6, max_capacity=6, requests_per_target=600, cpu_utilization=60, \
+scale_in_cooldown=300, scale_out_cooldown=60, sleep_after_minutes=0, concurrent_users=0, latency_ms=1000)
+        """
+        return replace(self, studies={
+            **self.studies,
+            **{
+                subdomain: replace(self[subdomain],
+                                   min_capacity=max(self[subdomain].min_capacity, n),
+                                   max_capacity=max(self[subdomain].max_capacity, n))
+                for subdomain, n in replicas.items()
+            }
+        })
+
+
+def combined(policies: Sequence[ScalingPolicy]) -> ScalingPolicy:
+    """
+    The policy for a task shared by studies with the given policies, see
+    `cellxgene_fargate.packing`. It satisfies the most demanding of them.
+
+    >>> combined([ScalingPolicy(max_capacity=2, cpu_utilization=50), ScalingPolicy(min_capacity=0)])
+    ScalingPolicy(min_capacity=1, max_capacity=4, requests_per_target=600, cpu_utilization=50, \
+scale_in_cooldown=300, scale_out_cooldown=60, sleep_after_minutes=0, concurrent_users=0, latency_ms=1000)
+    """
+    return ScalingPolicy(min_capacity=max(p.min_capacity for p in policies),
+                         max_capacity=max(p.max_capacity for p in policies),
+                         requests_per_target=min(p.requests_per_target for p in policies),
+                         cpu_utilization=min(p.cpu_utilization for p in policies),
+                         scale_in_cooldown=max(p.scale_in_cooldown for p in policies),
+                         scale_out_cooldown=min(p.scale_out_cooldown for p in policies),
+                         sleep_after_minutes=0,
+                         concurrent_users=sum(p.concurrent_users for p in policies),
+                         latency_ms=min(p.latency_ms for p in policies))
+
+
+def scaling_path() -> str:
+    return os.environ['CELLXGENE_SCALING']
@@ -0,0 +1,138 @@
+"""
+Serve a matrix file with the cellxgene web application under gunicorn.
+
+`cellxgene launch` runs the application in Flask's development server, a
+single process in which a slow request holds the GIL for every other user of
+the study. This module builds the same application, configured the way
+`cellxgene_fargate.launch.launch_args` configures `cellxgene launch`, and
+serves it with several gunicorn worker processes, each with several threads.
+
+The matrix is loaded in the gunicorn master, before the workers are forked, so
+that the workers share the pages holding the annotations and embeddings
+copy-on-write instead of each loading its own copy. The matrix is opened in
+backed mode, read-only, so the workers can safely read X through the inherited
+file handle.
+
+The application responds to requests for `readiness_path` with a short plain
+text response. The matrix is loaded before gunicorn binds its port, so any
+response to such a request means that the matrix is loaded. This lets the
+load balancer check the health of the container without rendering the UI.
+
+Usage:
+
+    python -m cellxgene_fargate.serve --title=TITLE --port=PORT \
+        --workers=N --threads=M PATH
+"""
+import argparse
+import logging
+import sys
+from typing import (
+    Any,
+    Mapping,
+    Sequence,
+)
+
+from gunicorn.app.base import BaseApplication
+
+from cellxgene_fargate.launch import (
+    readiness_path,
+)
+
+log = logging.getLogger(__name__)
+
+# Includes the request duration in microseconds, in addition to the fields of
+# the common log format
+access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(a)s" %(D)s'
+
+
+def create_app(path: str, title: str):
+    """
+    Build the cellxgene Flask application for the matrix at the given path
+    and load the matrix.
+    """
+    from server.common.app_config import AppConfig
+    from server.data_common.matrix_loader import MatrixDataCacheManager
+    from server.app.app import Server
+
+    app_config = AppConfig(datapath=path,
+                           title=title,
+                           anndata_backed=True,
+                           disable_diffexp=True)
+    matrix_data_cache_manager = MatrixDataCacheManager()
+    # Loads the matrix into the cache, where the workers will find it
+    with matrix_data_cache_manager.data_adaptor(path, app_config):
+        pass
+    # Passing no annotations object disables annotations
+    server = Server(matrix_data_cache_manager, None, app_config)
+    server.app.add_url_rule(readiness_path, 'ready', ready)
+    return server.app
+
+
+def ready():
+    return 'ready\n', 200, {'Content-Type': 'text/plain', 'Cache-Control': 'no-store'}
+
+
+class Application(BaseApplication):
+
+    def __init__(self, path: str, title: str, options: Mapping[str, Any]):
+        self.path = path
+        self.title = title
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        log.info('Loading %s', self.path)
+        return create_app(self.path, self.title)
+
+
+def serve(path: str,
+          title: str,
+          host: str,
+          port: int,
+          workers: int,
+          threads: int,
+          timeout: int = 300):
+    Application(path, title, {
+        'bind': f'{host}:{port}',
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread',
+        'preload_app': True,
+        'timeout': timeout,
+        # Longer than the keep-alive timeout of the router and the idle timeout
+        # of the load balancer, so that they can reuse their connections
+        'keepalive': 75,
+        'accesslog': '-',
+        'access_log_format': access_log_format
+    }).run()
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--title', required=True)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--timeout', type=int, default=300,
+                        help='Restart a worker that has been silent for this many seconds')
+    parser.add_argument('path')
+    args = parser.parse_args(argv)
+    serve(args.path,
+          title=args.title,
+          host=args.host,
+          port=args.port,
+          workers=args.workers,
+          threads=args.threads,
+          timeout=args.timeout)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,240 @@
+"""
+Predict the peak memory usage and the startup CPU time of a cellxgene
+container from the shape and structure of its matrix.
+
+The model is a linear one over a handful of matrix features. It is fitted with
+non-negative least squares to a table of profiling measurements so that no
+feature can reduce the prediction. The table is a CSV file with one row per
+profiled matrix, as written by `cellxgene_fargate.benchmark`. As long as the
+table has too few rows for a meaningful fit, callers fall back to the
+original estimate based on file size alone.
+
+Any prediction can be overridden for an individual study with the size its
+containers were observed to need, see `cellxgene_fargate.rightsizing`.
+"""
+import csv
+from functools import lru_cache
+import json
+import math
+import os
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Sequence,
+)
+
+from dataclasses import (
+    dataclass,
+    fields,
+)
+import numpy
+from scipy.optimize import nnls
+
+from cellxgene_fargate.fargate import (
+    FargateSpec,
+    fargate_vcpu_to_memory_in_MiB,
+)
+from cellxgene_fargate.h5ad import (
+    MatrixInfo,
+)
+
+MiB = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class Profile:
+    """
+    A row in the profiling table
+    """
+    label: str
+    cellxgene_version: str
+    n_obs: int
+    n_vars: int
+    nnz: int
+    x_dtype: str
+    n_embeddings: int
+    size: int
+    peak_rss_MiB: float
+    startup_cpu_seconds: float
+    startup_seconds: float
+
+    @property
+    def features(self) -> List[float]:
+        return features(n_obs=self.n_obs,
+                        n_vars=self.n_vars,
+                        nnz=self.nnz,
+                        x_itemsize=numpy.dtype(self.x_dtype).itemsize,
+                        n_embeddings=self.n_embeddings)
+
+
+def features(n_obs: int, n_vars: int, nnz: int, x_itemsize: int, n_embeddings: int) -> List[float]:
+    """
+    The predictors of the model. The first one models the baseline footprint
+    of the cellxgene process.
+    """
+    return [
+        1.0,
+        n_obs / 1000,
+        n_vars / 1000,
+        nnz * x_itemsize / MiB,
+        n_obs * n_embeddings / 1000
+    ]
+
+
+def info_features(info: MatrixInfo) -> List[float]:
+    return features(n_obs=info.n_obs,
+                    n_vars=info.n_vars,
+                    nnz=info.nnz,
+                    x_itemsize=info.x_itemsize,
+                    n_embeddings=len(info.embeddings))
+
+
+profile_fields = [field.name for field in fields(Profile)]
+
+
+def load_profiles(path: str) -> List[Profile]:
+    try:
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+    except FileNotFoundError:
+        return []
+    return [
+        Profile(**{
+            field.name: field.type(row[field.name])
+            for field in fields(Profile)
+        })
+        for row in rows
+    ]
+
+
+def append_profiles(path: str, profiles: Sequence[Profile]):
+    exists = os.path.exists(path)
+    with open(path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=profile_fields)
+        if not exists:
+            writer.writeheader()
+        for profile in profiles:
+            writer.writerow({name: getattr(profile, name) for name in profile_fields})
+
+
+@dataclass(frozen=True)
+class SizingModel:
+    memory_coefficients: Sequence[float]
+    cpu_coefficients: Sequence[float]
+    # The largest amount by which the fitted model underestimated the peak
+    # memory usage of any of the profiled matrices
+    max_memory_residual_MiB: float
+    # The prediction is increased by this fraction
+    margin: float
+    num_profiles: int
+
+    @classmethod
+    def fit(cls, profiles: Sequence[Profile], margin: float) -> Optional['SizingModel']:
+        """
+        Fit a model to the given profiles or return None if there aren't
+        enough profiles to do so.
+        """
+        num_features = len(features(n_obs=0, n_vars=0, nnz=0, x_itemsize=0, n_embeddings=0))
+        if len(profiles) < 2 * num_features:
+            return None
+        a = numpy.array([profile.features for profile in profiles])
+        memory = numpy.array([profile.peak_rss_MiB for profile in profiles])
+        cpu = numpy.array([profile.startup_cpu_seconds for profile in profiles])
+        memory_coefficients, _ = nnls(a, memory)
+        cpu_coefficients, _ = nnls(a, cpu)
+        residuals = memory - a @ memory_coefficients
+        return cls(memory_coefficients=tuple(map(float, memory_coefficients)),
+                   cpu_coefficients=tuple(map(float, cpu_coefficients)),
+                   max_memory_residual_MiB=max(0.0, float(residuals.max())),
+                   margin=margin,
+                   num_profiles=len(profiles))
+
+    def peak_memory_in_MiB(self, info: MatrixInfo) -> float:
+        return float(numpy.dot(self.memory_coefficients, info_features(info)))
+
+    def startup_cpu_seconds(self, info: MatrixInfo) -> float:
+        return float(numpy.dot(self.cpu_coefficients, info_features(info)))
+
+    # noinspection PyPep8Naming
+    def required_memory_in_MiB(self, info: MatrixInfo) -> int:
+        peak = self.peak_memory_in_MiB(info) + self.max_memory_residual_MiB
+        return math.ceil(peak * (1 + self.margin))
+
+    def required_vcpu(self, info: MatrixInfo, startup_seconds: float) -> Optional[int]:
+        """
+        The smallest Fargate vCPU allocation, in units of 1/1024 vCPU, that is
+        expected to bring up the container for the given matrix within the
+        given number of seconds, or None if even the largest one isn't.
+        Startup is assumed to be CPU-bound.
+        """
+        vcpu = 1024 * self.startup_cpu_seconds(info) * (1 + self.margin) / startup_seconds
+        allocations = sorted(fargate_vcpu_to_memory_in_MiB.keys())
+        return next((allocation for allocation in allocations if allocation >= vcpu), None)
+
+
+def profiles_path() -> str:
+    return os.environ['CELLXGENE_PROFILES']
+
+
+@lru_cache(maxsize=None)
+def default_model() -> Optional[SizingModel]:
+    """
+    The model fitted to the profiling table configured in the environment
+    """
+    return SizingModel.fit(load_profiles(profiles_path()),
+                           margin=float(os.environ['CELLXGENE_SIZING_MARGIN']))
+
+
+def startup_seconds_target() -> float:
+    return float(os.environ['CELLXGENE_STARTUP_SECONDS_TARGET'])
+
+
+@dataclass(frozen=True)
+class SizingOverride:
+    """
+    The size of the task of a study as recommended from the memory and CPU
+    its containers were observed to use
+    """
+    # The ETag of the matrix file that was served while observing. The
+    # override is ignored once the file changes.
+    etag: str
+    vcpu: int
+    memory_in_MiB: int
+
+    @property
+    def fargate_specs(self) -> FargateSpec:
+        return FargateSpec(vcpu=self.vcpu, memory_in_MiB=self.memory_in_MiB)
+
+
+def overrides_path() -> str:
+    return os.environ['CELLXGENE_SIZING_OVERRIDES']
+
+
+def load_overrides(path: str) -> Dict[str, SizingOverride]:
+    """
+    The overrides in the given file by subdomain
+    """
+    try:
+        with open(path) as f:
+            overrides = json.load(f)
+    except FileNotFoundError:
+        overrides = {}
+    return {subdomain: SizingOverride(**override) for subdomain, override in overrides.items()}
+
+
+def save_overrides(path: str, overrides: Dict[str, SizingOverride]):
+    with open(path, 'w') as f:
+        json.dump({
+            subdomain: {'etag': o.etag, 'vcpu': o.vcpu, 'memory_in_MiB': o.memory_in_MiB}
+            for subdomain, o in sorted(overrides.items())
+        }, f, indent=4)
+        f.write('\n')
+
+
+@lru_cache(maxsize=None)
+def default_overrides() -> Dict[str, SizingOverride]:
+    """
+    The overrides in the file configured in the environment
+    """
+    return load_overrides(overrides_path())
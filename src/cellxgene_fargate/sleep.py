@@ -0,0 +1,313 @@
+"""
+Put idle studies to sleep and wake them up on the first request.
+
+A study that is configured to sleep after a quiet period is put to sleep by
+the sleeper, a Lambda function invoked every few minutes. If the study's
+target group received no requests for the configured number of minutes, the
+sleeper points the study's listener rule at the target group of the waker,
+another Lambda function, and scales the study's service to zero.
+
+The waker handles the requests for a sleeping study. The first request starts
+the service. Until the service has a healthy task, the waker responds with a
+page that reloads itself every few seconds. Once a task is healthy, the waker
+points the listener rule back at the study's target group and redirects the
+client to the URL it requested, which is then served by the study.
+
+The configuration of each sleeping study is kept in an SSM parameter below
+`parameter_prefix`, as written by the Terraform template. All AWS clients are
+passed in, so the functions can be exercised against a local stand-in like
+`moto_server`. If the warm pool is enabled, the waker runs the pool manager
+right after starting a service, see `cellxgene_fargate.pool`. Both modules are
+packaged into the Lambda functions on their own and must not import anything
+outside the standard library and boto3.
+"""
+from datetime import (
+    datetime,
+    timedelta,
+    timezone,
+)
+import html
+import json
+import logging
+import os
+from typing import (
+    Any,
+    Callable,
+    List,
+    Mapping,
+    Optional,
+)
+
+from dataclasses import (
+    asdict,
+    dataclass,
+)
+
+log = logging.getLogger(__name__)
+
+parameter_prefix = '/cellxgene/studies/'
+
+# The number of seconds after which the warming up page reloads itself
+refresh_seconds = 10
+
+
+@dataclass(frozen=True)
+class StudyConfig:
+    subdomain: str
+    cluster: str
+    service: str
+    target_group_arn: str
+    listener_rule_arn: str
+    load_balancer_arn: str
+    min_capacity: int
+    max_capacity: int
+    sleep_after_minutes: int
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, s: str) -> 'StudyConfig':
+        return cls(**json.loads(s))
+
+    @property
+    def parameter_name(self) -> str:
+        return parameter_prefix + self.subdomain
+
+    @property
+    def resource_id(self) -> str:
+        """
+        The ID of the service as a scalable target
+        """
+        return f'service/{self.cluster}/{self.service}'
+
+
+def arn_suffix(arn: str) -> str:
+    """
+    The part of the ARN of a load balancer or target group that identifies
+    it in CloudWatch metrics.
+
+    >>> arn_suffix('arn:aws:elasticloadbalancing:us-east-1:123:loadbalancer/app/foo/abc')
+    'app/foo/abc'
+    >>> arn_suffix('arn:aws:elasticloadbalancing:us-east-1:123:targetgroup/foo/abc')
+    'targetgroup/foo/abc'
+    """
+    suffix = arn.split(':', 5)[5]
+    if suffix.startswith('loadbalancer/'):
+        suffix = suffix[len('loadbalancer/'):]
+    return suffix
+
+
+def load_config(ssm, subdomain: str) -> Optional[StudyConfig]:
+    try:
+        response = ssm.get_parameter(Name=parameter_prefix + subdomain)
+    except ssm.exceptions.ParameterNotFound:
+        return None
+    return StudyConfig.from_json(response['Parameter']['Value'])
+
+
+def load_configs(ssm) -> List[StudyConfig]:
+    paginator = ssm.get_paginator('get_parameters_by_path')
+    return [
+        StudyConfig.from_json(parameter['Value'])
+        for page in paginator.paginate(Path=parameter_prefix)
+        for parameter in page['Parameters']
+    ]
+
+
+class Study:
+
+    def __init__(self, config: StudyConfig, ecs, elbv2, autoscaling, cloudwatch=None):
+        self.config = config
+        self.ecs = ecs
+        self.elbv2 = elbv2
+        self.autoscaling = autoscaling
+        self.cloudwatch = cloudwatch
+
+    def service(self) -> Mapping[str, Any]:
+        response = self.ecs.describe_services(cluster=self.config.cluster,
+                                              services=[self.config.service])
+        return response['services'][0]
+
+    def is_asleep(self) -> bool:
+        return self.service()['desiredCount'] == 0
+
+    def is_healthy(self) -> bool:
+        response = self.elbv2.describe_target_health(TargetGroupArn=self.config.target_group_arn)
+        return any(target['TargetHealth']['State'] == 'healthy'
+                   for target in response['TargetHealthDescriptions'])
+
+    def _forward_to(self, target_group_arn: str):
+        self.elbv2.modify_rule(RuleArn=self.config.listener_rule_arn,
+                               Actions=[{'Type': 'forward', 'TargetGroupArn': target_group_arn}])
+
+    def _set_min_capacity(self, min_capacity: int):
+        self.autoscaling.register_scalable_target(ServiceNamespace='ecs',
+                                                  ResourceId=self.config.resource_id,
+                                                  ScalableDimension='ecs:service:DesiredCount',
+                                                  MinCapacity=min_capacity,
+                                                  MaxCapacity=self.config.max_capacity)
+
+    def wake(self):
+        """
+        Start the service of a sleeping study. Restoring the minimum capacity
+        first prevents Application Auto Scaling from undoing this.
+        """
+        log.info('Waking %s', self.config.subdomain)
+        self._set_min_capacity(self.config.min_capacity)
+        self.ecs.update_service(cluster=self.config.cluster,
+                                service=self.config.service,
+                                desiredCount=max(1, self.config.min_capacity))
+
+    def hand_over(self):
+        """
+        Route the requests for the study to its target group again
+        """
+        log.info('Handing %s over to its target group', self.config.subdomain)
+        self._forward_to(self.config.target_group_arn)
+
+    def requests(self, start: datetime, end: datetime) -> float:
+        response = self.cloudwatch.get_metric_statistics(
+            Namespace='AWS/ApplicationELB',
+            MetricName='RequestCount',
+            Dimensions=[
+                {'Name': 'LoadBalancer', 'Value': arn_suffix(self.config.load_balancer_arn)},
+                {'Name': 'TargetGroup', 'Value': arn_suffix(self.config.target_group_arn)}
+            ],
+            StartTime=start,
+            EndTime=end,
+            Period=60,
+            Statistics=['Sum'])
+        return sum(datapoint['Sum'] for datapoint in response['Datapoints'])
+
+    def is_idle(self, now: datetime) -> bool:
+        """
+        True if the study has been running for at least the quiet period
+        without receiving a request during it.
+        """
+        quiet_period = timedelta(minutes=self.config.sleep_after_minutes)
+        service = self.service()
+        if service['desiredCount'] == 0:
+            return False
+        last_update = max(deployment['updatedAt'] for deployment in service['deployments'])
+        if now - last_update < quiet_period:
+            return False
+        return self.requests(now - quiet_period, now) == 0
+
+    def sleep(self, waker_target_group_arn: str):
+        """
+        Route the requests for the study to the waker, then stop its service.
+        """
+        log.info('Putting %s to sleep', self.config.subdomain)
+        self._forward_to(waker_target_group_arn)
+        self._set_min_capacity(0)
+        self.ecs.update_service(cluster=self.config.cluster,
+                                service=self.config.service,
+                                desiredCount=0)
+
+
+def warming_up_page(subdomain: str) -> str:
+    subdomain = html.escape(subdomain)
+    return (f'<!DOCTYPE html>'
+            f'<html><head>'
+            f'<meta http-equiv="refresh" content="{refresh_seconds}">'
+            f'<title>{subdomain}</title>'
+            f'</head><body>'
+            f'<p>The study {subdomain} is starting up. This page will reload '
+            f'automatically until it is ready, usually within a few minutes.</p>'
+            f'</body></html>')
+
+
+def response(status: int, description: str, headers: Mapping[str, str], body: str = '') -> Mapping[str, Any]:
+    """
+    A response in the format expected by an ALB from a Lambda target
+    """
+    return {
+        'statusCode': status,
+        'statusDescription': f'{status} {description}',
+        'headers': {'Cache-Control': 'no-store', **headers},
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+
+def wake(event: Mapping[str, Any],
+         ssm,
+         ecs,
+         elbv2,
+         autoscaling,
+         on_wake: Optional[Callable[[StudyConfig], None]] = None) -> Mapping[str, Any]:
+    """
+    Handle a request for a sleeping study, passed in as an ALB event.
+
+    :param on_wake: called after the service of a sleeping study was started
+    """
+    headers = event['headers']
+    host = headers.get('x-forwarded-host', headers['host'])
+    subdomain = host.split('.', 1)[0]
+    config = load_config(ssm, subdomain)
+    if config is None:
+        return response(404, 'Not Found', {'Content-Type': 'text/plain'}, f'No such study: {host}')
+    study = Study(config, ecs=ecs, elbv2=elbv2, autoscaling=autoscaling)
+    if study.is_asleep():
+        study.wake()
+        if on_wake is not None:
+            on_wake(config)
+    elif study.is_healthy():
+        study.hand_over()
+        query = event.get('queryStringParameters') or {}
+        location = event['path']
+        if query:
+            # The ALB passes the query parameters URL-encoded
+            location += '?' + '&'.join(f'{k}={v}' for k, v in query.items())
+        return response(307, 'Temporary Redirect', {'Location': location})
+    return response(503, 'Service Unavailable',
+                    {'Content-Type': 'text/html', 'Retry-After': str(refresh_seconds)},
+                    warming_up_page(subdomain))
+
+
+def sleep(ssm, ecs, elbv2, autoscaling, cloudwatch, waker_target_group_arn: str, now: datetime) -> List[str]:
+    """
+    Put every idle study to sleep and return their subdomains.
+    """
+    slept = []
+    for config in load_configs(ssm):
+        study = Study(config, ecs=ecs, elbv2=elbv2, autoscaling=autoscaling, cloudwatch=cloudwatch)
+        if study.is_idle(now):
+            study.sleep(waker_target_group_arn)
+            slept.append(config.subdomain)
+    return slept
+
+
+def clients():
+    import boto3
+    return dict(ssm=boto3.client('ssm'),
+                ecs=boto3.client('ecs'),
+                elbv2=boto3.client('elbv2'),
+                autoscaling=boto3.client('application-autoscaling'))
+
+
+def waker_handler(event, context):
+    logging.getLogger().setLevel(logging.INFO)
+    pool_config = os.environ.get('CELLXGENE_POOL')
+    if pool_config is None:
+        on_wake = None
+    else:
+        from cellxgene_fargate import pool
+
+        def on_wake(_):
+            # Hand a task from the warm pool to the study right away instead
+            # of waiting for the next scheduled run of the pool manager
+            pool.manage(pool.PoolConfig.from_json(pool_config), **pool.clients())
+
+    return wake(event, **clients(), on_wake=on_wake)
+
+
+def sleeper_handler(event, context):
+    import boto3
+    logging.getLogger().setLevel(logging.INFO)
+    slept = sleep(**clients(),
+                  cloudwatch=boto3.client('cloudwatch'),
+                  waker_target_group_arn=os.environ['CELLXGENE_WAKER_TARGET_GROUP_ARN'],
+                  now=datetime.now(timezone.utc))
+    return {'slept': slept}
@@ -0,0 +1,272 @@
+"""
+Stage a matrix file from S3 onto task-local storage and launch cellxgene on
+the local copy.
+
+The object is fetched with many concurrent ranged GET requests. Every request
+is conditional on the ETag of the object so that an overwrite while the
+download is in progress fails the staging instead of producing a torn copy.
+When run inside the VPC, the requests go through the S3 gateway endpoint
+instead of the NAT gateways.
+
+Usage:
+
+    python -m cellxgene_fargate.stage --bucket BUCKET --key KEY [--size SIZE] \
+        [--etag ETAG] [--dest DIR] -- COMMAND ...
+
+Occurrences of `{path}` in COMMAND are replaced with the path of the local
+copy before COMMAND replaces the current process. If `--cache` names a
+directory that already holds a complete copy of the object, as populated by
+`cellxgene_fargate.populate`, that copy is used instead and nothing is
+downloaded. For local testing, point `--endpoint-url` at an S3 stand-in like
+`moto_server`.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import sys
+from typing import (
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import boto3
+import botocore.config
+from botocore.exceptions import ClientError
+
+log = logging.getLogger(__name__)
+
+default_part_size = 32 * 1024 * 1024
+
+default_concurrency = 16
+
+read_size = 1024 * 1024
+
+
+class StagingError(RuntimeError):
+    pass
+
+
+def s3_client(endpoint_url: Optional[str] = None,
+              concurrency: int = default_concurrency):
+    # The default connection pool is too small to let all workers run at once
+    return boto3.client('s3',
+                        endpoint_url=endpoint_url,
+                        config=botocore.config.Config(max_pool_connections=concurrency,
+                                                      retries={'max_attempts': 10}))
+
+
+def part_ranges(size: int, part_size: int) -> List[Tuple[int, int]]:
+    """
+    Return the inclusive byte ranges of the parts of an object of the given
+    size.
+
+    >>> part_ranges(10, 4)
+    [(0, 3), (4, 7), (8, 9)]
+    >>> part_ranges(0, 4)
+    []
+    """
+    return [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+
+def cache_path(cache_dir: str, bucket: str, key: str) -> str:
+    return os.path.join(cache_dir, bucket, key)
+
+
+def etag_path(path: str) -> str:
+    return path + '.etag'
+
+
+def is_staged(path: str, size: int, etag: str) -> bool:
+    """
+    True, if the file at the given path is a complete copy of the object with
+    the given size and ETag.
+    """
+    try:
+        with open(etag_path(path)) as f:
+            staged_etag = f.read()
+        staged_size = os.path.getsize(path)
+    except FileNotFoundError:
+        return False
+    else:
+        return staged_etag == etag and staged_size == size
+
+
+def head(s3, bucket: str, key: str, etag: Optional[str] = None) -> Tuple[int, str]:
+    """
+    Return the size and ETag of the given object, ensuring that the ETag
+    matches the given one, if any.
+    """
+    try:
+        response = s3.head_object(Bucket=bucket,
+                                  Key=key,
+                                  **({} if etag is None else {'IfMatch': etag}))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('412', 'PreconditionFailed'):
+            raise StagingError('ETag mismatch', bucket, key, etag)
+        else:
+            raise
+    return response['ContentLength'], response['ETag']
+
+
+def stage(s3,
+          bucket: str,
+          key: str,
+          path: str,
+          size: Optional[int] = None,
+          etag: Optional[str] = None,
+          part_size: int = default_part_size,
+          concurrency: int = default_concurrency) -> bool:
+    """
+    Download the given object to the given path unless a complete copy of it
+    already exists there. Return True if the object was downloaded.
+
+    :param size: the expected size of the object, the staging fails if the
+                 actual size differs
+
+    :param etag: the expected ETag of the object, the staging fails if the
+                 actual ETag differs
+    """
+    actual_size, actual_etag = head(s3, bucket, key, etag)
+    if size is not None and size != actual_size:
+        raise StagingError('Size mismatch', bucket, key, size, actual_size)
+    if is_staged(path, actual_size, actual_etag):
+        log.info('Found complete copy of s3://%s/%s at %s', bucket, key, path)
+        return False
+    log.info('Staging %i bytes from s3://%s/%s to %s using %i concurrent requests',
+             actual_size, bucket, key, path, concurrency)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # A stale marker would vouch for the new copy while it is being written
+    try:
+        os.unlink(etag_path(path))
+    except FileNotFoundError:
+        pass
+    # Write to a temporary file so that an interrupted download is never
+    # mistaken for a complete one
+    tmp_path = path + '.part'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, actual_size)
+
+        def fetch(part: Tuple[int, int]):
+            start, end = part
+            try:
+                response = s3.get_object(Bucket=bucket,
+                                         Key=key,
+                                         Range=f'bytes={start}-{end}',
+                                         IfMatch=actual_etag)
+            except ClientError as e:
+                if e.response['Error']['Code'] in ('412', 'PreconditionFailed'):
+                    raise StagingError('Object modified during staging', bucket, key)
+                else:
+                    raise
+            body = response['Body']
+            offset = start
+            for chunk in iter(lambda: body.read(read_size), b''):
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+            if offset != end + 1:
+                raise StagingError('Short read', bucket, key, start, end, offset)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Consume the iterator to propagate the first exception, if any
+            for _ in executor.map(fetch, part_ranges(actual_size, part_size)):
+                pass
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp_path)
+        raise
+    else:
+        os.close(fd)
+    staged_size = os.path.getsize(tmp_path)
+    if staged_size != actual_size:
+        raise StagingError('Size mismatch after staging', bucket, key, actual_size, staged_size)
+    os.rename(tmp_path, path)
+    with open(etag_path(path), 'w') as f:
+        f.write(actual_etag)
+    return True
+
+
+def parse_args(argv: Sequence[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bucket', required=True)
+    parser.add_argument('--key', required=True)
+    parser.add_argument('--size', type=int)
+    parser.add_argument('--etag')
+    parser.add_argument('--dest', default='/data',
+                        help='The directory to stage the object to. '
+                             'The local copy is named after the last component of the key.')
+    parser.add_argument('--cache',
+                        help='A directory, typically a read-only mount, '
+                             'that may hold a complete copy of the object under its bucket and key.')
+    parser.add_argument('--endpoint-url')
+    parser.add_argument('--part-size', type=int, default=default_part_size)
+    parser.add_argument('--concurrency', type=int, default=default_concurrency)
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    if args.command[:1] == ['--']:
+        args.command = args.command[1:]
+    return args
+
+
+def local_copy(s3,
+               bucket: str,
+               key: str,
+               dest: str,
+               size: Optional[int] = None,
+               etag: Optional[str] = None,
+               cache: Optional[str] = None,
+               part_size: int = default_part_size,
+               concurrency: int = default_concurrency) -> str:
+    """
+    Return the path of a local copy of the given object, either in the cache
+    directory, if given and it has a complete copy, or staged to the
+    destination directory.
+    """
+    if cache is not None:
+        size_, etag_ = head(s3, bucket, key, etag)
+        cached_path = cache_path(cache, bucket, key)
+        if (size is None or size == size_) and is_staged(cached_path, size_, etag_):
+            log.info('Using cached copy of s3://%s/%s at %s', bucket, key, cached_path)
+            return cached_path
+        else:
+            log.warning('No cached copy of s3://%s/%s in %s', bucket, key, cache)
+    path = os.path.join(dest, os.path.basename(key))
+    stage(s3,
+          bucket=bucket,
+          key=key,
+          path=path,
+          size=size,
+          etag=etag,
+          part_size=part_size,
+          concurrency=concurrency)
+    return path
+
+
+def main(argv: Sequence[str]):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        level=logging.INFO)
+    args = parse_args(argv)
+    s3 = s3_client(args.endpoint_url, args.concurrency)
+    path = local_copy(s3,
+                      bucket=args.bucket,
+                      key=args.key,
+                      dest=args.dest,
+                      size=args.size,
+                      etag=args.etag,
+                      cache=args.cache,
+                      part_size=args.part_size,
+                      concurrency=args.concurrency)
+    if args.command:
+        command = [arg.replace('{path}', path) for arg in args.command]
+        log.info('Running %r', command)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execvp(command[0], command)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
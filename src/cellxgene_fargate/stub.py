@@ -0,0 +1,64 @@
+"""
+A stand-in for a cellxgene server, for exercising the proxies locally.
+
+It answers requests to the paths of the cellxgene REST API with a
+deterministic body derived from the path, query and request body, after a
+configurable delay, and counts the requests it answered. The counts are
+served as JSON at `/stub/requests`.
+
+Usage:
+
+    python -m cellxgene_fargate.stub --port=PORT --delay=SECONDS
+"""
+import argparse
+import asyncio
+from collections import Counter
+import hashlib
+import json
+import sys
+from typing import (
+    Sequence,
+)
+
+from aiohttp import web
+
+api_prefix = '/api/v0.2/'
+
+
+def create_app(delay: float) -> web.Application:
+    counts = Counter()
+
+    async def handle(request: web.Request) -> web.Response:
+        counts[request.method + ' ' + request.path_qs] += 1
+        await asyncio.sleep(delay)
+        if request.path == '/':
+            return web.Response(text='<html></html>', content_type='text/html')
+        elif request.path.startswith(api_prefix):
+            digest = hashlib.sha256(request.path_qs.encode() + await request.read())
+            body = digest.digest() * 1024
+            return web.Response(body=body, content_type='application/octet-stream')
+        else:
+            raise web.HTTPNotFound()
+
+    async def requests(request: web.Request) -> web.Response:
+        return web.Response(text=json.dumps(counts), content_type='application/json')
+
+    app = web.Application()
+    app.router.add_get('/stub/requests', requests)
+    app.router.add_route('*', '/{path:.*}', handle)
+    return app
+
+
+def main(argv: Sequence[str]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--delay', type=float, default=0.5,
+                        help='The number of seconds to wait before responding')
+    args = parser.parse_args(argv)
+    web.run_app(create_app(args.delay), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,15 +1,86 @@
+import hashlib
 import json
+import math
 import os
-import re
-
-from boltons.cacheutils import cachedproperty
-import boto3
-from dataclasses import dataclass
+from typing import (
+    List,
+    Tuple,
+)
 
+from azul import config
 from azul.deployment import (
     aws,
     emit_tf,
 )
+from dataclasses import (
+    replace,
+)
+
+from cellxgene_fargate.components import (
+    split,
+    state_key,
+    write_components,
+)
+from cellxgene_fargate.fargate import (
+    FargateSpec,
+)
+from cellxgene_fargate.forecast import (
+    ScheduledAction,
+    load_schedules,
+    scheduled_actions,
+)
+from cellxgene_fargate.h5ad import (
+    load_info,
+)
+from cellxgene_fargate.launch import (
+    cache_proxy_args,
+    cache_proxy_enabled,
+    launch_args,
+    readiness_path,
+    serve_args,
+)
+from cellxgene_fargate.manifest import (
+    Manifest,
+    release_bucket,
+    release_prefix,
+)
+from cellxgene_fargate.matrix import (
+    MatrixFile,
+    load_optimized,
+    matrix_files,
+)
+from cellxgene_fargate.packing import (
+    Pack,
+    pack,
+    packing_capacity_in_MiB,
+)
+from cellxgene_fargate.planning import (
+    curves_path,
+    load_curves,
+    plan,
+)
+from cellxgene_fargate.pool import (
+    PoolConfig,
+    PoolStudy,
+    study_parameter_prefix,
+    task_parameter_prefix,
+)
+from cellxgene_fargate.router import (
+    Route,
+    routes_to_json,
+)
+from cellxgene_fargate.scaling import (
+    ScalingPolicies,
+    ScalingPolicy,
+    combined,
+)
+from cellxgene_fargate.sizing import (
+    default_model,
+)
+from cellxgene_fargate.sleep import (
+    StudyConfig,
+    parameter_prefix,
+)
 
 num_zones = 2  # An ALB needs at least two availability zones
 
@@ -20,11 +91,56 @@ num_zones = 2  # An ALB needs at least two availability zones
 ext_port = 80
 int_port = 5005
 
+# The port cellxgene listens on if the caching proxy listens on `int_port`
+backend_port = 5006
+
 vpc_cidr = "172.111.0.0/16"
 
+# The directory in the container to which the matrix file is staged before
+# cellxgene is launched on it
+staging_dir = '/data'
+
+efs_cache = bool(int(os.environ['CELLXGENE_EFS_CACHE']))
+
+# The mount point of the shared EFS file system holding a copy of each matrix
+# file under its key
+dataset_cache_dir = '/datasets'
+
+# The bucket for the optimized copies of the matrix files, empty to disable them
+optimized_bucket = os.environ['CELLXGENE_OPTIMIZED_BUCKET']
+
+# The bucket for the access logs of the load balancer, empty to disable them
+access_log_bucket = os.environ['CELLXGENE_ACCESS_LOG_BUCKET']
+
+access_log_prefix = 'cellxgene'
+
+# The number of days after which access logs are deleted
+access_log_expiration = 90
+
+wsgi = bool(int(os.environ['CELLXGENE_WSGI']))
+
+cache_proxy = cache_proxy_enabled()
+
+# The directory on the task's ephemeral storage for the caching proxy's disk
+# cache
+cache_proxy_dir = staging_dir + '/.cache-proxy'
+
 zone_name = os.environ['CELLXGENE_ZONE_NAME']
 domain_name = os.environ['CELLXGENE_DOMAIN_NAME']
 
+cloudfront = bool(int(os.environ['CELLXGENE_CLOUDFRONT']))
+
+# How long CloudFront caches the responses that depend on the matrix file.
+# Changing a matrix file invalidates the entire distribution.
+cloudfront_dataset_ttl = 7 * 24 * 3600
+
+# How long CloudFront caches the static assets. Their names include a digest
+# of their content.
+cloudfront_static_ttl = 365 * 24 * 3600
+
+# https://docs.aws.amazon.com/AmazonCloudFront/latest/DeveloperGuide/distribution-web-values-specify.html#DownloadDistValuesOriginKeepaliveTimeout
+cloudfront_origin_keepalive_timeout = 60
+
 ingress_egress_block = {
     "cidr_blocks": None,
     "ipv6_cidr_blocks": None,
@@ -50,101 +166,120 @@ def subnet_number(zone: int, public: bool):
     return 2 * zone + int(public)
 
 
-# https://aws.amazon.com/fargate/pricing/
+# The size of the task that populates the EFS file system
 #
-fargate_vcpu_to_memory_in_MiB = {
-    256: [512, 1024, 2048],
-    512: [i * 1024 for i in range(1, 5)],
-    1024: [i * 1024 for i in range(2, 9)],
-    2048: [i * 1024 for i in range(4, 17)],
-    4096: [i * 1024 for i in range(8, 31)]
-}
+populate_specs = FargateSpec(vcpu=2048, memory_in_MiB=4096)
+
+
+manifest = Manifest.load()
+matrix_files = matrix_files(manifest, load_info(manifest), load_optimized(manifest))
+scaling = ScalingPolicies.load()
+
+# The size and minimum number of replicas of the studies with a concurrency
+# target, see `cellxgene_fargate.planning`
+plans = plan(matrix_files, scaling, load_curves(curves_path()))
+matrix_files = [
+    replace(m, planned_specs=plans[m.subdomain].fargate_specs) if m.subdomain in plans else m
+    for m in matrix_files
+]
+scaling = scaling.with_replicas({subdomain: p.replicas for subdomain, p in plans.items()})
+
+# The studies that are scaled to zero when idle
+sleeping_files = [m for m in matrix_files if scaling[m.subdomain].sleeps]
+
+# The number of idle, pre-started containers to keep in the warm pool
+warm_pool_size = int(os.environ['CELLXGENE_WARM_POOL_SIZE'])
 
-fargate_vcpu_dollars_per_hour = 0.04048
-fargate_GB_ram_dollars_per_hour = 0.004445
-
-
-@dataclass(frozen=True)
-class FargateSpec:
-    vcpu: int
-    memory_in_MiB: int
-
-    # noinspection PyPep8Naming
-    @classmethod
-    def for_required_memory(cls, memory_in_MiB: int) -> 'FargateSpec':
-        for vcpu, mems in sorted(fargate_vcpu_to_memory_in_MiB.items()):
-            for mem in sorted(mems):
-                if mem >= memory_in_MiB:
-                    return cls(vcpu=vcpu, memory_in_MiB=mem)
-
-    @property
-    def cost_per_hour(self):
-        return (fargate_vcpu_dollars_per_hour * self.vcpu/1024,
-                fargate_GB_ram_dollars_per_hour * self.memory_in_MiB/1024)
-
-
-@dataclass(frozen=True)
-class MatrixFile:
-    key: str
-    size: int
-    study_name: str
-    public_url: str
-    subdomain: str
-    tfid: str
-    slug_prefix = '2020-mar-'
-
-    @classmethod
-    def for_key(cls, key: str, size: int) -> 'MatrixFile':
-        prefix, _, filename = key.rpartition('/')
-        study_name, _, suffix = filename.partition('_')
-        # https://docs.aws.amazon.com/Route53/latest/DeveloperGuide/DomainNameFormat.html
-        # has nothing against - and _ at the beginning/end or repeating them but
-        # we'll enforce those things anyways.
-        assert re.fullmatch(r'[a-z0-9]+([-_][a-z0-9]+)*', study_name, re.I), study_name
-        assert len(study_name) < 64
-        return cls(key=key,
-                   size=size,
-                   study_name=study_name,
-                   public_url='https://data.humancellatlas.org/' + key,
-                   subdomain=study_name.lower(),
-                   tfid='cellxgene_' + study_name.replace('-', '_').lower())
-
-    @property
-    def slug(self):
-        assert self.subdomain.startswith(self.slug_prefix)
-        return self.subdomain[len(self.slug_prefix):]
-
-    # noinspection PyPep8Naming
-    @property
-    def required_memory_in_MiB(self) -> int:
-        # Formula inferred from linear regression on optimized services and
-        # verified to successfully deploy for all March 2020 HCA files.
-        # Resting memory usage is typically low but but lowering the allocation
-        # causes health checks to fail.
-        return round(self.size * 2.5601e-6 - 16.5)
-
-    @cachedproperty
-    def fargate_specs(self) -> FargateSpec:
-        return FargateSpec.for_required_memory(self.required_memory_in_MiB)
-
-
-def matrix_files():
-    bucket = boto3.resource('s3').Bucket('release-files.data.humancellatlas.org')
-    for obj in bucket.objects.filter(Prefix='release-files/releases/2020-mar/'):
-        if obj.key.endswith('.h5ad'):
-            yield MatrixFile.for_key(obj.key, obj.size)
-
-
-matrix_files = list(matrix_files())
-
-assert len(set(m.subdomain for m in matrix_files)) == len(matrix_files)
-assert len(set(m.tfid for m in matrix_files)) == len(matrix_files)
+# At least one vCPU so that loading the matrix of the assigned study isn't
+# throttled
+pool_specs = FargateSpec.for_required_memory(int(os.environ['CELLXGENE_WARM_POOL_MEMORY']),
+                                             min_vcpu=1024)
+
+# The studies that can borrow a container from the warm pool
+pool_files = [
+    m for m in matrix_files
+    if warm_pool_size and m.fargate_specs.memory_in_MiB <= pool_specs.memory_in_MiB
+]
+
+# Extract metrics from the access logs of the studies, see
+# `cellxgene_fargate.request_metrics`
+request_metrics = bool(int(os.environ['CELLXGENE_REQUEST_METRICS']))
+
+lambdas = bool(sleeping_files or warm_pool_size or request_metrics)
+
+# Route the requests to the studies through `cellxgene_fargate.router`
+# instead of a listener rule and target group per study
+router = bool(int(os.environ['CELLXGENE_ROUTER']))
+
+assert not (router and (sleeping_files or warm_pool_size)), \
+    'Sleeping studies and the warm pool require a target group per study'
+
+router_specs = FargateSpec(vcpu=512, memory_in_MiB=1024)
+
+# Two tasks in different availability zones
+router_count = 2
+
+# The Cloud Map namespace the studies are registered in when routing
+namespace_name = 'cellxgene.local'
+
+packing_capacity = packing_capacity_in_MiB()
+
+# Emit the resources of each study into a Terraform component of its own, see
+# `cellxgene_fargate.components`
+study_components = bool(int(os.environ['CELLXGENE_STUDY_COMPONENTS']))
+
+# Record the memory and CPU used by the tasks, see
+# `cellxgene_fargate.rightsizing`
+container_insights = bool(int(os.environ['CELLXGENE_CONTAINER_INSIGHTS']))
+
+# Leave updating the services to new revisions of their task definitions to
+# `cellxgene_fargate.rollout`
+rollout = bool(int(os.environ['CELLXGENE_ROLLOUT']))
+
+# The Fargate tasks serving the studies, each a study on its own unless
+# packing is enabled
+packs = pack(matrix_files,
+             packing_capacity,
+             packable=lambda m: not scaling[m.subdomain].sleeps and m.subdomain not in plans
+             ) if packing_capacity else [Pack((m,)) for m in matrix_files]
+
+pack_of = {m.subdomain: p for p in packs for m in p.members}
+
+
+def pack_policy(p: Pack) -> ScalingPolicy:
+    return combined([scaling[m.subdomain] for m in p.members])
+
+
+# The replicas predicted for every hour of the week by
+# `cellxgene_fargate.forecast`
+schedules = load_schedules()
+
+# The minutes it takes to provision a task and pull the image, on top of the
+# time it takes the containers to become healthy
+provisioning_minutes = 5
+
+
+def pack_scheduled_actions(p: Pack) -> List[ScheduledAction]:
+    member_schedules = [schedules[m.subdomain] for m in p.members if m.subdomain in schedules]
+    if member_schedules:
+        # Sleeping studies aren't packed
+        policy = scaling[p.members[0].subdomain] if len(p.members) == 1 else pack_policy(p)
+        lead_minutes = math.ceil(health_check_grace_period(p) / 60) + provisioning_minutes
+        return scheduled_actions([max(hour) for hour in zip(*member_schedules)], policy, lead_minutes)
+    else:
+        return []
 
 
 def cost_report(matrix_files):
     base_fmt = '{:<45} ' + '| {:<6}' * 2
     header_fmt = base_fmt + '| {:<10}' * 3
     row_fmt = base_fmt + '| ${:<9.4}' * 3
+    model = default_model()
+    if model is None:
+        print('Containers sized by matrix file size')
+    else:
+        print(f'Containers sized by model fitted to {model.num_profiles} profiles, '
+              f'{sum(m.info is None for m in matrix_files)} uninspected files sized by file size')
     print('Cluster hourly cost breakdown:')
     print(header_fmt.format('container', 'vCPU', 'RAM', 'vCPU cost', 'RAM cost', 'sum cost'))
     info = [
@@ -158,11 +293,428 @@ def cost_report(matrix_files):
     info.append(('Total', *map(sum, list(zip(*info))[1:])))
     for row in info:
         print(row_fmt.format(*row))
+    overridden = sum(file.sizing_override is not None for file in matrix_files)
+    if overridden:
+        cost = sum(sum(file.estimated_fargate_specs.cost_per_hour) for file in matrix_files)
+        print(f'{overridden} containers sized by observed usage, total as predicted: ${cost:.4}')
+    if plans:
+        cost = sum(p.cost_per_hour for p in plans.values())
+        print(f'{len(plans)} containers sized for their concurrency targets, '
+              f'with their minimum replicas: ${cost:.4}')
+    for bound in ('min_capacity', 'max_capacity'):
+        cost = sum(getattr(scaling[file.subdomain], bound) * sum(file.fargate_specs.cost_per_hour)
+                   for file in matrix_files)
+        print(f'Total with every study scaled to its {bound.replace("_", " ")}: ${cost:.4}')
+    if packing_capacity:
+        pack_fmt = '{:<45} ' + '| {:<7}' + '| {:<6}' * 2
+        print(f'Packed into tasks of at most {packing_capacity / 1024} GiB:')
+        print((pack_fmt + '| {:<13}' * 2).format('task', 'studies', 'vCPU', 'RAM', 'packed cost', 'unpacked cost'))
+        rows = [
+            (p.name, len(p.members), p.fargate_specs.vcpu / 1024, p.fargate_specs.memory_in_MiB / 1024,
+             p.cost_per_hour, p.unpacked_cost_per_hour)
+            for p in packs if p.packed
+        ]
+        rows.append(('Total (including unpacked studies)', len(matrix_files),
+                     *(sum(getattr(p.fargate_specs, a) for p in packs) / 1024 for a in ('vcpu', 'memory_in_MiB')),
+                     sum(p.cost_per_hour for p in packs),
+                     sum(p.unpacked_cost_per_hour for p in packs)))
+        for row in rows:
+            print((pack_fmt + '| ${:<12.4}' * 2).format(*row))
+        for bound in ('min_capacity', 'max_capacity'):
+            cost = sum(getattr(pack_policy(p), bound) * p.cost_per_hour for p in packs)
+            print(f'Packed total with every task scaled to its {bound.replace("_", " ")}: ${cost:.4}')
+    if router:
+        cost = router_count * sum(router_specs.cost_per_hour)
+        print(f'Router of {router_count} tasks: ${cost:.4}')
+    if warm_pool_size:
+        cost = warm_pool_size * sum(pool_specs.cost_per_hour)
+        print(f'Warm pool of {warm_pool_size} idle containers '
+              f'({pool_specs.vcpu / 1024} vCPU, {pool_specs.memory_in_MiB / 1024} GiB each): ${cost:.4}')
 
 
 cost_report(matrix_files)
 
-emit_tf({
+image = ("${data.aws_ecr_repository.cellxgene.repository_url}"
+         "@${data.aws_ecr_image.cellxgene.image_digest}")
+
+
+def log_configuration(stream_prefix: str):
+    return {
+        "logDriver": "awslogs",
+        "options": {
+            "awslogs-group": "${aws_cloudwatch_log_group.cellxgene.name}",
+            "awslogs-region": aws.region_name,
+            "awslogs-stream-prefix": stream_prefix
+        }
+    }
+
+
+def efs_volume():
+    return {
+        "name": "datasets",
+        "efs_volume_configuration": {
+            "file_system_id": "${aws_efs_file_system.cellxgene.id}",
+            "root_directory": "/"
+        }
+    }
+
+
+def member_ports(i: int) -> Tuple[int, int]:
+    """
+    The port the load balancer forwards to and the port of cellxgene behind
+    the cache proxy, for the container of the i-th member of a pack
+    """
+    return int_port + 2 * i, backend_port + 2 * i
+
+
+def server_command(m: MatrixFile, i: int, vcpu: int):
+    """
+    The command that the staging script runs on the staged matrix file
+    """
+    frontend_port, backend_port_ = member_ports(i)
+    port = backend_port_ if cache_proxy else frontend_port
+    if wsgi:
+        return ["python", *serve_args(m.study_name, "{path}", port, vcpu)]
+    else:
+        return ["cellxgene", *launch_args(m.study_name, "{path}", port)]
+
+
+def container_name(p: Pack, name: str, i: int):
+    return f"{name}-{i}" if p.packed else name
+
+
+def frontend_container(p: Pack, i: int):
+    """
+    The container the load balancer forwards to
+    """
+    return container_name(p, 'cache-proxy' if cache_proxy else 'cellxgene', i)
+
+
+def container_definitions(p: Pack):
+    return [
+        container
+        for i, m in enumerate(p.members)
+        for container in member_container_definitions(p, m, i)
+    ]
+
+
+def member_container_definitions(p: Pack, m: MatrixFile, i: int):
+    frontend_port, backend_port_ = member_ports(i)
+    return [
+        {
+            "name": container_name(p, "cellxgene", i),
+            "image": image,
+            "essential": True,
+            "entryPoint": [
+                "python",
+                "-m",
+                "cellxgene_fargate.stage"
+            ],
+            "command": [
+                f"--bucket={m.bucket}",
+                f"--key={m.key}",
+                f"--size={m.size}",
+                f"--etag={m.etag}",
+                f"--dest={staging_dir}",
+                *([f"--cache={dataset_cache_dir}"] if efs_cache else []),
+                "--",
+                # The members of a pack share its vCPUs
+                *server_command(m, i, p.fargate_specs.vcpu // len(p.members))
+            ],
+            "mountPoints": [
+                {"sourceVolume": "data", "containerPath": staging_dir},
+                *([{
+                    "sourceVolume": "datasets",
+                    "containerPath": dataset_cache_dir,
+                    "readOnly": True
+                }] if efs_cache else [])
+            ],
+            **({
+                # Keeps the members of a pack from starving each other
+                "memoryReservation": m.required_memory_in_MiB
+            } if p.packed else {}),
+            **({} if cache_proxy else {
+                "portMappings": [
+                    {"containerPort": frontend_port, "hostPort": frontend_port}
+                ],
+                **({"healthCheck": container_health_check(p, i)} if router else {})
+            }),
+            "logConfiguration": log_configuration(m.subdomain)
+        },
+        *([{
+            "name": container_name(p, "cache-proxy", i),
+            "image": image,
+            "essential": True,
+            "entryPoint": [
+                "python"
+            ],
+            "command": cache_proxy_args(frontend_port,
+                                        backend_port_,
+                                        m.etag,
+                                        f"{cache_proxy_dir}/{m.subdomain}" if p.packed else cache_proxy_dir),
+            "memoryReservation": m.sidecar_memory_in_MiB,
+            "mountPoints": [
+                {"sourceVolume": "data", "containerPath": staging_dir}
+            ],
+            "portMappings": [
+                {"containerPort": frontend_port, "hostPort": frontend_port}
+            ],
+            **({"healthCheck": container_health_check(p, i)} if router else {}),
+            "logConfiguration": log_configuration(m.subdomain)
+        }] if cache_proxy else [])
+    ]
+
+
+def cloudfront_cache_behavior(headers, ttl):
+    return {
+        "target_origin_id": "cellxgene-alb",
+        "viewer_protocol_policy": "redirect-to-https",
+        # cellxgene's client queries the expression of genes with PUT requests,
+        # which CloudFront forwards without caching
+        "allowed_methods": ["DELETE", "GET", "HEAD", "OPTIONS", "PATCH", "POST", "PUT"],
+        "cached_methods": ["GET", "HEAD"],
+        "compress": True,
+        "forwarded_values": {
+            # Including the Host header in the cache key keeps the responses
+            # of the individual studies apart.
+            "headers": ["Host", *headers],
+            "query_string": True,
+            "cookies": {
+                "forward": "none"
+            }
+        },
+        "min_ttl": 0,
+        "default_ttl": ttl,
+        "max_ttl": ttl
+    }
+
+
+def health_check():
+    if wsgi:
+        # The readiness endpoint responds promptly unless the container is
+        # hung or dead, so it is checked often and replaced quickly.
+        return {
+            "path": readiness_path,
+            "healthy_threshold": 2,
+            "unhealthy_threshold": 3,
+            "timeout": 5,
+            "interval": 10
+        }
+    else:
+        # `cellxgene launch` serves one request at a time and has no readiness
+        # endpoint. The check waits in line behind the requests of the users,
+        # so under load it takes as long as the slowest of those. These are
+        # the thresholds that always served it well.
+        return {
+            "path": "/",
+            "healthy_threshold": 2,
+            "unhealthy_threshold": 10,
+            "timeout": 30,
+            "interval": 60
+        }
+
+
+def health_check_grace_period(p: Pack) -> int:
+    startup = max(m.startup_seconds(p.fargate_specs.vcpu // len(p.members)) for m in p.members)
+    return max(60, math.ceil(startup * 1.5))
+
+
+def container_health_check(p: Pack, i: int):
+    """
+    The health check of the container the router forwards to, the same as
+    the load balancer's. ECS reports its outcome to Cloud Map.
+    """
+    check = health_check()
+    url = f"http://127.0.0.1:{member_ports(i)[0]}{check['path']}"
+    return {
+        "command": [
+            "CMD-SHELL",
+            f"python -c \"import urllib.request; urllib.request.urlopen('{url}', timeout={check['timeout'] - 1})\""
+        ],
+        "interval": check["interval"],
+        "timeout": check["timeout"],
+        "retries": check["unhealthy_threshold"],
+        # The longest ECS allows. The service ignores failures during its
+        # grace period anyway.
+        "startPeriod": min(300, health_check_grace_period(p))
+    }
+
+
+def routes():
+    return {
+        m.subdomain: Route(service=p.name, port=member_ports(i)[0])
+        for p in packs
+        for i, m in enumerate(p.members)
+    }
+
+
+def sleep_config(m: MatrixFile) -> StudyConfig:
+    return StudyConfig(subdomain=m.subdomain,
+                       cluster="${aws_ecs_cluster.cellxgene.name}",
+                       service=f"${{aws_ecs_service.{m.tfid}.name}}",
+                       target_group_arn=f"${{aws_lb_target_group.{m.tfid}.arn}}",
+                       listener_rule_arn=f"${{aws_lb_listener_rule.{m.tfid}.arn}}",
+                       load_balancer_arn="${aws_lb.cellxgene.arn}",
+                       min_capacity=scaling[m.subdomain].min_capacity,
+                       max_capacity=scaling[m.subdomain].max_capacity,
+                       sleep_after_minutes=scaling[m.subdomain].sleep_after_minutes)
+
+
+def pool_study(m: MatrixFile) -> PoolStudy:
+    return PoolStudy(subdomain=m.subdomain,
+                     service=f"${{aws_ecs_service.{pack_of[m.subdomain].tfid}.name}}",
+                     target_group_arn=f"${{aws_lb_target_group.{m.tfid}.arn}}",
+                     title=m.study_name,
+                     bucket=m.bucket,
+                     key=m.key,
+                     size=m.size,
+                     etag=m.etag,
+                     memory_in_MiB=m.fargate_specs.memory_in_MiB)
+
+
+def pool_config() -> PoolConfig:
+    return PoolConfig(cluster="${aws_ecs_cluster.cellxgene.name}",
+                      task_definition="${aws_ecs_task_definition.cellxgene_pool.arn}",
+                      size=warm_pool_size,
+                      memory_in_MiB=pool_specs.memory_in_MiB,
+                      port=int_port,
+                      **private_network_configuration())
+
+
+def ssm_parameter_arn(prefix: str) -> str:
+    return f"arn:aws:ssm:{aws.region_name}:{aws.account}:parameter{prefix}*"
+
+
+# The Lambda functions that run on a schedule, by Terraform ID
+scheduled_functions = {
+    **({"cellxgene_sleeper": "rate(5 minutes)"} if sleeping_files else {}),
+    **({"cellxgene_pool_manager": "rate(1 minute)"} if warm_pool_size else {})
+}
+
+
+def lambda_function(name: str, handler: str, timeout: int, **environment):
+    return {
+        "function_name": name,
+        "runtime": "python3.7",
+        "handler": "cellxgene_fargate." + handler,
+        # Built by the Makefile
+        "filename": "lambda.zip",
+        "source_code_hash": '${filebase64sha256("lambda.zip")}',
+        "role": "${aws_iam_role.cellxgene_lambda.arn}",
+        "timeout": timeout,
+        **({
+            "environment": {
+                "variables": environment
+            }
+        } if environment else {})
+    }
+
+
+def private_network_configuration():
+    return {
+        "subnets": [
+            f"${{aws_subnet.cellxgene_private_{zone}.id}}"
+            for zone in range(num_zones)
+        ],
+        "security_groups": [
+            "${aws_security_group.cellxgene.id}"
+        ]
+    }
+
+
+def service_rollout_changes() -> List[str]:
+    """
+    The attributes of a service that Terraform leaves to the rollout
+    """
+    return ["task_definition"] if rollout else []
+
+
+def rollout_plan():
+    """
+    The services to roll out, read by `cellxgene_fargate.rollout` from the
+    outputs of the shared component. All values are literals so that the
+    output stays in the shared component when the studies are split off.
+    """
+    return {
+        "cluster": "cellxgene",
+        "services": [
+            *([
+                {
+                    # Rolled out first, any problem with it affects all studies
+                    "name": "cellxgene-router",
+                    "family": "cellxgene_router",
+                    "size": 0,
+                    "grace_period": 0
+                }
+            ] if router else []),
+            *(
+                {
+                    "name": p.name,
+                    "family": p.tfid,
+                    "size": sum(m.size for m in p.members),
+                    "grace_period": health_check_grace_period(p)
+                } for p in packs
+            )
+        ]
+    }
+
+
+def component(p: Pack) -> str:
+    """
+    The name of the Terraform component holding the resources of the given
+    pack if study components are enabled
+    """
+    return p.tfid[len('cellxgene_'):].replace('_', '')
+
+
+def component_resources(p: Pack) -> List[Tuple[str, str]]:
+    return [
+        ("aws_ecs_task_definition", p.tfid),
+        ("aws_ecs_service", p.tfid),
+        ("aws_appautoscaling_target", p.tfid),
+        ("aws_appautoscaling_policy", f"{p.tfid}_cpu"),
+        *(
+            ("aws_appautoscaling_scheduled_action", f"{p.tfid}_{i}")
+            for i, _ in enumerate(pack_scheduled_actions(p))
+        ),
+        *([("aws_service_discovery_service", p.tfid)] if router else []),
+        *(
+            address
+            for m in p.members
+            for address in [
+                ("aws_route53_record", m.tfid),
+                *([
+                    ("aws_lb_target_group", m.tfid),
+                    ("aws_lb_listener_rule", m.tfid),
+                    ("aws_appautoscaling_policy", f"{m.tfid}_requests")
+                ] if not router else []),
+                *([("aws_ssm_parameter", f"{m.tfid}_sleep")] if m in sleeping_files else []),
+                *([("aws_ssm_parameter", f"{m.tfid}_pool")] if m in pool_files else [])
+            ]
+        )
+    ]
+
+
+def remote_state_config():
+    """
+    The location of the state of the shared component, as configured by
+    `backend.tf.json.template.py`
+    """
+    return {
+        "bucket": config.terraform_backend_bucket,
+        "key": state_key(''),
+        "region": aws.region_name,
+        **(
+            {
+                "profile": aws.profile['source_profile'],
+                "role_arn": aws.profile['role_arn']
+            } if 'role_arn' in aws.profile else {
+            }
+        )
+    }
+
+
+tf = {
     "data": {
         "aws_availability_zones": {
             "available": {}
@@ -178,6 +730,11 @@ emit_tf({
                 "image_tag": os.environ['CELLXGENE_VERSION']
             }
         },
+        **({
+            "aws_elb_service_account": {
+                "main": {}
+            }
+        } if access_log_bucket else {}),
         "aws_route53_zone": {
             "cellxgene": {
                 "name": zone_name + ".",
@@ -187,28 +744,188 @@ emit_tf({
     },
     "resource": {
         "aws_iam_role": {
-            "cellxgene": {
-                "name": "cellxgene",
+            name.replace('-', '_'): {
+                "name": name,
                 "assume_role_policy": json.dumps({
                     "Version": "2012-10-17",
                     "Statement": [
                         {
                             "Action": "sts:AssumeRole",
                             "Principal": {
-                                "Service": "ecs-tasks.amazonaws.com"
+                                "Service": f"{service}.amazonaws.com"
                             },
                             "Effect": "Allow",
                             "Sid": ""
                         }
                     ]
                 })
+            } for name, service in [
+                ('cellxgene', 'ecs-tasks'),
+                ('cellxgene-task', 'ecs-tasks'),
+                *([('cellxgene-lambda', 'lambda')] if lambdas else [])
+            ]
+        },
+        **({
+            "aws_s3_bucket": {
+                **({
+                    # Holds the copies of the matrix files made by
+                    # `cellxgene_fargate.optimize`, under the keys of the originals
+                    "cellxgene_optimized": {
+                        "bucket": optimized_bucket,
+                        "acl": "private"
+                    }
+                } if optimized_bucket else {}),
+                **({
+                    "cellxgene_access_logs": {
+                        "bucket": access_log_bucket,
+                        "acl": "private",
+                        "lifecycle_rule": {
+                            "enabled": True,
+                            "expiration": {
+                                "days": access_log_expiration
+                            }
+                        }
+                    }
+                } if access_log_bucket else {})
             }
+        } if optimized_bucket or access_log_bucket else {}),
+        **({
+            "aws_s3_bucket_policy": {
+                "cellxgene_access_logs": {
+                    "bucket": "${aws_s3_bucket.cellxgene_access_logs.id}",
+                    "policy": json.dumps({
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                # Lets the load balancer write its access logs
+                                "Effect": "Allow",
+                                "Principal": {
+                                    "AWS": "${data.aws_elb_service_account.main.arn}"
+                                },
+                                "Action": "s3:PutObject",
+                                "Resource": f"arn:aws:s3:::{access_log_bucket}/{access_log_prefix}/AWSLogs/{aws.account}/*"
+                            }
+                        ]
+                    })
+                }
+            }
+        } if access_log_bucket else {}),
+        "aws_iam_role_policy": {
+            "cellxgene_task": {
+                "name": "cellxgene-task",
+                "role": "${aws_iam_role.cellxgene_task.id}",
+                "policy": json.dumps({
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Action": "s3:GetObject",
+                            "Resource": [
+                                f"arn:aws:s3:::{release_bucket}/{release_prefix}*",
+                                *([f"arn:aws:s3:::{optimized_bucket}/{release_prefix}*"] if optimized_bucket else [])
+                            ]
+                        },
+                        *([{
+                            # Lets the router look up the tasks of the studies
+                            "Effect": "Allow",
+                            "Action": "servicediscovery:DiscoverInstances",
+                            "Resource": "*"
+                        }] if router else []),
+                        *([{
+                            # Lets the pool agent read its assignment
+                            "Effect": "Allow",
+                            "Action": "ssm:GetParameter",
+                            "Resource": [
+                                ssm_parameter_arn(study_parameter_prefix),
+                                ssm_parameter_arn(task_parameter_prefix)
+                            ]
+                        }] if warm_pool_size else [])
+                    ]
+                })
+            },
+            **({
+                "cellxgene_lambda": {
+                    "name": "cellxgene-lambda",
+                    "role": "${aws_iam_role.cellxgene_lambda.id}",
+                    "policy": json.dumps({
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            *([
+                                {
+                                    "Effect": "Allow",
+                                    "Action": [
+                                        "ssm:GetParameter",
+                                        "ssm:GetParametersByPath"
+                                    ],
+                                    "Resource": ssm_parameter_arn(parameter_prefix)
+                                },
+                                {
+                                    "Effect": "Allow",
+                                    "Action": [
+                                        "ecs:DescribeServices",
+                                        "ecs:UpdateService",
+                                        "elasticloadbalancing:DescribeTargetHealth",
+                                        "elasticloadbalancing:ModifyRule",
+                                        "application-autoscaling:RegisterScalableTarget",
+                                        "cloudwatch:GetMetricStatistics"
+                                    ],
+                                    "Resource": "*"
+                                }
+                            ] if sleeping_files else []),
+                            *([
+                                {
+                                    "Effect": "Allow",
+                                    "Action": [
+                                        "ssm:GetParameter",
+                                        "ssm:GetParametersByPath",
+                                        "ssm:PutParameter",
+                                        "ssm:DeleteParameter"
+                                    ],
+                                    "Resource": [
+                                        ssm_parameter_arn(study_parameter_prefix),
+                                        ssm_parameter_arn(task_parameter_prefix)
+                                    ]
+                                },
+                                {
+                                    "Effect": "Allow",
+                                    "Action": [
+                                        "ecs:DescribeServices",
+                                        "ecs:ListTasks",
+                                        "ecs:DescribeTasks",
+                                        "ecs:RunTask",
+                                        "ecs:StopTask",
+                                        "elasticloadbalancing:DescribeTargetHealth",
+                                        "elasticloadbalancing:RegisterTargets",
+                                        "elasticloadbalancing:DeregisterTargets"
+                                    ],
+                                    "Resource": "*"
+                                },
+                                {
+                                    # For starting pool tasks
+                                    "Effect": "Allow",
+                                    "Action": "iam:PassRole",
+                                    "Resource": [
+                                        "${aws_iam_role.cellxgene.arn}",
+                                        "${aws_iam_role.cellxgene_task.arn}"
+                                    ]
+                                }
+                            ] if warm_pool_size else [])
+                        ]
+                    })
+                }
+            } if sleeping_files or warm_pool_size else {})
         },
         "aws_iam_role_policy_attachment": {
             "ecs-task-execution-role-policy": {
                 "role": "${aws_iam_role.cellxgene.name}",
                 "policy_arn": "arn:aws:iam::aws:policy/service-role/AmazonECSTaskExecutionRolePolicy"
-            }
+            },
+            **({
+                "cellxgene-lambda-basic-execution": {
+                    "role": "${aws_iam_role.cellxgene_lambda.name}",
+                    "policy_arn": "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"
+                }
+            } if lambdas else {})
         },
         "aws_vpc": {
             "cellxgene": {
@@ -291,6 +1008,22 @@ emit_tf({
                 "subnet_id": f"${{aws_subnet.cellxgene_private_{zone}.id}}"
             } for zone in range(num_zones)
         },
+        "aws_vpc_endpoint": {
+            # Lets the containers download matrix files without going through
+            # the NAT gateways. This only works because the release bucket is in
+            # the same region as the VPC.
+            "cellxgene_s3": {
+                "vpc_id": "${aws_vpc.cellxgene.id}",
+                "service_name": f"com.amazonaws.{aws.region_name}.s3",
+                "vpc_endpoint_type": "Gateway",
+                "route_table_ids": [
+                    f"${{aws_route_table.cellxgene_{zone}.id}}" for zone in range(num_zones)
+                ],
+                "tags": {
+                    "Name": "cellxgene-s3"
+                }
+            }
+        },
         "aws_security_group": {
             "cellxgene_alb": {
                 "name": "cellxgene-alb",
@@ -334,10 +1067,35 @@ emit_tf({
                         "security_groups": [
                             "${aws_security_group.cellxgene_alb.id}"
                         ],
-                        "to_port": int_port,
-                    }
+                        "to_port": max(member_ports(len(p.members) - 1)[0] for p in packs),
+                    },
+                    *([{
+                        # From the router to the studies
+                        **ingress_egress_block,
+                        "from_port": int_port,
+                        "protocol": "tcp",
+                        "self": True,
+                        "to_port": max(member_ports(len(p.members) - 1)[0] for p in packs),
+                    }] if router else [])
                 ]
-            }
+            },
+            **({
+                "cellxgene_efs": {
+                    "name": "cellxgene-efs",
+                    "vpc_id": "${aws_vpc.cellxgene.id}",
+                    "ingress": [
+                        {
+                            **ingress_egress_block,
+                            "from_port": 2049,
+                            "protocol": "tcp",
+                            "security_groups": [
+                                "${aws_security_group.cellxgene.id}"
+                            ],
+                            "to_port": 2049,
+                        }
+                    ]
+                }
+            } if efs_cache else {})
         },
         "aws_lb": {
             "cellxgene": {
@@ -349,6 +1107,15 @@ emit_tf({
                 "security_groups": [
                     "${aws_security_group.cellxgene_alb.id}"
                 ],
+                **({
+                    # See `cellxgene_fargate.access_logs`
+                    "access_logs": {
+                        "bucket": "${aws_s3_bucket.cellxgene_access_logs.id}",
+                        "prefix": access_log_prefix,
+                        "enabled": True
+                    },
+                    "depends_on": ["aws_s3_bucket_policy.cellxgene_access_logs"]
+                } if access_log_bucket else {}),
                 "tags": {
                     "Name": "cellxgene"
                 }
@@ -368,7 +1135,7 @@ emit_tf({
                             f"var l={[m.slug for m in matrix_files]};"
                             f"for(i=0;i<l.length;i++)"
                             f"document.write("
-                            f"'<p><a href=\"http://{MatrixFile.slug_prefix}'+l[i]+'.{domain_name}\">'+l[i]+'</a></p>'"
+                            f"'<p><a href=\"{'https' if cloudfront else 'http'}://{MatrixFile.slug_prefix}'+l[i]+'.{domain_name}\">'+l[i]+'</a></p>'"
                             f");"
                             f"</script></body></html>",
                         "status_code": "200"
@@ -378,6 +1145,21 @@ emit_tf({
             }
         },
         "aws_lb_listener_rule": {
+            "cellxgene_router": {
+                "listener_arn": "${aws_lb_listener.cellxgene.arn}",
+                "action": {
+                    "type": "forward",
+                    "target_group_arn": "${aws_lb_target_group.cellxgene_router.arn}"
+                },
+                "condition": {
+                    "host_header": {
+                        "values": [
+                            f"*.{domain_name}"
+                        ]
+                    }
+                }
+            }
+        } if router else {
             m.tfid: {
                 "listener_arn": "${aws_lb_listener.cellxgene.arn}",
                 "action": {
@@ -391,127 +1173,630 @@ emit_tf({
                         ]
                     }
                 },
-                "depends_on": [f"aws_lb_target_group.{m.tfid}"]
+                "depends_on": [f"aws_lb_target_group.{m.tfid}"],
+                **({
+                    "lifecycle": {
+                        # Switched between the study and the waker by
+                        # `cellxgene_fargate.sleep`
+                        "ignore_changes": ["action"]
+                    }
+                } if scaling[m.subdomain].sleeps else {})
             } for m in matrix_files
         },
         "aws_lb_target_group": {
-            m.tfid: {
-                "port": int_port,
-                "protocol": "HTTP",
-                "target_type": "ip",
-                "stickiness": {
-                    # Stickyness is irrelevant when there is only one target but
-                    # should be reconsidered when we load balance over multiple
-                    # containers.
-                    "enabled": False,
-                    "type": "lb_cookie",
-                },
-                "health_check": {
+            **({
+                "cellxgene_router": {
+                    "port": int_port,
                     "protocol": "HTTP",
-                    "path": "/",
-                    "port": "traffic-port",
-                    "healthy_threshold": 2,
-                    # This and `interval` give the containers for the large files enough time to initialize
-                    "unhealthy_threshold": 10,
-                    "timeout": 30,
-                    "interval": 60,
-                    "matcher": "200"
-                },
-                "vpc_id": "${aws_vpc.cellxgene.id}",
-                "tags": {
-                    # Work around TF bug with eplicit name. This will make TF chose a name for us:
-                    # https://github.com/terraform-providers/terraform-provider-aws/issues/636#issuecomment-397459646
-                    "Name": m.subdomain
+                    "target_type": "ip",
+                    "health_check": {
+                        "protocol": "HTTP",
+                        "path": readiness_path,
+                        "port": "traffic-port",
+                        "healthy_threshold": 2,
+                        "unhealthy_threshold": 3,
+                        "timeout": 5,
+                        "interval": 10,
+                        "matcher": "200"
+                    },
+                    "vpc_id": "${aws_vpc.cellxgene.id}",
+                    "tags": {
+                        "Name": "cellxgene-router"
+                    }
                 }
-            } for m in matrix_files
+            } if router else {}),
+            **({
+                "cellxgene_waker": {
+                    "name": "cellxgene-waker",
+                    "target_type": "lambda"
+                }
+            } if sleeping_files else {}),
+            **{
+                m.tfid: {
+                    "port": int_port,
+                    "protocol": "HTTP",
+                    "target_type": "ip",
+                    "stickiness": {
+                        # Keep each client on the replica whose caches it warmed up.
+                        # Stickyness is irrelevant when there is only one target.
+                        "enabled": pack_policy(pack_of[m.subdomain]).replicated,
+                        "type": "lb_cookie",
+                        "cookie_duration": 24 * 3600
+                    },
+                    "health_check": {
+                        "protocol": "HTTP",
+                        "port": "traffic-port",
+                        "matcher": "200",
+                        **health_check()
+                    },
+                    "vpc_id": "${aws_vpc.cellxgene.id}",
+                    "tags": {
+                        # Work around TF bug with eplicit name. This will make TF chose a name for us:
+                        # https://github.com/terraform-providers/terraform-provider-aws/issues/636#issuecomment-397459646
+                        "Name": m.subdomain
+                    }
+                } for m in ([] if router else matrix_files)
+            }
         },
         "aws_ecs_cluster": {
             "cellxgene": {
                 "name": "cellxgene",
                 "capacity_providers": [
                     "FARGATE"
-                ]
+                ],
+                **({
+                    "setting": {
+                        "name": "containerInsights",
+                        "value": "enabled"
+                    }
+                } if container_insights else {})
             }
         },
         "aws_ecs_service": {
-            m.tfid: {
-                "name": f"cellxgene-{m.subdomain}",
-                "cluster": "${aws_ecs_cluster.cellxgene.id}",
-                "task_definition": f"${{aws_ecs_task_definition.{m.tfid}.arn}}",
-                "desired_count": 1,
-                "launch_type": "FARGATE",
-                "load_balancer": {
-                    "target_group_arn": f"${{aws_lb_target_group.{m.tfid}.arn}}",
-                    "container_name": "cellxgene",
-                    "container_port": int_port,
-                },
-                "network_configuration": {
-                    "subnets": [
-                        f"${{aws_subnet.cellxgene_private_{zone}.id}}"
-                        for zone in range(num_zones)
-                    ],
-                    "security_groups": [
-                        "${aws_security_group.cellxgene.id}"
-                    ]
+            **{
+                p.tfid: {
+                    "name": p.name,
+                    "cluster": "${aws_ecs_cluster.cellxgene.id}",
+                    "task_definition": f"${{aws_ecs_task_definition.{p.tfid}.arn}}",
+                    "desired_count": pack_policy(p).min_capacity,
+                    "lifecycle": {
+                        # Managed by Application Auto Scaling
+                        "ignore_changes": ["desired_count", *service_rollout_changes()]
+                    },
+                    "launch_type": "FARGATE",
+                    # 1.4.0 is the first platform version with 20 GiB of ephemeral
+                    # storage, enough to stage the largest matrix file
+                    "platform_version": "1.4.0",
+                    # Containers that are still staging or loading their matrix fail
+                    # the health checks of the load balancer. The service ignores
+                    # that for as long as the slowest one is predicted to need.
+                    "health_check_grace_period_seconds": health_check_grace_period(p),
+                    **({
+                        "service_registries": {
+                            "registry_arn": f"${{aws_service_discovery_service.{p.tfid}.arn}}"
+                        }
+                    } if router else {
+                        "load_balancer": [
+                            {
+                                "target_group_arn": f"${{aws_lb_target_group.{m.tfid}.arn}}",
+                                "container_name": frontend_container(p, i),
+                                "container_port": member_ports(i)[0],
+                            } for i, m in enumerate(p.members)
+                        ]
+                    }),
+                    "network_configuration": private_network_configuration(),
+                    **({
+                        "depends_on": [
+                            f"aws_efs_mount_target.cellxgene_{zone}" for zone in range(num_zones)
+                        ]
+                    } if efs_cache else {})
+                } for p in packs
+            },
+            **({
+                "cellxgene_router": {
+                    "name": "cellxgene-router",
+                    "cluster": "${aws_ecs_cluster.cellxgene.id}",
+                    "task_definition": "${aws_ecs_task_definition.cellxgene_router.arn}",
+                    "desired_count": router_count,
+                    **({
+                        "lifecycle": {
+                            "ignore_changes": service_rollout_changes()
+                        }
+                    } if rollout else {}),
+                    "launch_type": "FARGATE",
+                    "platform_version": "1.4.0",
+                    "load_balancer": {
+                        "target_group_arn": "${aws_lb_target_group.cellxgene_router.arn}",
+                        "container_name": "router",
+                        "container_port": int_port
+                    },
+                    "network_configuration": private_network_configuration()
                 }
-            } for m in matrix_files
+            } if router else {})
+        },
+        **({
+            "aws_service_discovery_private_dns_namespace": {
+                "cellxgene": {
+                    "name": namespace_name,
+                    "vpc": "${aws_vpc.cellxgene.id}"
+                }
+            },
+            "aws_service_discovery_service": {
+                p.tfid: {
+                    "name": p.name,
+                    "dns_config": {
+                        "namespace_id": "${aws_service_discovery_private_dns_namespace.cellxgene.id}",
+                        "dns_records": {
+                            "ttl": 10,
+                            "type": "A"
+                        },
+                        "routing_policy": "MULTIVALUE"
+                    },
+                    "health_check_custom_config": {
+                        # ECS reports the outcome of the container health check
+                        "failure_threshold": 1
+                    }
+                } for p in packs
+            }
+        } if router else {}),
+        "aws_appautoscaling_target": {
+            p.tfid: {
+                "service_namespace": "ecs",
+                "resource_id": f"service/${{aws_ecs_cluster.cellxgene.name}}/${{aws_ecs_service.{p.tfid}.name}}",
+                "scalable_dimension": "ecs:service:DesiredCount",
+                "min_capacity": pack_policy(p).min_capacity,
+                "max_capacity": pack_policy(p).max_capacity
+            } for p in packs
+        },
+        "aws_appautoscaling_policy": {
+            # A pack scales out as soon as the requests to any of its members or
+            # the CPU utilization of its tasks exceed their target and scales in
+            # only once all of them are below their target.
+            f"{tfid}_{metric}": {
+                "name": f"{name}-{metric}",
+                "policy_type": "TargetTrackingScaling",
+                "service_namespace": f"${{aws_appautoscaling_target.{p.tfid}.service_namespace}}",
+                "resource_id": f"${{aws_appautoscaling_target.{p.tfid}.resource_id}}",
+                "scalable_dimension": f"${{aws_appautoscaling_target.{p.tfid}.scalable_dimension}}",
+                "target_tracking_scaling_policy_configuration": {
+                    "predefined_metric_specification": {
+                        "predefined_metric_type": metric_type,
+                        **({
+                            "resource_label": f"${{aws_lb.cellxgene.arn_suffix}}"
+                                              f"/${{aws_lb_target_group.{tfid}.arn_suffix}}"
+                        } if metric == 'requests' else {})
+                    },
+                    "target_value": target_value,
+                    "scale_in_cooldown": pack_policy(p).scale_in_cooldown,
+                    "scale_out_cooldown": pack_policy(p).scale_out_cooldown
+                }
+            }
+            for p in packs
+            for tfid, name, metric, metric_type, target_value in [
+                *(
+                    (m.tfid, f"cellxgene-{m.subdomain}", 'requests', 'ALBRequestCountPerTarget',
+                     scaling[m.subdomain].requests_per_target)
+                    for m in ([] if router else p.members)
+                ),
+                (p.tfid, p.name, 'cpu', 'ECSServiceAverageCPUUtilization', pack_policy(p).cpu_utilization)
+            ]
+        },
+        "aws_appautoscaling_scheduled_action": {
+            # Raises the minimum capacity ahead of the predicted demand
+            f"{p.tfid}_{i}": {
+                "name": f"{p.name}-{i}",
+                "service_namespace": f"${{aws_appautoscaling_target.{p.tfid}.service_namespace}}",
+                "resource_id": f"${{aws_appautoscaling_target.{p.tfid}.resource_id}}",
+                "scalable_dimension": f"${{aws_appautoscaling_target.{p.tfid}.scalable_dimension}}",
+                "schedule": action.schedule,
+                "scalable_target_action": {
+                    "min_capacity": action.min_capacity,
+                    "max_capacity": action.max_capacity
+                }
+            }
+            for p in packs
+            for i, action in enumerate(pack_scheduled_actions(p))
         },
         "aws_route53_record": {
-            'cellxgene' if m is None else m.tfid: {
-                "zone_id": "${data.aws_route53_zone.cellxgene.id}",
-                "name": 'cellxgene' if m is None else m.subdomain + '.' + domain_name,
-                "type": "A",
-                "alias": {
-                    "name": "${aws_lb.cellxgene.dns_name}",
-                    "zone_id": "${aws_lb.cellxgene.zone_id}",
-                    "evaluate_target_health": False
-                }
-            } for m in [None, *matrix_files]
+            **{
+                'cellxgene' if m is None else m.tfid: {
+                    "zone_id": "${data.aws_route53_zone.cellxgene.id}",
+                    "name": 'cellxgene' if m is None else m.subdomain + '.' + domain_name,
+                    "type": "A",
+                    "alias": {
+                        "name": "${aws_cloudfront_distribution.cellxgene.domain_name}",
+                        "zone_id": "${aws_cloudfront_distribution.cellxgene.hosted_zone_id}",
+                        "evaluate_target_health": False
+                    } if cloudfront and m is not None else {
+                        "name": "${aws_lb.cellxgene.dns_name}",
+                        "zone_id": "${aws_lb.cellxgene.zone_id}",
+                        "evaluate_target_health": False
+                    }
+                } for m in [None, *matrix_files]
+            },
+            **({
+                "cellxgene_certificate_validation": {
+                    "zone_id": "${data.aws_route53_zone.cellxgene.id}",
+                    "name": "${aws_acm_certificate.cellxgene.domain_validation_options.0.resource_record_name}",
+                    "type": "${aws_acm_certificate.cellxgene.domain_validation_options.0.resource_record_type}",
+                    "records": [
+                        "${aws_acm_certificate.cellxgene.domain_validation_options.0.resource_record_value}"
+                    ],
+                    "ttl": 60
+                }
+            } if cloudfront else {})
         },
+        **({
+            "aws_acm_certificate": {
+                "cellxgene": {
+                    # CloudFront only uses certificates from this region
+                    "provider": "aws.us-east-1",
+                    "domain_name": "*." + domain_name,
+                    "validation_method": "DNS",
+                    "lifecycle": {
+                        "create_before_destroy": True
+                    }
+                }
+            },
+            "aws_acm_certificate_validation": {
+                "cellxgene": {
+                    "provider": "aws.us-east-1",
+                    "certificate_arn": "${aws_acm_certificate.cellxgene.arn}",
+                    "validation_record_fqdns": [
+                        "${aws_route53_record.cellxgene_certificate_validation.fqdn}"
+                    ]
+                }
+            },
+            "aws_cloudfront_distribution": {
+                "cellxgene": {
+                    "enabled": True,
+                    "is_ipv6_enabled": True,
+                    "http_version": "http2",
+                    "price_class": "PriceClass_100",
+                    "aliases": [
+                        f"{m.subdomain}.{domain_name}" for m in matrix_files
+                    ],
+                    "origin": {
+                        "origin_id": "cellxgene-alb",
+                        "domain_name": "${aws_lb.cellxgene.dns_name}",
+                        "custom_origin_config": {
+                            "http_port": ext_port,
+                            "https_port": 443,
+                            "origin_protocol_policy": "http-only",
+                            "origin_ssl_protocols": ["TLSv1.2"],
+                            "origin_keepalive_timeout": cloudfront_origin_keepalive_timeout,
+                            "origin_read_timeout": 60
+                        }
+                    },
+                    # The index page of each study
+                    "default_cache_behavior": cloudfront_cache_behavior([], cloudfront_dataset_ttl),
+                    "ordered_cache_behavior": [
+                        {
+                            "path_pattern": "/static/*",
+                            **cloudfront_cache_behavior([], cloudfront_static_ttl)
+                        },
+                        {
+                            "path_pattern": "/api/*",
+                            # cellxgene responds with JSON or a FlatBuffer,
+                            # depending on the Accept header
+                            **cloudfront_cache_behavior(["Accept"], cloudfront_dataset_ttl)
+                        }
+                    ],
+                    "restrictions": {
+                        "geo_restriction": {
+                            "restriction_type": "none"
+                        }
+                    },
+                    "viewer_certificate": {
+                        "acm_certificate_arn": "${aws_acm_certificate_validation.cellxgene.certificate_arn}",
+                        "ssl_support_method": "sni-only",
+                        "minimum_protocol_version": "TLSv1.2_2018"
+                    },
+                    "tags": {
+                        "Name": "cellxgene"
+                    }
+                }
+            },
+            "null_resource": {
+                # Invalidate the distribution whenever a matrix file or the
+                # image changes
+                "cellxgene_invalidation": {
+                    "triggers": {
+                        "matrix_files": hashlib.sha256(json.dumps(sorted(
+                            (m.subdomain, m.etag) for m in matrix_files
+                        )).encode()).hexdigest(),
+                        "image": "${data.aws_ecr_image.cellxgene.image_digest}"
+                    },
+                    "provisioner": {
+                        "local-exec": {
+                            "command": "aws cloudfront create-invalidation"
+                                       " --distribution-id ${aws_cloudfront_distribution.cellxgene.id}"
+                                       " --paths '/*'"
+                        }
+                    }
+                }
+            }
+        } if cloudfront else {}),
         "aws_ecs_task_definition": {
-            m.tfid: {
-                "family": m.tfid,
-                "requires_compatibilities": [
-                    "FARGATE"
-                ],
-                "network_mode": "awsvpc",
-                "cpu": m.fargate_specs.vcpu,
-                "memory": m.fargate_specs.memory_in_MiB,
-                "container_definitions": json.dumps(
-                    [
+            **{
+                p.tfid: {
+                    "family": p.tfid,
+                    "requires_compatibilities": [
+                        "FARGATE"
+                    ],
+                    "network_mode": "awsvpc",
+                    "cpu": p.fargate_specs.vcpu,
+                    "memory": p.fargate_specs.memory_in_MiB,
+                    "container_definitions": json.dumps(container_definitions(p)),
+                    "volume": [
                         {
-                            "name": "cellxgene",
-                            "image": "${data.aws_ecr_repository.cellxgene.repository_url}"
-                                     "@${data.aws_ecr_image.cellxgene.image_digest}",
-                            "essential": True,
-                            "command": [
-                                "launch",
-                                "--verbose",
-                                "--backed",
-                                "--disable-diffexp",
-                                "--disable-annotations",
-                                "--title=" + m.study_name,
-                                m.public_url,
-                                "--host=0.0.0.0",
-                                f"--port={int_port}"
-                            ],
-                            "portMappings": [
-                                {"containerPort": int_port, "hostPort": int_port}
-                            ],
-                            "logConfiguration": {
-                                "logDriver": "awslogs",
-                                "options": {
-                                    "awslogs-group": "${aws_cloudwatch_log_group.cellxgene.name}",
-                                    "awslogs-region": aws.region_name,
-                                    "awslogs-stream-prefix": m.subdomain
-                                }
+                            # A bind mount on the task's ephemeral storage, avoiding
+                            # the overhead of the container's overlay file system
+                            "name": "data"
+                        },
+                        *([efs_volume()] if efs_cache else [])
+                    ],
+                    "execution_role_arn": "${aws_iam_role.cellxgene.arn}",
+                    "task_role_arn": "${aws_iam_role.cellxgene_task.arn}"
+                } for p in packs
+            },
+            **({
+                "cellxgene_populate": {
+                    "family": "cellxgene_populate",
+                    "requires_compatibilities": [
+                        "FARGATE"
+                    ],
+                    "network_mode": "awsvpc",
+                    "cpu": populate_specs.vcpu,
+                    "memory": populate_specs.memory_in_MiB,
+                    "container_definitions": json.dumps(
+                        [
+                            {
+                                "name": "populate",
+                                "image": image,
+                                "essential": True,
+                                "entryPoint": [
+                                    "python",
+                                    "-m",
+                                    "cellxgene_fargate.populate"
+                                ],
+                                "command": [
+                                    f"--dest={dataset_cache_dir}",
+                                    *(f"s3://{m.bucket}/{m.key}" for m in matrix_files)
+                                ],
+                                "mountPoints": [
+                                    {"sourceVolume": "datasets", "containerPath": dataset_cache_dir}
+                                ],
+                                "logConfiguration": log_configuration("populate")
                             }
-                        }
-                    ]
-                ),
-                "execution_role_arn": "${aws_iam_role.cellxgene.arn}"
-            } for m in matrix_files
+                        ]
+                    ),
+                    "volume": [
+                        efs_volume()
+                    ],
+                    "execution_role_arn": "${aws_iam_role.cellxgene.arn}",
+                    "task_role_arn": "${aws_iam_role.cellxgene_task.arn}"
+                }
+            } if efs_cache else {}),
+            **({
+                "cellxgene_pool": {
+                    "family": "cellxgene_pool",
+                    "requires_compatibilities": [
+                        "FARGATE"
+                    ],
+                    "network_mode": "awsvpc",
+                    "cpu": pool_specs.vcpu,
+                    "memory": pool_specs.memory_in_MiB,
+                    "container_definitions": json.dumps(
+                        [
+                            {
+                                "name": "cellxgene",
+                                "image": image,
+                                "essential": True,
+                                "entryPoint": [
+                                    "python",
+                                    "-m",
+                                    "cellxgene_fargate.pool"
+                                ],
+                                "command": [
+                                    f"--port={int_port}",
+                                    f"--dest={staging_dir}",
+                                    *([f"--cache={dataset_cache_dir}"] if efs_cache else []),
+                                    f"--vcpu={pool_specs.vcpu}"
+                                ],
+                                "mountPoints": [
+                                    {"sourceVolume": "data", "containerPath": staging_dir},
+                                    *([{
+                                        "sourceVolume": "datasets",
+                                        "containerPath": dataset_cache_dir,
+                                        "readOnly": True
+                                    }] if efs_cache else [])
+                                ],
+                                "portMappings": [
+                                    {"containerPort": int_port, "hostPort": int_port}
+                                ],
+                                "logConfiguration": log_configuration("pool")
+                            }
+                        ]
+                    ),
+                    "volume": [
+                        {
+                            "name": "data"
+                        },
+                        *([efs_volume()] if efs_cache else [])
+                    ],
+                    "execution_role_arn": "${aws_iam_role.cellxgene.arn}",
+                    "task_role_arn": "${aws_iam_role.cellxgene_task.arn}"
+                }
+            } if warm_pool_size else {}),
+            **({
+                "cellxgene_router": {
+                    "family": "cellxgene_router",
+                    "requires_compatibilities": [
+                        "FARGATE"
+                    ],
+                    "network_mode": "awsvpc",
+                    "cpu": router_specs.vcpu,
+                    "memory": router_specs.memory_in_MiB,
+                    "container_definitions": json.dumps(
+                        [
+                            {
+                                "name": "router",
+                                "image": image,
+                                "essential": True,
+                                "entryPoint": [
+                                    "python",
+                                    "-m",
+                                    "cellxgene_fargate.router"
+                                ],
+                                "command": [
+                                    f"--port={int_port}",
+                                    f"--namespace={namespace_name}",
+                                    f"--routes={routes_to_json(routes())}"
+                                ],
+                                "portMappings": [
+                                    {"containerPort": int_port, "hostPort": int_port}
+                                ],
+                                "logConfiguration": log_configuration("router")
+                            }
+                        ]
+                    ),
+                    "execution_role_arn": "${aws_iam_role.cellxgene.arn}",
+                    "task_role_arn": "${aws_iam_role.cellxgene_task.arn}"
+                }
+            } if router else {})
         },
+        **({
+            "aws_efs_file_system": {
+                "cellxgene": {
+                    "encrypted": True,
+                    "tags": {
+                        "Name": "cellxgene"
+                    }
+                }
+            },
+            "aws_efs_mount_target": {
+                f"cellxgene_{zone}": {
+                    "file_system_id": "${aws_efs_file_system.cellxgene.id}",
+                    "subnet_id": f"${{aws_subnet.cellxgene_private_{zone}.id}}",
+                    "security_groups": [
+                        "${aws_security_group.cellxgene_efs.id}"
+                    ]
+                } for zone in range(num_zones)
+            },
+        } if efs_cache else {}),
+        **({
+            "aws_ssm_parameter": {
+                **{
+                    f"{m.tfid}_sleep": {
+                        "name": parameter_prefix + m.subdomain,
+                        "type": "String",
+                        "value": sleep_config(m).to_json()
+                    } for m in sleeping_files
+                },
+                **{
+                    f"{m.tfid}_pool": {
+                        "name": study_parameter_prefix + m.subdomain,
+                        "type": "String",
+                        "value": pool_study(m).to_json()
+                    } for m in pool_files
+                }
+            },
+            "aws_lambda_function": {
+                **({
+                    "cellxgene_waker": lambda_function(
+                        "cellxgene-waker",
+                        "sleep.waker_handler",
+                        timeout=30,
+                        **({"CELLXGENE_POOL": pool_config().to_json()} if warm_pool_size else {})
+                    ),
+                    "cellxgene_sleeper": lambda_function(
+                        "cellxgene-sleeper",
+                        "sleep.sleeper_handler",
+                        timeout=60,
+                        CELLXGENE_WAKER_TARGET_GROUP_ARN="${aws_lb_target_group.cellxgene_waker.arn}"
+                    )
+                } if sleeping_files else {}),
+                **({
+                    "cellxgene_pool_manager": lambda_function(
+                        "cellxgene-pool-manager",
+                        "pool.manager_handler",
+                        timeout=60,
+                        CELLXGENE_POOL=pool_config().to_json()
+                    )
+                } if warm_pool_size else {}),
+                **({
+                    "cellxgene_request_metrics": lambda_function(
+                        "cellxgene-request-metrics",
+                        "request_metrics.handler",
+                        timeout=60,
+                        CELLXGENE_FRONTEND_CONTAINER='cache-proxy' if cache_proxy else 'cellxgene'
+                    )
+                } if request_metrics else {})
+            },
+            "aws_lambda_permission": {
+                **({
+                    "cellxgene_waker": {
+                        "statement_id": "AllowExecutionFromLoadBalancer",
+                        "action": "lambda:InvokeFunction",
+                        "function_name": "${aws_lambda_function.cellxgene_waker.function_name}",
+                        "principal": "elasticloadbalancing.amazonaws.com",
+                        "source_arn": "${aws_lb_target_group.cellxgene_waker.arn}"
+                    }
+                } if sleeping_files else {}),
+                **{
+                    name: {
+                        "statement_id": "AllowExecutionFromCloudWatch",
+                        "action": "lambda:InvokeFunction",
+                        "function_name": f"${{aws_lambda_function.{name}.function_name}}",
+                        "principal": "events.amazonaws.com",
+                        "source_arn": f"${{aws_cloudwatch_event_rule.{name}.arn}}"
+                    } for name in scheduled_functions
+                },
+                **({
+                    "cellxgene_request_metrics": {
+                        "statement_id": "AllowExecutionFromCloudWatchLogs",
+                        "action": "lambda:InvokeFunction",
+                        "function_name": "${aws_lambda_function.cellxgene_request_metrics.function_name}",
+                        "principal": f"logs.{aws.region_name}.amazonaws.com",
+                        "source_arn": "${aws_cloudwatch_log_group.cellxgene.arn}"
+                    }
+                } if request_metrics else {})
+            },
+            **({
+                "aws_cloudwatch_log_subscription_filter": {
+                    "cellxgene_request_metrics": {
+                        "name": "cellxgene-request-metrics",
+                        "log_group_name": "${aws_cloudwatch_log_group.cellxgene.name}",
+                        # Matches the access log lines and little else
+                        "filter_pattern": '"HTTP/1."',
+                        "destination_arn": "${aws_lambda_function.cellxgene_request_metrics.arn}",
+                        "depends_on": ["aws_lambda_permission.cellxgene_request_metrics"]
+                    }
+                }
+            } if request_metrics else {}),
+            **({
+                "aws_lb_target_group_attachment": {
+                    "cellxgene_waker": {
+                        "target_group_arn": "${aws_lb_target_group.cellxgene_waker.arn}",
+                        "target_id": "${aws_lambda_function.cellxgene_waker.arn}",
+                        "depends_on": ["aws_lambda_permission.cellxgene_waker"]
+                    }
+                }
+            } if sleeping_files else {}),
+            "aws_cloudwatch_event_rule": {
+                name: {
+                    "name": name.replace('_', '-'),
+                    "schedule_expression": schedule
+                } for name, schedule in scheduled_functions.items()
+            },
+            "aws_cloudwatch_event_target": {
+                name: {
+                    "rule": f"${{aws_cloudwatch_event_rule.{name}.name}}",
+                    "arn": f"${{aws_lambda_function.{name}.arn}}"
+                } for name in scheduled_functions
+            }
+        } if lambdas else {}),
         "aws_cloudwatch_log_group": {
             "cellxgene": {
                 "name": "/aws/fargate/cellxgene",
@@ -521,7 +1806,31 @@ emit_tf({
     },
     "output": {
         "total_cluster_hourly_cost": {
-            "value": f"${sum(sum(matrix_file.fargate_specs.cost_per_hour) for matrix_file in matrix_files):<0.5}"
-        }
+            "value": f"${sum(p.cost_per_hour for p in packs):<0.5}"
+        },
+        **({
+            # Used by scripts/populate_dataset_cache.py
+            "populate": {
+                "value": {
+                    "cluster": "${aws_ecs_cluster.cellxgene.name}",
+                    "task_definition": "${aws_ecs_task_definition.cellxgene_populate.arn}",
+                    **private_network_configuration()
+                }
+            }
+        } if efs_cache else {}),
+        **({
+            "rollout": {
+                "value": json.dumps(rollout_plan())
+            }
+        } if rollout else {})
     }
-})
+}
+
+if study_components:
+    assert len(set(map(component, packs))) == len(packs)
+    tf, component_docs = split(tf,
+                               {component(p): component_resources(p) for p in packs},
+                               remote_state_config())
+    write_components(os.path.dirname(os.path.abspath(__file__)), component_docs)
+
+emit_tf(tf)
@@ -0,0 +1,42 @@
+# The Makefile of the Terraform component of a study, generated below
+# `studies` by cellxgene.tf.json.template.py. Each directory links to this
+# file. Run `make deploy` in the project root to apply only the components
+# that changed.
+
+all: apply
+
+include ../../../common.mk
+
+# The name of the directory is the name of the component, which selects the
+# state of the component in the backend bucket
+export azul_terraform_component := $(notdir $(CURDIR))
+export TF_DATA_DIR := $(TF_DATA_DIR).$(azul_terraform_component)
+
+config: $(patsubst %.template.py,%,$(wildcard *.tf.json.template.py))
+
+init: config
+	terraform init
+
+validate: init
+	terraform validate
+
+plan: validate
+	terraform plan
+
+apply: validate
+	terraform apply
+
+auto_apply: validate
+	terraform apply -auto-approve
+
+destroy: validate
+	terraform destroy
+
+auto_destroy: validate
+	@echo '!!! All resources will be deleted in 10s, hit Ctrl-C to cancel !!!'; sleep 10
+	terraform destroy -auto-approve
+
+clean:
+	rm -f backend.tf.json providers.tf.json
+
+.PHONY: all config init validate plan apply auto_apply destroy auto_destroy clean
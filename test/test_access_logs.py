@@ -0,0 +1,101 @@
+import contextlib
+import doctest
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import cellxgene_fargate.access_logs
+from cellxgene_fargate.access_logs import (
+    Summary,
+    compare,
+    list_logs,
+    main,
+    report,
+    summarize,
+    summarize_log,
+)
+
+fixtures = os.path.join(os.path.dirname(__file__), 'fixtures', 'alb')
+
+domain = 'cellxgene.example.org'
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(cellxgene_fargate.access_logs))
+    return tests
+
+
+class TestAccessLogs(unittest.TestCase):
+    """
+    The first log has 20 schema requests of 2020-mar-foo taking 10 to 200 ms,
+    one for a static asset, one readiness check, one from a scanner and a
+    malformed line. The second one has 20 more schema requests taking 210 to
+    400 ms and three requests of 2020-mar-bar, one of which failed at the
+    target and one of which never reached it.
+    """
+
+    def setUp(self):
+        self.logs = list_logs([fixtures])
+
+    def test_summary(self):
+        self.assertEqual(['alb-1.log.gz', 'alb-2.log.gz'], [os.path.basename(path) for path in self.logs])
+        summary = Summary()
+        for path in self.logs:
+            summary.merge(summarize_log(path, domain))
+        studies = report(summary, top=2)['studies']
+        self.assertEqual({'2020-mar-foo', '2020-mar-bar', 'other'}, studies.keys())
+        foo = studies['2020-mar-foo']
+        # The readiness check isn't counted
+        self.assertEqual(41, foo['requests'])
+        self.assertEqual({'/api/v0.2/schema', '/static'}, foo['endpoints'].keys())
+        schema = foo['endpoints']['/api/v0.2/schema']
+        self.assertEqual(40, schema['requests'])
+        self.assertEqual(8.2, schema['target_seconds'])
+        # Within the relative accuracy of the sketch of the exact 380 ms
+        self.assertEqual(379.1, schema['p95_ms'])
+        self.assertAlmostEqual(380, schema['p95_ms'], delta=3.8)
+        bar = studies['2020-mar-bar']['endpoints']['/api/v0.2/data/var']
+        self.assertEqual((3, 1, 1), (bar['requests'], bar['target_errors'], bar['elb_errors']))
+        # The request that never reached a target has no latency
+        self.assertEqual(895.8, bar['p95_ms'])
+        self.assertEqual(2.4, bar['target_seconds'])
+        self.assertEqual(['other'], list(studies['other']['endpoints']))
+        self.assertEqual(1, summary.malformed)
+
+    def test_merge(self):
+        merged = Summary()
+        for path in self.logs:
+            merged.merge(summarize_log(path, domain))
+        lines = []
+        for path in self.logs:
+            with cellxgene_fargate.access_logs.open_log(path) as f:
+                lines.extend(f)
+        combined = summarize(lines, domain)
+        self.assertEqual(report(combined, top=5), report(merged, top=5))
+        schema = ('2020-mar-foo', '/api/v0.2/schema')
+        self.assertEqual(combined.stats[schema].latency.buckets, merged.stats[schema].latency.buckets)
+
+    def test_compare(self):
+        with tempfile.TemporaryDirectory() as d:
+            old_path, new_path = os.path.join(d, 'old.json'), os.path.join(d, 'new.json')
+            main(['--output', old_path, '--domain', domain, '--jobs', '1', self.logs[0]])
+            main(['--output', new_path, '--domain', domain, '--jobs', '2', fixtures])
+            # Both logs, found in the directory
+            with open(new_path) as f:
+                self.assertEqual(40, json.load(f)['studies']['2020-mar-foo']['endpoints']['/api/v0.2/schema']['requests'])
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                compare(old_path, new_path)
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('study'))
+        rows = {line.split()[0]: line for line in lines[1:]}
+        self.assertEqual({'2020-mar-foo', '2020-mar-bar', 'other'}, rows.keys())
+        self.assertIn('added', rows['2020-mar-bar'])
+        # 21 requests in 32 seconds, then 41 in 92 seconds
+        self.assertIn('0.656 -> 0.446 (-32%)', rows['2020-mar-foo'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import doctest
+import os
+import tempfile
+import unittest
+
+import cellxgene_fargate.forecast
+from cellxgene_fargate.forecast import (
+    forecast,
+    load_history,
+    load_schedules,
+    save_history,
+    save_schedules,
+    scheduled_actions,
+    weekdays,
+)
+from cellxgene_fargate.scaling import (
+    ScalingPolicies,
+)
+
+fixtures = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(cellxgene_fargate.forecast))
+    return tests
+
+
+class TestForecast(unittest.TestCase):
+
+    def setUp(self):
+        self.history = load_history(os.path.join(fixtures, 'history.json'))
+        self.policies = ScalingPolicies.load(os.path.join(fixtures, 'scaling.json'))
+
+    def test_forecast(self):
+        schedules = forecast(self.history, self.policies)
+        # The quiet study never needs more than its minimum
+        self.assertEqual(['2020-mar-foo', '2020-mar-sleepy'], sorted(schedules))
+        # Four weeks of history make for a weekly profile: Mondays at 9 need
+        # two replicas, Tuesdays at 14 more than the maximum of four
+        expected = [0] * 168
+        expected[9] = 2
+        expected[24 + 14] = 4
+        self.assertEqual(expected, schedules['2020-mar-foo'])
+        # Two days of history make for a daily profile, and a sleeping study
+        # needs a replica whenever it is expected to get requests
+        self.assertEqual([1 if hour % 24 == 12 else 0 for hour in range(168)],
+                         schedules['2020-mar-sleepy'])
+
+    def test_scheduled_actions(self):
+        schedules = forecast(self.history, self.policies)
+        actions = scheduled_actions(schedules['2020-mar-foo'], self.policies['2020-mar-foo'], lead_minutes=10)
+        self.assertEqual([
+            ('cron(50 8 ? * MON *)', 2, 4),
+            ('cron(0 10 ? * MON *)', 1, 4),
+            ('cron(50 13 ? * TUE *)', 4, 4),
+            ('cron(0 15 ? * TUE *)', 1, 4)
+        ], [(a.schedule, a.min_capacity, a.max_capacity) for a in actions])
+        # A sleeping study is only ever woken up ahead of time
+        actions = scheduled_actions(schedules['2020-mar-sleepy'], self.policies['2020-mar-sleepy'], lead_minutes=10)
+        self.assertEqual([f'cron(50 11 ? * {day} *)' for day in weekdays],
+                         [a.schedule for a in actions])
+        self.assertEqual({1}, {a.min_capacity for a in actions})
+
+    def test_round_trip(self):
+        schedules = forecast(self.history, self.policies)
+        with tempfile.TemporaryDirectory() as d:
+            history_path = os.path.join(d, 'history.json')
+            save_history(history_path, self.history)
+            self.assertEqual(self.history, load_history(history_path))
+            schedules_path = os.path.join(d, 'schedules.json')
+            save_schedules(schedules_path, schedules)
+            self.assertEqual(schedules, load_schedules(schedules_path))
+            self.assertEqual({}, load_schedules(os.path.join(d, 'missing.json')))
+
+
+if __name__ == '__main__':
+    unittest.main()
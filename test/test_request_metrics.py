@@ -0,0 +1,126 @@
+import base64
+import contextlib
+import doctest
+import gzip
+import io
+import json
+import os
+import unittest
+from unittest import mock
+
+import cellxgene_fargate.request_metrics
+from cellxgene_fargate.request_metrics import (
+    Request,
+    Stats,
+    emf_documents,
+    handler,
+    main,
+    max_emf_values,
+    namespace,
+    parse,
+)
+
+fixtures = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(cellxgene_fargate.request_metrics))
+    return tests
+
+
+class TestRequestMetrics(unittest.TestCase):
+    """
+    The log has a line that isn't an access log line, followed by one line
+    each of gunicorn, the cache proxy and werkzeug, and a readiness check
+    """
+
+    def setUp(self):
+        with open(os.path.join(fixtures, '2020-mar-foo.log')) as f:
+            self.lines = f.read().splitlines()
+
+    def test_parse(self):
+        self.assertEqual([
+            None,
+            Request(endpoint='/api/v0.2/schema', status=200, bytes=1234, latency_ms=5.3, timestamp=1792314000000),
+            Request(endpoint='/api/v0.2/data/var', status=500, bytes=0, latency_ms=125.0, timestamp=1792314001000),
+            Request(endpoint='other', status=404, bytes=0, latency_ms=None, timestamp=1792314002000),
+            None
+        ], list(map(parse, self.lines)))
+
+    def handle(self, stream: str):
+        data = {
+            'messageType': 'DATA_MESSAGE',
+            'logGroup': '/ecs/cellxgene',
+            'logStream': stream,
+            'logEvents': [
+                {'id': str(i), 'timestamp': 1792314000000 + i, 'message': line}
+                for i, line in enumerate(self.lines)
+            ]
+        }
+        event = {'awslogs': {'data': base64.b64encode(gzip.compress(json.dumps(data).encode())).decode()}}
+        output = io.StringIO()
+        with mock.patch.dict(os.environ, CELLXGENE_FRONTEND_CONTAINER='cache-proxy'):
+            with contextlib.redirect_stdout(output):
+                handler(event, None)
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_handler(self):
+        documents = {d['Endpoint']: d for d in self.handle('2020-mar-foo/cache-proxy/0123abcd')}
+        # The readiness check isn't counted
+        self.assertEqual({'/api/v0.2/schema', '/api/v0.2/data/var', 'other'}, documents.keys())
+        document = documents['/api/v0.2/data/var']
+        self.assertEqual({
+            'Timestamp': 1792314000002,
+            'CloudWatchMetrics': [
+                {
+                    'Namespace': namespace,
+                    'Dimensions': [['Study', 'Endpoint'], ['Study']],
+                    'Metrics': [
+                        {'Name': 'Requests', 'Unit': 'Count'},
+                        {'Name': 'ClientErrors', 'Unit': 'Count'},
+                        {'Name': 'ServerErrors', 'Unit': 'Count'},
+                        {'Name': 'Bytes', 'Unit': 'Bytes'},
+                        {'Name': 'Latency', 'Unit': 'Milliseconds'}
+                    ]
+                }
+            ]
+        }, document['_aws'])
+        self.assertEqual(('2020-mar-foo', 1, 0, 1, 0, [125.0]),
+                         tuple(document[k] for k in ('Study', 'Requests', 'ClientErrors', 'ServerErrors', 'Bytes', 'Latency')))
+        # Without a duration in the line, there is no latency to report
+        document = documents['other']
+        self.assertEqual(1, document['ClientErrors'])
+        self.assertNotIn('Latency', document)
+        self.assertNotIn('Latency', [m['Name'] for m in document['_aws']['CloudWatchMetrics'][0]['Metrics']])
+        # The lines of the containers behind the frontend aren't counted
+        self.assertEqual([], self.handle('2020-mar-foo/cellxgene/0123abcd'))
+
+    def test_emf_documents(self):
+        stats = Stats()
+        for i in range(max_emf_values * 2 + 1):
+            stats.add(Request(endpoint='/api/v0.2/schema', status=200, bytes=10, latency_ms=float(i), timestamp=0))
+        documents = emf_documents('2020-mar-foo', '/api/v0.2/schema', stats, 1792314000000)
+        self.assertEqual([max_emf_values, max_emf_values, 1], [len(d['Latency']) for d in documents])
+        self.assertEqual(list(range(max_emf_values * 2 + 1)), [v for d in documents for v in d['Latency']])
+        # Only the first document has the counts, so they aren't counted twice
+        self.assertEqual(max_emf_values * 2 + 1, documents[0]['Requests'])
+        for document in documents[1:]:
+            self.assertEqual({'_aws', 'Study', 'Endpoint', 'Latency'}, document.keys())
+            self.assertEqual([{'Name': 'Latency', 'Unit': 'Milliseconds'}],
+                             document['_aws']['CloudWatchMetrics'][0]['Metrics'])
+
+    def test_main(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            main(['--emf', os.path.join(fixtures, '2020-mar-foo.log')])
+        documents = [json.loads(line) for line in output.getvalue().splitlines()]
+        # The study is taken from the name of the file, the time from the lines
+        self.assertEqual([
+            ('2020-mar-foo', '/api/v0.2/data/var', 1792314001000),
+            ('2020-mar-foo', '/api/v0.2/schema', 1792314000000),
+            ('2020-mar-foo', 'other', 1792314002000)
+        ], [(d['Study'], d['Endpoint'], d['_aws']['Timestamp']) for d in documents])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+from datetime import (
+    datetime,
+    timezone,
+)
+import unittest
+
+from botocore.exceptions import ClientError
+
+from cellxgene_fargate.rollout import (
+    Rollout,
+    RolloutFailed,
+    Service,
+)
+
+
+class FakeECS:
+    """
+    Just enough of ECS for a rollout. An update starts a new deployment whose
+    tasks start, or stop right away if their image is broken, each time the
+    rollout sleeps.
+    """
+
+    def __init__(self, services, broken_images=()):
+        self.task_definitions = {}
+        self.services = {}
+        self.stopped_tasks = []
+        self.broken_images = set(broken_images)
+        self.updates = []
+        self.throttle = 0
+        for name, image in services.items():
+            arn = self._register(family=name, image=image)
+            self.services[name] = {
+                'serviceName': name,
+                'taskDefinition': arn,
+                'deployments': [self._deployment(arn, running=1)],
+                'loadBalancers': [{'targetGroupArn': 'tg-' + name}]
+            }
+
+    def _register(self, family, image, **kwargs):
+        revision = 1 + sum(td['family'] == family for td in self.task_definitions.values())
+        arn = f'arn:aws:ecs:us-east-1:123:task-definition/{family}:{revision}'
+        self.task_definitions[arn] = {
+            'taskDefinitionArn': arn,
+            'family': family,
+            'status': 'ACTIVE',
+            'containerDefinitions': [{'name': 'cellxgene', 'image': image}],
+            **kwargs
+        }
+        return arn
+
+    def _deployment(self, arn, running=0):
+        return {'status': 'PRIMARY', 'taskDefinition': arn, 'desiredCount': 1, 'runningCount': running}
+
+    def release(self, family, image):
+        return self._register(family=family, image=image)
+
+    def image(self, arn):
+        return self.task_definitions[arn]['containerDefinitions'][0]['image']
+
+    def advance(self):
+        for service in self.services.values():
+            primary = service['deployments'][0]
+            if self.image(primary['taskDefinition']) in self.broken_images:
+                self.stopped_tasks.append({'taskDefinitionArn': primary['taskDefinition'],
+                                           'createdAt': datetime.now(timezone.utc)})
+            else:
+                primary['runningCount'] = primary['desiredCount']
+                del service['deployments'][1:]
+
+    def describe_services(self, cluster, services):
+        if self.throttle:
+            self.throttle -= 1
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}},
+                              'DescribeServices')
+        return {
+            'services': [self.services[name] for name in services],
+            'failures': []
+        }
+
+    def describe_task_definition(self, taskDefinition):
+        if taskDefinition in self.task_definitions:
+            return {'taskDefinition': self.task_definitions[taskDefinition]}
+        else:
+            latest = max((td for td in self.task_definitions.values()
+                          if td['family'] == taskDefinition and td['status'] == 'ACTIVE'),
+                         key=lambda td: int(td['taskDefinitionArn'].rsplit(':', 1)[1]))
+            return {'taskDefinition': latest}
+
+    def register_task_definition(self, family, containerDefinitions, **kwargs):
+        arn = self._register(family=family, image=containerDefinitions[0]['image'], **kwargs)
+        return {'taskDefinition': self.task_definitions[arn]}
+
+    def update_service(self, cluster, service, taskDefinition):
+        self.updates.append((service, taskDefinition))
+        service = self.services[service]
+        service['taskDefinition'] = taskDefinition
+        for deployment in service['deployments']:
+            deployment['status'] = 'ACTIVE'
+        service['deployments'].insert(0, self._deployment(taskDefinition))
+
+    def list_tasks(self, cluster, serviceName, desiredStatus):
+        return {'taskArns': [f'task-{i}' for i in range(len(self.stopped_tasks))]}
+
+    def describe_tasks(self, cluster, tasks):
+        return {'tasks': self.stopped_tasks}
+
+
+class FakeELBv2:
+
+    def describe_target_health(self, TargetGroupArn):
+        return {'TargetHealthDescriptions': [{'TargetHealth': {'State': 'healthy'}}]}
+
+
+class TestRollout(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def rollout(self, ecs, timeout=600):
+
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+            ecs.advance()
+
+        return Rollout(ecs=ecs,
+                       elbv2=FakeELBv2(),
+                       cluster='cellxgene',
+                       timeout=timeout,
+                       poll_interval=15,
+                       sleep=sleep,
+                       clock=self.clock)
+
+    services = [
+        Service(name='small', family='small', size=1, grace_period=60),
+        Service(name='medium', family='medium', size=2, grace_period=60),
+        Service(name='large', family='large', size=3, grace_period=120)
+    ]
+
+    def ecs(self, **kwargs):
+        return FakeECS({service.name: 'cellxgene:1' for service in self.services}, **kwargs)
+
+    def test_run(self):
+        ecs = self.ecs()
+        new = {name: ecs.release(name, 'cellxgene:2') for name in ('small', 'medium', 'large')}
+        self.rollout(ecs).run(self.services, batch_size=2)
+        # Smallest first, one batch after the other
+        self.assertEqual([('small', new['small']), ('medium', new['medium']), ('large', new['large'])],
+                         ecs.updates)
+        self.assertEqual([15, 15], self.sleeps)
+        for name, arn in new.items():
+            self.assertEqual(arn, ecs.services[name]['taskDefinition'])
+
+    def test_up_to_date(self):
+        ecs = self.ecs()
+        medium = ecs.release('medium', 'cellxgene:2')
+        self.rollout(ecs).run(self.services, batch_size=1)
+        self.assertEqual([('medium', medium)], ecs.updates)
+        self.assertEqual([], self.rollout(ecs).plan(self.services, batch_size=1))
+
+    def test_failed_batch(self):
+        ecs = self.ecs(broken_images=['cellxgene:2'])
+        old = {name: ecs.services[name]['taskDefinition'] for name in ecs.services}
+        ecs.release('small', 'cellxgene:1.1')
+        for name in ('medium', 'large'):
+            ecs.release(name, 'cellxgene:2')
+        # Terraform deregisters the revisions it replaces
+        ecs.task_definitions[old['medium']]['status'] = 'INACTIVE'
+        with self.assertRaises(RolloutFailed) as cm:
+            self.rollout(ecs).run(self.services, batch_size=1)
+        self.assertIn('new tasks of medium stopped', str(cm.exception))
+        updated = [name for name, _ in ecs.updates]
+        # The second batch failed, so the first one is rolled back, too
+        self.assertEqual(['small', 'medium', 'small', 'medium'], updated)
+        self.assertNotIn('large', updated)
+        self.assertEqual(old['small'], ecs.services['small']['taskDefinition'])
+        # The deregistered revision was copied, since ECS can't start it
+        medium = ecs.services['medium']['taskDefinition']
+        self.assertNotEqual(old['medium'], medium)
+        self.assertEqual('cellxgene:1', ecs.image(medium))
+        self.assertEqual('ACTIVE', ecs.task_definitions[medium]['status'])
+        for name in ('small', 'medium'):
+            self.assertEqual(1, len(ecs.services[name]['deployments']))
+
+    def test_timeout(self):
+        ecs = self.ecs()
+        ecs.release('small', 'cellxgene:2')
+        ecs.advance = lambda: None
+        with self.assertRaises(RolloutFailed) as cm:
+            self.rollout(ecs, timeout=30).run(self.services, batch_size=1)
+        self.assertIn('Timed out waiting for small', str(cm.exception))
+        self.assertGreater(self.now, 60 + 30)
+        # The rollback times out, too, which is logged but not raised
+        self.assertEqual('small', ecs.updates[-1][0])
+        self.assertEqual('cellxgene:1', ecs.image(ecs.updates[-1][1]))
+
+    def test_throttling(self):
+        ecs = self.ecs()
+        ecs.release('small', 'cellxgene:2')
+        ecs.throttle = 2
+        self.rollout(ecs).run(self.services, batch_size=1)
+        self.assertEqual(1, len(ecs.updates))
+        # Two retries with backoff, then one poll
+        self.assertEqual(3, len(self.sleeps))
+
+
+if __name__ == '__main__':
+    unittest.main()
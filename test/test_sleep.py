@@ -0,0 +1,206 @@
+from datetime import (
+    datetime,
+    timedelta,
+    timezone,
+)
+import unittest
+
+import boto3
+from moto import (
+    mock_applicationautoscaling,
+    mock_cloudwatch,
+    mock_ec2,
+    mock_ecs,
+    mock_elbv2,
+    mock_ssm,
+)
+
+from cellxgene_fargate.sleep import (
+    StudyConfig,
+    arn_suffix,
+    sleep,
+    wake,
+)
+
+region = 'us-east-1'
+
+
+@mock_applicationautoscaling
+@mock_cloudwatch
+@mock_ec2
+@mock_ecs
+@mock_elbv2
+@mock_ssm
+class TestSleep(unittest.TestCase):
+
+    def setUp(self):
+        self.ssm = boto3.client('ssm', region_name=region)
+        self.ecs = boto3.client('ecs', region_name=region)
+        self.elbv2 = boto3.client('elbv2', region_name=region)
+        self.autoscaling = boto3.client('application-autoscaling', region_name=region)
+        self.cloudwatch = boto3.client('cloudwatch', region_name=region)
+        ec2 = boto3.client('ec2', region_name=region)
+        vpc_id = ec2.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']['VpcId']
+        subnet_ids = [
+            ec2.create_subnet(VpcId=vpc_id,
+                              CidrBlock=f'10.0.{i}.0/24',
+                              AvailabilityZone=region + zone)['Subnet']['SubnetId']
+            for i, zone in enumerate('ab')
+        ]
+        load_balancer_arn = self.elbv2.create_load_balancer(Name='cellxgene',
+                                                            Subnets=subnet_ids)['LoadBalancers'][0]['LoadBalancerArn']
+        self.target_group_arn = self.elbv2.create_target_group(Name='foo',
+                                                               Protocol='HTTP',
+                                                               Port=5005,
+                                                               VpcId=vpc_id,
+                                                               TargetType='ip')['TargetGroups'][0]['TargetGroupArn']
+        self.waker_target_group_arn = self.elbv2.create_target_group(Name='cellxgene-waker',
+                                                                     TargetType='lambda')['TargetGroups'][0]['TargetGroupArn']
+        listener_arn = self.elbv2.create_listener(LoadBalancerArn=load_balancer_arn,
+                                                  Protocol='HTTP',
+                                                  Port=80,
+                                                  DefaultActions=[{
+                                                      'Type': 'fixed-response',
+                                                      'FixedResponseConfig': {'StatusCode': '404'}
+                                                  }])['Listeners'][0]['ListenerArn']
+        rule_arn = self.elbv2.create_rule(ListenerArn=listener_arn,
+                                          Priority=1,
+                                          Conditions=[{
+                                              'Field': 'host-header',
+                                              'Values': ['2020-mar-foo.cellxgene.example.org']
+                                          }],
+                                          Actions=[{
+                                              'Type': 'forward',
+                                              'TargetGroupArn': self.target_group_arn
+                                          }])['Rules'][0]['RuleArn']
+        self.ecs.create_cluster(clusterName='cellxgene')
+        self.ecs.register_task_definition(family='cellxgene-2020-mar-foo',
+                                          containerDefinitions=[{'name': 'cellxgene', 'image': 'img', 'memory': 512}])
+        self.ecs.create_service(cluster='cellxgene',
+                                serviceName='cellxgene-2020-mar-foo',
+                                taskDefinition='cellxgene-2020-mar-foo',
+                                desiredCount=1)
+        self.config = StudyConfig(subdomain='2020-mar-foo',
+                                  cluster='cellxgene',
+                                  service='cellxgene-2020-mar-foo',
+                                  target_group_arn=self.target_group_arn,
+                                  listener_rule_arn=rule_arn,
+                                  load_balancer_arn=load_balancer_arn,
+                                  min_capacity=2,
+                                  max_capacity=4,
+                                  sleep_after_minutes=60)
+        self.ssm.put_parameter(Name=self.config.parameter_name,
+                               Value=self.config.to_json(),
+                               Type='String')
+        self.autoscaling.register_scalable_target(ServiceNamespace='ecs',
+                                                  ResourceId=self.config.resource_id,
+                                                  ScalableDimension='ecs:service:DesiredCount',
+                                                  MinCapacity=self.config.min_capacity,
+                                                  MaxCapacity=self.config.max_capacity)
+
+    def desired_count(self) -> int:
+        response = self.ecs.describe_services(cluster=self.config.cluster, services=[self.config.service])
+        return response['services'][0]['desiredCount']
+
+    def min_capacity(self) -> int:
+        response = self.autoscaling.describe_scalable_targets(ServiceNamespace='ecs',
+                                                              ResourceIds=[self.config.resource_id])
+        return response['ScalableTargets'][0]['MinCapacity']
+
+    def forwarded_to(self) -> str:
+        response = self.elbv2.describe_rules(RuleArns=[self.config.listener_rule_arn])
+        return response['Rules'][0]['Actions'][0]['TargetGroupArn']
+
+    def event(self, host: str = '2020-mar-foo.cellxgene.example.org'):
+        return {
+            'httpMethod': 'GET',
+            'path': '/api/v0.2/schema',
+            'queryStringParameters': {'foo': 'bar'},
+            'headers': {'host': host}
+        }
+
+    def wake(self, event=None, on_wake=None):
+        return wake(self.event() if event is None else event,
+                    ssm=self.ssm,
+                    ecs=self.ecs,
+                    elbv2=self.elbv2,
+                    autoscaling=self.autoscaling,
+                    on_wake=on_wake)
+
+    def sleep(self, now: datetime):
+        return sleep(ssm=self.ssm,
+                     ecs=self.ecs,
+                     elbv2=self.elbv2,
+                     autoscaling=self.autoscaling,
+                     cloudwatch=self.cloudwatch,
+                     waker_target_group_arn=self.waker_target_group_arn,
+                     now=now)
+
+    def later(self, minutes: int) -> datetime:
+        return datetime.now(timezone.utc) + timedelta(minutes=minutes)
+
+    def test_sleep(self):
+        self.assertEqual([], self.sleep(self.later(30)))
+        self.assertEqual(['2020-mar-foo'], self.sleep(self.later(90)))
+        self.assertEqual(0, self.desired_count())
+        self.assertEqual(0, self.min_capacity())
+        self.assertEqual(self.waker_target_group_arn, self.forwarded_to())
+        # A sleeping study isn't put to sleep again
+        self.assertEqual([], self.sleep(self.later(180)))
+
+    def test_sleep_busy(self):
+        now = self.later(90)
+        self.cloudwatch.put_metric_data(Namespace='AWS/ApplicationELB',
+                                        MetricData=[{
+                                            'MetricName': 'RequestCount',
+                                            'Dimensions': [
+                                                {'Name': 'LoadBalancer', 'Value': arn_suffix(self.config.load_balancer_arn)},
+                                                {'Name': 'TargetGroup', 'Value': arn_suffix(self.target_group_arn)}
+                                            ],
+                                            'Timestamp': now - timedelta(minutes=10),
+                                            'Value': 3
+                                        }])
+        self.assertEqual([], self.sleep(now))
+        self.assertEqual(1, self.desired_count())
+        self.assertEqual(self.target_group_arn, self.forwarded_to())
+
+    def test_wake(self):
+        self.sleep(self.later(90))
+        woken = []
+        response = self.wake(on_wake=woken.append)
+        self.assertEqual(503, response['statusCode'])
+        self.assertEqual('10', response['headers']['Retry-After'])
+        self.assertIn('2020-mar-foo is starting up', response['body'])
+        self.assertEqual([self.config], woken)
+        self.assertEqual(2, self.desired_count())
+        self.assertEqual(2, self.min_capacity())
+        # The waker keeps handling the requests until a task is healthy
+        self.assertEqual(self.waker_target_group_arn, self.forwarded_to())
+        response = self.wake(on_wake=woken.append)
+        self.assertEqual(503, response['statusCode'])
+        self.assertEqual(1, len(woken))
+
+    def test_hand_over(self):
+        self.sleep(self.later(90))
+        self.wake()
+        self.elbv2.register_targets(TargetGroupArn=self.target_group_arn,
+                                    Targets=[{'Id': '10.0.0.5', 'Port': 5005}])
+        response = self.wake()
+        self.assertEqual(307, response['statusCode'])
+        self.assertEqual('/api/v0.2/schema?foo=bar', response['headers']['Location'])
+        self.assertEqual(self.target_group_arn, self.forwarded_to())
+
+    def test_forwarded_host(self):
+        event = self.event(host='cellxgene-1234.us-east-1.elb.amazonaws.com')
+        event['headers']['x-forwarded-host'] = '2020-mar-foo.cellxgene.example.org'
+        self.sleep(self.later(90))
+        self.assertEqual(503, self.wake(event)['statusCode'])
+        self.assertEqual(2, self.desired_count())
+
+    def test_unknown_study(self):
+        response = self.wake(self.event(host='2020-mar-bar.cellxgene.example.org'))
+        self.assertEqual(404, response['statusCode'])
+
+
+if __name__ == '__main__':
+    unittest.main()